@@ -304,11 +304,14 @@ server.get('/start', async function(req, res) {
  *
  *   The POST body is a JSON array of lane results
  *   [
- *     {"laneNumber": <number>, "laneTime":<number>},
+ *     {"laneNumber": <number>, "laneTime":<number>, "laneTimeError":<number|null>},
  *     ...
- *     {"laneNumber": <number>, "laneTime":<number>}
+ *     {"laneNumber": <number>, "laneTime":<number>, "laneTimeError":<number|null>}
  *   ]
  *
+ *   laneTimeError is the Starting Gate's bound, in seconds, on the error in laneTime
+ *   or null if unknown. It is passed through to the results unchanged.
+ *
  *  Return:
  *
  *   A sorted list of finishers from first to last
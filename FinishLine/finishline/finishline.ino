@@ -4,8 +4,12 @@
 	The finish line is responsible for monitoring for cars passing over each lane
   and reporting back to the Starting Gate via Bluetooth.
 
-  TODO(tq): Finish write-up including commands accepted over BlueTooth and OTA
-            updates
+  New firmware can be installed two ways: streamed from the Starting Gate over the
+  Bluetooth link (OTAB/OTAD/OTAF, see otaBegin() and StartingGate/firmware_update.py),
+  which needs no network, or fetched from the coordinator over WiFi. The WiFi check runs
+  in a background task at boot and on request (UPFW), so Bluetooth is up at once.
+
+  TODO(tq): Finish write-up including commands accepted over BlueTooth
 
 Author: Tom Quiggle
 tquiggle@gmail.com
@@ -28,6 +32,7 @@ full license information.
 #endif
 
 // #include <string>
+#include <atomic>
 #include <map>
 
 #include <Arduino.h>
@@ -38,6 +43,9 @@ full license information.
 #include <WiFi.h>
 #include <FS.h>
 #include <SPIFFS.h>
+#include <Update.h>
+#include <esp32/rom/crc.h>
+#include <mbedtls/base64.h>
 
 // Hard coded config
 const char* FW_VERSION = "21012000";
@@ -53,7 +61,7 @@ const char* configFilename = "/config.json";
 #define DEFAULT_BT_ADVERTISEMENT "FinishLine"
 #define DEFAULT_CONTROLLER_HOSTNAME "nas.weiland.site"
 #define DEFAULT_CONTROLLER_PORT 1968
-#define MAX_CONFIG_SIZE 256
+#define MAX_CONFIG_SIZE 512
 #define MAX_LANES 4
 
 // Configuration stored in config.json
@@ -68,6 +76,7 @@ const int LANE1_PIN = 16;
 const int LANE2_PIN = 17;
 const int LANE3_PIN = 18;
 const int LANE4_PIN = 19;
+const int LANE_PINS[] = {LANE1_PIN, LANE2_PIN, LANE3_PIN, LANE4_PIN};
 
 enum Lanes {
   LANE1 = 0,  // Lanes is used as an array index
@@ -86,18 +95,59 @@ enum Commands {
   GET_CONFIG,
   SET_CONFIG,
   DELETE_CONFIG,
+  GET_TIME,
+  KEEPALIVE,
+  REPLAY,
+  OTA_BEGIN,
+  OTA_DATA,
+  OTA_FINISH,
+  OTA_ABORT,
   UNKNOWN
 };
 
-#define DEBOUNCE_MILLIS 100
-unsigned long lastFinish[MAX_LANES] = {0, 0, 0, 0};
-const int finishMessageLength = 4;
-const uint8_t* finishMessages[MAX_LANES] = {
-  (uint8_t*)"FIN1",
-  (uint8_t*)"FIN2",
-  (uint8_t*)"FIN3",
-  (uint8_t*)"FIN4"
-};
+/*
+ * Every message exchanged with the Starting Gate is a line of ASCII text terminated
+ * by MESSAGE_TERMINATOR: a four character command optionally followed by a space and
+ * arguments. The Starting Gate parses the stream with protocol.MessageFramer; keep
+ * StartingGate/protocol.py in sync with any change here.
+ */
+#define MESSAGE_TERMINATOR '\n'
+#define MAX_MESSAGE_LENGTH 256    // Same limit as protocol.MAX_MESSAGE_LENGTH
+
+/*
+ * Protocol features this firmware supports, reported in hex in the HELLO reply along with
+ * FW_VERSION. The Starting Gate only uses features both sides support, and caches them so
+ * it needn't wait for HELLO on later connections. Must match the CAP_* flags in protocol.py.
+ */
+#define CAP_FRAMING       0x01  // Every message is newline terminated
+#define CAP_TIMESTAMPS    0x02  // FIN carries the micros() of the crossing
+#define CAP_TIME_SYNC     0x04  // Answers TIME
+#define CAP_PING          0x08  // Answers PING
+#define CAP_ARM_ACK       0x10  // Answers BGIN with ARMED, and FIN carries the race id
+#define CAP_REPLAY        0x20  // FIN carries a sequence number, and answers RPLY
+#define CAP_BATCH_CONFIG  0x40  // SETC accepts a JSON object, and SETC/GETC are answered with CONF
+#define CAP_OTA           0x80  // Accepts a firmware image over the link (OTAB/OTAD/OTAF/OTAA)
+#define FW_CAPABILITIES   (CAP_FRAMING | CAP_TIMESTAMPS | CAP_TIME_SYNC | CAP_PING | \
+                           CAP_ARM_ACK | CAP_REPLAY | CAP_BATCH_CONFIG | CAP_OTA)
+#define HELLO_MESSAGE_LENGTH 32   // "HELLO " + FW_VERSION + " " + capabilities + '\0'
+
+/*
+ * Edges within a lane's debounce of its last finish are the same car (the sensor bouncing,
+ * or the gaps in a short car's body) rather than a new crossing. The debounce of each lane
+ * is fitted from recorded sensor traces by the Starting Gate's debounce_fit.py and sent in
+ * the laneDebounce setting, as the microseconds for each lane separated by commas.
+ */
+#define DEFAULT_DEBOUNCE_MICROS 100000UL
+unsigned long laneDebounceMicros[MAX_LANES] = {DEFAULT_DEBOUNCE_MICROS, DEFAULT_DEBOUNCE_MICROS,
+                                               DEFAULT_DEBOUNCE_MICROS, DEFAULT_DEBOUNCE_MICROS};
+unsigned long lastFinish[MAX_LANES] = {0, 0, 0, 0};  // micros() of each lane's last finish
+#define FINISH_MESSAGE_LENGTH 40  // "FINn " + micros() + " " + race id + " " + sequence + '\0'
+#define TIME_MESSAGE_LENGTH 48    // "TIME " + sequence + two micros() + separators
+#define OTA_CHUNK_SIZE 168        // Largest OTAD chunk, same as firmware_update.OTA_CHUNK_SIZE
+#define OTA_MESSAGE_LENGTH 24     // "OTAK " + offset + '\0'
+#define WIFI_CONNECT_TIMEOUT_MS 15000   // Give up on the update check if WiFi takes longer
+#define HTTP_TIMEOUT_MS 5000            // Limit on each step of talking to the coordinator
+#define UPDATE_TASK_STACK_SIZE 8192
 
 /* Mapping for command string received over Bluetooth to enum */
 static const std::map<String, Commands> commandTable = {
@@ -109,7 +159,14 @@ static const std::map<String, Commands> commandTable = {
   {"FWVS", Commands::VERSION},
   {"GETC", Commands::GET_CONFIG},
   {"SETC", Commands::SET_CONFIG},
-  {"DELC", Commands::DELETE_CONFIG}
+  {"DELC", Commands::DELETE_CONFIG},
+  {"TIME", Commands::GET_TIME},
+  {"PING", Commands::KEEPALIVE},
+  {"RPLY", Commands::REPLAY},
+  {"OTAB", Commands::OTA_BEGIN},
+  {"OTAD", Commands::OTA_DATA},
+  {"OTAF", Commands::OTA_FINISH},
+  {"OTAA", Commands::OTA_ABORT}
 };
 
 Commands toCommand(String str) {
@@ -120,7 +177,136 @@ Commands toCommand(String str) {
 }
 
 BluetoothSerial SerialBT;
-bool raceRunning = false;
+volatile bool raceRunning = false;  // Also read by laneISR()
+
+/*
+ * Lane crossings are detected by falling edge interrupts rather than by polling the
+ * sensors from loop(), so the time of a crossing doesn't depend on how long Bluetooth
+ * servicing or logging held up the loop. laneISR() only stamps the edge with micros()
+ * and pushes the stamp onto its lane's queue; loop() drains the queues, debounces, and
+ * sends the FIN messages.
+ *
+ * Each queue has a single producer (the ISR) and a single consumer (loop()), so it is
+ * a lock-free ring: only the ISR advances head and only loop() advances tail. The
+ * indices are free running and LANE_QUEUE_SIZE is a power of two, so head - tail is
+ * the number of stamps queued even across unsigned overflow. An edge arriving while the
+ * queue is full is counted in overflows and dropped.
+ */
+#define LANE_QUEUE_SIZE 16
+
+struct LaneQueue {
+  unsigned long stamps[LANE_QUEUE_SIZE];
+  std::atomic<uint32_t> head;
+  std::atomic<uint32_t> tail;
+  std::atomic<uint32_t> overflows;
+};
+
+LaneQueue laneQueues[MAX_LANES];
+
+void IRAM_ATTR laneISR(void* arg) {
+  if (!raceRunning) {
+    return;
+  }
+  unsigned long now = micros();
+  LaneQueue& queue = laneQueues[(intptr_t)arg];
+  uint32_t head = queue.head.load(std::memory_order_relaxed);
+  if (head - queue.tail.load(std::memory_order_acquire) >= LANE_QUEUE_SIZE) {
+    queue.overflows.fetch_add(1, std::memory_order_relaxed);
+    return;
+  }
+  queue.stamps[head % LANE_QUEUE_SIZE] = now;
+  queue.head.store(head + 1, std::memory_order_release);
+}
+
+// Pop the oldest stamp queued for lane into stamp. Returns false if the queue is empty.
+bool popLaneStamp(Lanes lane, unsigned long& stamp) {
+  LaneQueue& queue = laneQueues[lane];
+  uint32_t tail = queue.tail.load(std::memory_order_relaxed);
+  if (tail == queue.head.load(std::memory_order_acquire)) {
+    return false;
+  }
+  stamp = queue.stamps[tail % LANE_QUEUE_SIZE];
+  queue.tail.store(tail + 1, std::memory_order_release);
+  return true;
+}
+
+// Discard every queued stamp, e.g. edges from cars being placed before the race
+void flushLaneQueues() {
+  for (int lane = LANE1; lane <= LANE4; lane++) {
+    laneQueues[lane].tail.store(laneQueues[lane].head.load(std::memory_order_acquire),
+                                std::memory_order_release);
+  }
+}
+
+/*
+ * Bytes of the message currently being received. Commands are assembled a byte at a
+ * time as they arrive so loop() never waits on the Stream timeout for the rest of a
+ * message. A message longer than MAX_MESSAGE_LENGTH is discarded up to its terminator.
+ */
+char messageBuffer[MAX_MESSAGE_LENGTH + 1];
+size_t messageLength = 0;
+bool discardingMessage = false;
+String raceId;  // Id the Starting Gate armed the current race with, echoed in every FIN
+
+/*
+ * The last EVENT_LOG_SIZE finishes of the current race, so that finishes sent while the
+ * Bluetooth link was down can be resent (RPLY) once the Starting Gate reconnects. Each
+ * finish is numbered in sequence from 1; finish n is kept in eventLog[(n - 1) % EVENT_LOG_SIZE].
+ */
+#define EVENT_LOG_SIZE 16
+
+struct FinishEvent {
+  Lanes lane;
+  unsigned long detectedMicros;
+};
+
+FinishEvent eventLog[EVENT_LOG_SIZE];
+unsigned int eventCount = 0;  // Sequence number of the race's latest finish
+
+// Firmware image being received from the Starting Gate, see otaBegin()
+size_t otaSize = 0;           // Size of the image, as given by OTAB
+String otaMD5;                // MD5 of the image, as given by OTAB
+size_t otaOffset = 0;         // Bytes of the image written so far
+bool otaNakSent = false;      // Chunks are being rejected until otaOffset is resent
+
+// State of the background update check, see checkForUpdates()
+std::atomic<bool> updateCheckRunning(false);
+std::atomic<bool> updateDownloading(false);   // Update is claimed by the download, or by OTAB
+std::atomic<bool> updateReady(false);         // A new image is installed, restart to boot it
+
+// Send a single framed message to the Starting Gate
+void sendMessage(const char* message) {
+  SerialBT.write((const uint8_t*)message, strlen(message));
+  SerialBT.write(MESSAGE_TERMINATOR);
+}
+
+// The laneDebounce setting: each lane's debounce in microseconds, separated by commas
+String laneDebounceSetting() {
+  String setting;
+  for (int lane = LANE1; lane <= LANE4; lane++) {
+    if (lane != LANE1) setting += ",";
+    setting += String(laneDebounceMicros[lane]);
+  }
+  return setting;
+}
+
+// Set every lane's debounce from a laneDebounce setting. Returns false, changing nothing,
+// unless it holds a number for each lane.
+bool parseLaneDebounce(String setting) {
+  unsigned long debounceMicros[MAX_LANES];
+  int start = 0;
+  for (int lane = LANE1; lane <= LANE4; lane++) {
+    int end = setting.indexOf(',', start);
+    if ((end < 0) != (lane == LANE4)) return false;
+    String value = setting.substring(start, end < 0 ? setting.length() : end);
+    value.trim();
+    if (value.length() == 0 || value.toInt() <= 0) return false;
+    debounceMicros[lane] = value.toInt();
+    start = end + 1;
+  }
+  memcpy(laneDebounceMicros, debounceMicros, sizeof(laneDebounceMicros));
+  return true;
+}
 
 bool saveConfig(const char* filename) {
   if (!SPIFFS.begin(true)) {
@@ -145,6 +331,7 @@ bool saveConfig(const char* filename) {
   doc["bluetoothAdvertisement"] = bluetoothAdvertisement;
   doc["controllerHostname"] = controllerHostname;
   doc["controllerPort"] = controllerPort;
+  doc["laneDebounce"] = laneDebounceSetting();
 
   String configJson;
   if (serializeJsonPretty(doc, configJson)) {
@@ -172,6 +359,7 @@ bool readConfig(const char* filename) {
                 bluetoothAdvertisement.c_str());
   Serial.printf("  controllerHostname = %s\n", controllerHostname.c_str());
   Serial.printf("  controllerPort = %d\n", controllerPort);
+  Serial.printf("  laneDebounce = %s\n", laneDebounceSetting().c_str());
 
   if (!SPIFFS.begin(true)) {
     Serial.println("readConfig(): SPIFFS.begin() failed.");
@@ -226,76 +414,137 @@ bool readConfig(const char* filename) {
     Serial.print("  controllerPort = ");
     Serial.println(controllerPort);
   }
+  if (doc.containsKey("laneDebounce")) {
+    parseLaneDebounce(doc["laneDebounce"].as<String>());
+    Serial.print("  laneDebounce = ");
+    Serial.println(laneDebounceSetting());
+  }
   config.close();
   SPIFFS.end();
 }
 
-// Process a GETC command received via Bluetooth to update
-bool getConfig(String configStr) {
-  Serial.printf("getConfig(): configStr=%s\n", configStr);
+// True if setting is named in keys, a comma separated list where empty means every setting
+bool settingListed(String keys, const char* setting) {
+  return keys.length() == 0 || ("," + keys + ",").indexOf("," + String(setting) + ",") >= 0;
+}
+
+/*
+ * Send the config, or just the settings named in keys (comma separated) if given, to the
+ * Starting Gate as "CONF <compact JSON>". The Starting Gate discards messages longer than
+ * MAX_MESSAGE_LENGTH, so a config that won't fit is sent one setting per CONF.
+ */
+void sendConfig(String keys) {
   StaticJsonDocument<MAX_CONFIG_SIZE> doc;
 
-  if (configStr.length() > 5) {
-    String config = configStr.substring(5);
-    Serial.printf("getConfig(): getting %s\n", config);
-    if (configStr == "wifiSSID") {
-      doc["wifiSSID"] = wifiSSID;
-    } else if (configStr == "wifiPassword") {
-      doc["wifiPassword"] = wifiPassword;
-    } else if (configStr == "bluetoothAdvertisement") {
-      doc["bluetoothAdvertisement"] = bluetoothAdvertisement;
-    } else if (configStr == "controllerHostname") {
-      doc["controllerHostname"] = controllerHostname;
-    } else if (configStr == "controllerPort") {
-      doc["controllerPort"] = controllerPort;
-    }
-  } else {
+  if (settingListed(keys, "wifiSSID")) {
     doc["wifiSSID"] = wifiSSID;
+  }
+  if (settingListed(keys, "wifiPassword")) {
     doc["wifiPassword"] = wifiPassword;
+  }
+  if (settingListed(keys, "bluetoothAdvertisement")) {
     doc["bluetoothAdvertisement"] = bluetoothAdvertisement;
+  }
+  if (settingListed(keys, "controllerHostname")) {
     doc["controllerHostname"] = controllerHostname;
+  }
+  if (settingListed(keys, "controllerPort")) {
     doc["controllerPort"] = controllerPort;
   }
+  if (settingListed(keys, "laneDebounce")) {
+    doc["laneDebounce"] = laneDebounceSetting();
+  }
 
-  String configJson;
-  if (serializeJsonPretty(doc, configJson)) {
-    Serial.printf("config = %s\n", configJson.c_str());
+  String configMessage("CONF ");
+  serializeJson(doc, configMessage);
+  Serial.printf("sendConfig(): %s\n", configMessage.c_str());
+  if (configMessage.length() <= MAX_MESSAGE_LENGTH) {
+    sendMessage(configMessage.c_str());
+    return;
   }
-  SerialBT.write((const uint8_t*)configJson.c_str(), configJson.length());
 
+  for (JsonPair setting : doc.as<JsonObject>()) {
+    StaticJsonDocument<MAX_CONFIG_SIZE> single;
+    single[setting.key().c_str()] = setting.value();
+    String settingMessage("CONF ");
+    serializeJson(single, settingMessage);
+    sendMessage(settingMessage.c_str());
+  }
 }
 
-// Process a SETC command received via Bluetooth to update
-bool setConfig(String configStr) {
-  Serial.printf("setConfig(): configStr=%s\n", configStr.c_str());
-  String key;
-  String value;
-
-  size_t pos = configStr.indexOf('=');
-  if (pos > 0) {
-    key = configStr.substring(0, pos);
-    value = configStr.substring(pos+1);
-  } else {
-    Serial.println("Invalid config string");
-    return false;
-  }
+// Process a GETC command received via Bluetooth
+void getConfig(String configStr) {
+  Serial.printf("getConfig(): configStr=%s\n", configStr.c_str());
+  sendConfig(configStr);
+}
 
-  Serial.printf("setConfig(): key=%s, value=%s\n", key.c_str(), value.c_str());
+// Update setting key to value. Returns true if it was valid and changed.
+bool updateSetting(String key, String value) {
   if (key == "wifiSSID") {
+    if (wifiSSID == value) return false;
     wifiSSID = value;
   } else if  (key == "wifiPassword") {
+    if (wifiPassword == value) return false;
     wifiPassword = value;
   } else if  (key == "bluetoothAdvertisement") {
+    if (bluetoothAdvertisement == value) return false;
     bluetoothAdvertisement = value;
   } else if (key == "controllerHostname") {
+    if (controllerHostname == value) return false;
     controllerHostname = value;
   } else if (key == "controllerPort") {
+    if (controllerPort == value.toInt()) return false;
     controllerPort = value.toInt();
+  } else if (key == "laneDebounce") {
+    if (laneDebounceSetting() == value) return false;
+    if (!parseLaneDebounce(value)) {
+      Serial.printf("updateSetting(): Invalid laneDebounce %s. Ignoring.\n", value.c_str());
+      return false;
+    }
   } else {
-    Serial.println("setConfig(): Invalud config name. Ignoring.");
+    Serial.printf("updateSetting(): Invalid config name %s. Ignoring.\n", key.c_str());
     return false;
   }
-  return saveConfig(configFilename);
+  return true;
+}
+
+/*
+ * Process a SETC command received via Bluetooth. The argument is either a single
+ * key=value, or a JSON object of any number of settings that the Starting Gate uses to
+ * provision us in as few messages as fit. Either way the config is written to flash at
+ * most once, and only if a setting actually changed. The resulting value of each setting
+ * named is sent back as the ack.
+ */
+bool setConfig(String configStr) {
+  Serial.printf("setConfig(): configStr=%s\n", configStr.c_str());
+  bool changed = false;
+  String keys;
+
+  if (configStr.startsWith("{")) {
+    StaticJsonDocument<MAX_CONFIG_SIZE> doc;
+    DeserializationError error = deserializeJson(doc, configStr);
+    if (error) {
+      Serial.printf("setConfig(): invalid JSON: %s\n", error.c_str());
+      return false;
+    }
+    for (JsonPair setting : doc.as<JsonObject>()) {
+      changed |= updateSetting(setting.key().c_str(), setting.value().as<String>());
+      if (keys.length() > 0) keys += ",";
+      keys += setting.key().c_str();
+    }
+  } else {
+    int pos = configStr.indexOf('=');
+    if (pos <= 0) {
+      Serial.println("Invalid config string");
+      return false;
+    }
+    keys = configStr.substring(0, pos);
+    changed = updateSetting(keys, configStr.substring(pos + 1));
+  }
+
+  bool saved = !changed || saveConfig(configFilename);
+  sendConfig(keys);
+  return saved;
 }
 
 void deleteConfig() {
@@ -309,6 +558,14 @@ void deleteConfig() {
   SPIFFS.end();
 }
 
+/*
+ * Check the coordinator for newer firmware over WiFi, and download it if there is any.
+ * This runs in its own task (see startUpdateCheck()) so that neither setup() nor loop()
+ * ever waits on the network: Bluetooth is up and races can be run while it is going on.
+ * Every network step is bounded, so bad WiFi credentials or an unreachable coordinator
+ * only cost this task WIFI_CONNECT_TIMEOUT_MS or HTTP_TIMEOUT_MS. A new image is only
+ * downloaded between races and, once written, loop() restarts into it between races.
+ */
 void checkForUpdates() {
   Serial.printf("Running Finish Line version %s\n", FW_VERSION);
   Serial.println("Configuring WiFi");
@@ -317,10 +574,14 @@ void checkForUpdates() {
 // Connect to the network
   WiFi.begin(wifiSSID.c_str(), wifiPassword.c_str());
 
-  int i = 0;
+  unsigned long deadline = millis() + WIFI_CONNECT_TIMEOUT_MS;
   while (WiFi.status() != WL_CONNECTED) {  // Wait for the Wi-Fi to connect
-    delay(1000);
-    Serial.printf("Waiting for wifi %d\n", i++);
+    if ((long)(millis() - deadline) >= 0) {
+      Serial.printf("WiFi did not connect within %d ms, skipping update check\n",
+                    WIFI_CONNECT_TIMEOUT_MS);
+      return;
+    }
+    vTaskDelay(pdMS_TO_TICKS(250));
   }
 
   // expand template for URL of current firmware version
@@ -337,6 +598,8 @@ void checkForUpdates() {
 
   WiFiClient client;
   HTTPClient httpClient;
+  httpClient.setConnectTimeout(HTTP_TIMEOUT_MS);
+  httpClient.setTimeout(HTTP_TIMEOUT_MS);
   bool result = httpClient.begin(client, fwVersionURL);
   Serial.printf("httpClient.begin(client, %s) returned %d\n",
                 fwVersionURL, result);
@@ -344,54 +607,341 @@ void checkForUpdates() {
   int httpCode = httpClient.GET();
   Serial.printf("http.GET() returned %d\n", httpCode);
 
-  if ( httpCode == 200 ) {
-    String newFWVersion = httpClient.getString();
-    int newVersion = newFWVersion.toInt();
-    int curVersion = atoi(FW_VERSION);
-
-    Serial.printf("Current firmware version: %d\n", curVersion);
-    Serial.printf("Available firmware version: %d\n", newVersion);
-
-    if ( newVersion <= curVersion ) {
-      Serial.println("Firmware is up to date");
-    } else {
-      char fwImageURL[URLLEN];
-      t_httpUpdate_return ret;
-      
-      snprintf(fwImageURL, URLLEN, fwURLtemplate, controllerHostname.c_str(),
-               controllerPort, newVersion);
-      Serial.printf("Preparing to update to %s\n", fwImageURL);
-
-      ret = httpUpdate.update(client, fwImageURL, FW_VERSION);
-
-      switch (ret) {
-        case HTTP_UPDATE_OK:
-          Serial.printf("HTTP_UPDATE_OK Rebooting to new image.");
-          delay(1000);
-          ESP.restart();
-          break;  // Just because it's good form!
-
-        case HTTP_UPDATE_FAILED:
-          Serial.printf("HTTP_UPDATE_FAILD Error (%d): %s\n",
-                        httpUpdate.getLastError(),
-                        httpUpdate.getLastErrorString().c_str());
-          break;
-
-        case HTTP_UPDATE_NO_UPDATES:
-          Serial.println("HTTP_UPDATE_NO_UPDATES");
-          break;
-      }
-    }
-  } else {
+  if ( httpCode != 200 ) {
     Serial.print("Firmware version check failed, got HTTP response code ");
     Serial.println(httpCode);
+    httpClient.end();
+    return;
   }
+
+  String newFWVersion = httpClient.getString();
   httpClient.end();
+  int newVersion = newFWVersion.toInt();
+  int curVersion = atoi(FW_VERSION);
+
+  Serial.printf("Current firmware version: %d\n", curVersion);
+  Serial.printf("Available firmware version: %d\n", newVersion);
+
+  if ( newVersion <= curVersion ) {
+    Serial.println("Firmware is up to date");
+    return;
+  }
+
+  // Writing flash and sharing the radio with a download would slow the FIN messages.
+  // Update is claimed before checking it is free, so an OTAB on the other core can't begin
+  // it in between, and a race that a BGIN started meanwhile is waited out again.
+  while (true) {
+    while (raceRunning) {
+      vTaskDelay(pdMS_TO_TICKS(500));
+    }
+    if (updateDownloading.exchange(true)) {
+      Serial.println("Firmware update already in progress, skipping download");
+      return;
+    }
+    if (Update.isRunning()) {
+      updateDownloading = false;
+      Serial.println("Firmware is being streamed over Bluetooth, skipping download");
+      return;
+    }
+    if (!raceRunning) {
+      break;
+    }
+    updateDownloading = false;
+  }
+
+  char fwImageURL[URLLEN];
+  t_httpUpdate_return ret;
+
+  snprintf(fwImageURL, URLLEN, fwURLtemplate, controllerHostname.c_str(),
+           controllerPort, newVersion);
+  Serial.printf("Preparing to update to %s\n", fwImageURL);
+
+  client.setTimeout(HTTP_TIMEOUT_MS / 1000);
+  httpUpdate.rebootOnUpdate(false);
+  ret = httpUpdate.update(client, fwImageURL, FW_VERSION);
+  updateDownloading = false;
+
+  switch (ret) {
+    case HTTP_UPDATE_OK:
+      Serial.println("HTTP_UPDATE_OK New image will be booted between races.");
+      updateReady = true;
+      break;
+
+    case HTTP_UPDATE_FAILED:
+      Serial.printf("HTTP_UPDATE_FAILD Error (%d): %s\n",
+                    httpUpdate.getLastError(),
+                    httpUpdate.getLastErrorString().c_str());
+      break;
+
+    case HTTP_UPDATE_NO_UPDATES:
+      Serial.println("HTTP_UPDATE_NO_UPDATES");
+      break;
+  }
 }
 
+void updateCheckTask(void* arg) {
+  checkForUpdates();
+  if (!updateReady) {
+    WiFi.disconnect(true);  // Leave the radio to Bluetooth
+    WiFi.mode(WIFI_OFF);
+  }
+  updateCheckRunning = false;
+  vTaskDelete(NULL);
+}
 
-void processMessage() {
-  String data = SerialBT.readString();
+/*
+ * Run checkForUpdates() in the background, at boot and on UPFW. Does nothing if a
+ * check is already under way.
+ */
+void startUpdateCheck() {
+  if (updateCheckRunning.exchange(true)) {
+    Serial.println("startUpdateCheck(): update check already running");
+    return;
+  }
+  if (xTaskCreatePinnedToCore(updateCheckTask, "updateCheck", UPDATE_TASK_STACK_SIZE,
+                              NULL, 1, NULL, 0) != pdPASS) {
+    Serial.println("startUpdateCheck(): could not create task");
+    updateCheckRunning = false;
+  }
+}
+
+/*
+ * Report to the Starting Gate how much of the firmware image has been written (OTAK),
+ * or that the chunk it sent was rejected and it should resend from there (OTAN).
+ */
+void sendOtaOffset(const char* reply) {
+  char otaMessage[OTA_MESSAGE_LENGTH];
+  snprintf(otaMessage, sizeof(otaMessage), "%s %u", reply, (unsigned)otaOffset);
+  sendMessage(otaMessage);
+}
+
+void sendOtaError(const char* reason) {
+  String error = String("OTAE ") + reason;
+  sendMessage(error.c_str());
+  Serial.printf("OTA update failed: %s\n", reason);
+}
+
+/*
+ * Process "OTAB <size> <md5> [version]": start writing a firmware image streamed over
+ * the link to the spare OTA partition. Unlike checkForUpdates() this needs no WiFi.
+ * The image arrives as OTAD chunks, each of which is acknowledged with the offset
+ * written so far, and is installed by OTAF once its MD5 is verified. If the link drops
+ * mid-update the Starting Gate sends OTAB again and, the image being the same, resumes
+ * from where it left off.
+ */
+void otaBegin(String argument) {
+  // Hold the claim on Update while it is checked and begun, so that checkForUpdates() on
+  // the other core can't begin it too. Once begun, Update.isRunning() keeps the download out.
+  if (raceRunning || updateDownloading.exchange(true)) {
+    sendOtaError("busy");
+    return;
+  }
+  beginOtaImage(argument);
+  updateDownloading = false;
+}
+
+// The body of otaBegin(), run with Update claimed
+void beginOtaImage(String argument) {
+  int first = argument.indexOf(' ');
+  int second = argument.indexOf(' ', first + 1);
+  size_t size = argument.substring(0, first).toInt();
+  String md5 = second < 0 ? argument.substring(first + 1)
+                          : argument.substring(first + 1, second);
+
+  if (Update.isRunning()) {
+    if (size == otaSize && md5 == otaMD5) {
+      Serial.printf("otaBegin(): resuming at %u\n", (unsigned)otaOffset);
+      otaNakSent = false;
+      sendOtaOffset("OTAK");
+      return;
+    }
+    Update.abort();
+  }
+
+  if (first < 0 || size == 0 || !Update.begin(size) || !Update.setMD5(md5.c_str())) {
+    Update.abort();
+    sendOtaError(Update.hasError() ? Update.errorString() : "invalid OTAB");
+    return;
+  }
+
+  Serial.printf("otaBegin(): receiving %u byte image, version %s\n", (unsigned)size,
+                second < 0 ? "unknown" : argument.substring(second + 1).c_str());
+  otaSize = size;
+  otaMD5 = md5;
+  otaOffset = 0;
+  otaNakSent = false;
+  sendOtaOffset("OTAK");
+}
+
+/*
+ * Process "OTAD <offset> <crc32> <base64 chunk>". The Starting Gate keeps several chunks
+ * in flight, so after rejecting one the chunks behind it are dropped without further
+ * OTANs until it rewinds, and chunks it resends that were already written are only
+ * acknowledged. Nothing is logged per chunk: Serial would hold up the link.
+ */
+void otaData(const char* argument) {
+  if (!Update.isRunning()) {
+    sendOtaError("not started");
+    return;
+  }
+
+  char* field;
+  size_t offset = strtoul(argument, &field, 10);
+  uint32_t crc = strtoul(field, &field, 16);
+  while (*field == ' ') {
+    field++;
+  }
+
+  if (offset < otaOffset) {
+    sendOtaOffset("OTAK");
+    return;
+  }
+  if (offset > otaOffset) {
+    if (!otaNakSent) {
+      otaNakSent = true;
+      sendOtaOffset("OTAN");
+    }
+    return;
+  }
+
+  uint8_t chunk[OTA_CHUNK_SIZE];
+  size_t chunkLength = 0;
+  otaNakSent = false;
+  if (mbedtls_base64_decode(chunk, sizeof(chunk), &chunkLength,
+                            (const unsigned char*)field, strlen(field)) != 0 ||
+      chunkLength == 0 || crc32_le(0, chunk, chunkLength) != crc ||
+      otaOffset + chunkLength > otaSize) {
+    otaNakSent = true;
+    sendOtaOffset("OTAN");
+    return;
+  }
+
+  if (Update.write(chunk, chunkLength) != chunkLength) {
+    sendOtaError(Update.errorString());
+    Update.abort();
+    return;
+  }
+  otaOffset += chunkLength;
+  sendOtaOffset("OTAK");
+}
+
+/*
+ * Process OTAF: verify the image against its MD5 and, if it matches, make it the boot
+ * partition and restart into it.
+ */
+void otaFinish() {
+  if (!Update.isRunning()) {
+    sendOtaError("not started");
+    return;
+  }
+  if (otaOffset != otaSize) {
+    sendOtaError("incomplete");
+    return;
+  }
+  if (!Update.end()) {
+    sendOtaError(Update.errorString());
+    return;
+  }
+
+  sendMessage("OTAC");
+  Serial.println("OTA update complete. Rebooting to new image.");
+  SerialBT.flush();
+  delay(1000);
+  ESP.restart();
+}
+
+// Process OTAA: discard the partially received image
+void otaAbort() {
+  if (Update.isRunning()) {
+    Update.abort();
+  }
+}
+
+/*
+ * Reply to a TIME request with the micros() at which the request was received and
+ * the reply sent, echoing the request's sequence number. The Starting Gate uses these
+ * NTP style exchanges to estimate the offset and drift between our clocks so it can
+ * convert the timestamps in FIN messages into its own clock.
+ */
+void sendTime(String sequence, unsigned long receivedMicros) {
+  char timeMessage[TIME_MESSAGE_LENGTH];
+  snprintf(timeMessage, sizeof(timeMessage), "TIME %s %lu %lu",
+           sequence.c_str(), receivedMicros, micros());
+  sendMessage(timeMessage);
+}
+
+/*
+ * Answer HELO with our firmware version and capabilities. The Starting Gate's own
+ * capabilities, the HELO argument, aren't needed since we only reply to its requests.
+ */
+void sendHello() {
+  char helloMessage[HELLO_MESSAGE_LENGTH];
+  snprintf(helloMessage, sizeof(helloMessage), "HELLO %s %x", FW_VERSION, FW_CAPABILITIES);
+  sendMessage(helloMessage);
+}
+
+/*
+ * Echo a PING back to the Starting Gate, which measures round trip times
+ * between races to judge the health of the link.
+ */
+void sendPong(String sequence) {
+  String pong = "PONG " + sequence;
+  sendMessage(pong.c_str());
+}
+
+/*
+ * Start reporting finishes for the race the Starting Gate armed with raceId and
+ * acknowledge it. FIN messages carry the id so that crossings reported for an
+ * earlier race can't be mistaken for this one. Re-arming the race already running,
+ * as the Starting Gate does after reconnecting mid-race, only repeats the ack.
+ */
+void armRace(String id) {
+  id = id.substring(0, 5);  // Race ids are 16 bit
+  if (!raceRunning || id != raceId) {
+    raceId = id;
+    eventCount = 0;
+    flushLaneQueues();
+    raceRunning = true;
+  }
+  String armed = "ARMED " + raceId;
+  sendMessage(armed.c_str());
+}
+
+void sendFinish(unsigned int sequence) {
+  const FinishEvent& event = eventLog[(sequence - 1) % EVENT_LOG_SIZE];
+  char finishMessage[FINISH_MESSAGE_LENGTH];
+  snprintf(finishMessage, sizeof(finishMessage), "FIN%d %lu %s %u",
+           event.lane + 1, event.detectedMicros, raceId.c_str(), sequence);
+  sendMessage(finishMessage);
+}
+
+/*
+ * Process "RPLY <race id> <sequence>" by resending every finish of the race after
+ * sequence that is still in the event log.
+ */
+void replayFinishes(String argument) {
+  int space = argument.indexOf(' ');
+  if (space < 0 || argument.substring(0, space) != raceId) {
+    Serial.println("replayFinishes(): not the current race");
+    return;
+  }
+
+  unsigned int after = argument.substring(space + 1).toInt();
+  unsigned int oldest = eventCount > EVENT_LOG_SIZE ? eventCount - EVENT_LOG_SIZE + 1 : 1;
+  for (unsigned int sequence = max(after + 1, oldest); sequence <= eventCount; sequence++) {
+    sendFinish(sequence);
+  }
+}
+
+void processMessage(const char* message, unsigned long receivedMicros) {
+  // Firmware chunks arrive back to back; handle them before anything is logged or copied
+  if (strncmp(message, "OTAD ", 5) == 0) {
+    otaData(message + 5);
+    return;
+  }
+
+  String data(message);
+  data.trim();
   Serial.println("Received '" + data + "' from Starting Line");
   if (data.length() < 3) {
     Serial.println("Command too short");
@@ -406,19 +956,19 @@ void processMessage() {
 
   switch (toCommand(command)) {
     case HELLO:
-      SerialBT.write((const uint8_t*)"HELLO", 5);
+      sendHello();
       break;
     case RESTART:
       ESP.restart();
       break;
     case UPDATE_FW:
-      checkForUpdates();
+      startUpdateCheck();
       break;
     case VERSION:
-      SerialBT.write((const uint8_t*)FW_VERSION, strlen(FW_VERSION));
+      sendMessage(FW_VERSION);
       break;
     case BEGIN_RACE:
-      raceRunning = true;
+      armRace(argument);
       break;
     case END_RACE:
       raceRunning = false;
@@ -432,21 +982,69 @@ void processMessage() {
     case DELETE_CONFIG:
       deleteConfig();
       break;
+    case GET_TIME:
+      sendTime(argument, receivedMicros);
+      break;
+    case KEEPALIVE:
+      sendPong(argument);
+      break;
+    case REPLAY:
+      replayFinishes(argument);
+      break;
+    case OTA_BEGIN:
+      otaBegin(argument);
+      break;
+    case OTA_DATA:
+      otaData(argument.c_str());
+      break;
+    case OTA_FINISH:
+      otaFinish();
+      break;
+    case OTA_ABORT:
+      otaAbort();
+      break;
     case UNKNOWN:
       Serial.println(F("Received unknown command."));
       break;
   }
 }
 
-void sendResult(Lanes lane) {
-  Serial.printf("LANE%0d finished.\n", lane + 1);
-  SerialBT.write(finishMessages[lane], finishMessageLength);
-  lastFinish[lane] = millis();
+/*
+ * Report a lane crossing along with the micros() at which it was detected, so
+ * Bluetooth latency doesn't become part of the lane time. The crossing is logged
+ * first so it can be replayed if the link is down.
+ */
+void sendResult(Lanes lane, unsigned long detectedMicros) {
+  eventCount++;
+  eventLog[(eventCount - 1) % EVENT_LOG_SIZE] = {lane, detectedMicros};
+  sendFinish(eventCount);
+  lastFinish[lane] = detectedMicros;
+  Serial.printf("LANE%0d finished at %lu.\n", lane + 1, detectedMicros);
+}
+
+// Returns true if an edge at detectedMicros is far enough from the lane's last finish to count
+bool debounce(Lanes lane, unsigned long detectedMicros) {
+  return (detectedMicros - lastFinish[lane]) > laneDebounceMicros[lane];
 }
 
-bool debounce(Lanes lane) {
-  unsigned long now = millis();
-  return (now - lastFinish[lane]) > DEBOUNCE_MILLIS;
+/*
+ * Send a FIN for every crossing the ISRs have queued since the last call. Stamps
+ * queued once the race has ended are dropped.
+ */
+void drainLaneQueues() {
+  for (int lane = LANE1; lane <= LANE4; lane++) {
+    unsigned long detectedMicros;
+    while (popLaneStamp((Lanes)lane, detectedMicros)) {
+      if (raceRunning && debounce((Lanes)lane, detectedMicros)) {
+        sendResult((Lanes)lane, detectedMicros);
+      }
+    }
+
+    uint32_t overflows = laneQueues[lane].overflows.exchange(0, std::memory_order_relaxed);
+    if (overflows > 0) {
+      Serial.printf("LANE%0d dropped %u edges, queue full.\n", lane + 1, overflows);
+    }
+  }
 }
 
 void setup() {
@@ -456,35 +1054,56 @@ void setup() {
    */
   Serial.begin(115200);
   readConfig(configFilename);
-  checkForUpdates();
-  pinMode(LANE1_PIN, INPUT_PULLUP);
-  pinMode(LANE2_PIN, INPUT_PULLUP);
-  pinMode(LANE3_PIN, INPUT_PULLUP);
-  pinMode(LANE4_PIN, INPUT_PULLUP);
+  for (int lane = LANE1; lane <= LANE4; lane++) {
+    pinMode(LANE_PINS[lane], INPUT_PULLUP);
+    attachInterruptArg(digitalPinToInterrupt(LANE_PINS[lane]), laneISR, (void*)(intptr_t)lane, FALLING);
+  }
 
   Serial.printf("setup(): Initializing SerialBT with advertisement '%s'\n",
                 bluetoothAdvertisement.c_str());
   SerialBT.begin(bluetoothAdvertisement, false);
+  startUpdateCheck();
 }
 
-void loop() {
-  if (SerialBT.available()) {
-    processMessage();
-  }
-  if (raceRunning) {
-    if ((digitalRead(LANE1_PIN) == 0) && debounce(LANE1)) {
-      sendResult(LANE1);
-    }
-    if ((digitalRead(LANE2_PIN) == 0) && debounce(LANE2)) {
-      sendResult(LANE2);
-    }
-    if ((digitalRead(LANE3_PIN) == 0) && debounce(LANE3)) {
-      sendResult(LANE3);
+/*
+ * Consume whatever bytes SerialBT has buffered without waiting for more. Once a
+ * terminator completes a message it is processed and we return, so at most one
+ * command is handled between drains of the lane queues.
+ */
+void receiveMessages() {
+  while (SerialBT.available()) {
+    int c = SerialBT.read();
+    if (c < 0) {
+      return;
     }
-    if ((digitalRead(LANE4_PIN) == 0) && debounce(LANE4)) {
-      sendResult(LANE4);
+
+    if (c == MESSAGE_TERMINATOR) {
+      unsigned long receivedMicros = micros();
+      bool complete = !discardingMessage;
+      messageBuffer[messageLength] = '\0';
+      messageLength = 0;
+      discardingMessage = false;
+      if (complete) {
+        processMessage(messageBuffer, receivedMicros);
+        return;
+      }
+      Serial.println(F("Discarded message longer than MAX_MESSAGE_LENGTH"));
+    } else if (messageLength < MAX_MESSAGE_LENGTH) {
+      messageBuffer[messageLength++] = (char)c;
+    } else {
+      discardingMessage = true;
     }
   }
 }
 
+void loop() {
+  receiveMessages();
+  drainLaneQueues();
+  if (updateReady && !raceRunning) {
+    Serial.println("Rebooting to new image.");
+    delay(100);
+    ESP.restart();
+  }
+}
+
 // vim: set expandtab ts=2
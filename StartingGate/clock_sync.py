@@ -0,0 +1,205 @@
+"""
+Diecast Remote Raceway - clock_sync
+
+Relates the Finish Line's clock to the Starting Gate's.
+
+The Finish Line stamps every lane crossing with the ESP32's micros() counter at the
+moment the crossing is detected. Those stamps are only meaningful to the Starting Gate
+once they are converted into its own time.monotonic_ns() timebase. FinishLineClock
+estimates the mapping between the two clocks from NTP style TIME request/reply exchanges:
+
+    sent_ns       Starting Gate monotonic_ns() when the TIME request was sent
+    receive_us    Finish Line micros() when the request was received
+    transmit_us   Finish Line micros() when the reply was sent
+    received_ns   Starting Gate monotonic_ns() when the reply was received
+
+The midpoint of receive_us and transmit_us happened somewhere between sent_ns and
+received_ns, less the time the Finish Line spent processing the request. Taking the
+midpoints of both intervals, the pairing is wrong by at most half the network delay:
+
+    delay = (received_ns - sent_ns) - (transmit_us - receive_us)
+
+Bluetooth delay varies from a few to tens of milliseconds, so the exchange is repeated
+during the HELO handshake and periodically while idle. The sample with the smallest delay
+gives the offset between the clocks. The two crystals also run at slightly different rates
+(tens of parts per million), so once samples span at least MIN_DRIFT_SPAN_NS the drift
+is estimated from the best sample in the older and newer halves of the sample window.
+
+Every conversion comes with a bound on its error: the reference sample's half delay plus
+the worst case drift error accumulated between the reference sample and the converted stamp.
+
+micros() is an unsigned 32 bit counter that wraps roughly every 71.6 minutes. Samples are
+unwrapped onto a continuous count as they arrive, and stamps are unwrapped relative to the
+most recent sample, so wrap around is handled as long as stamps are within half a wrap
+(about 35 minutes) of the last exchange.
+
+Author: Tom Quiggle
+tquiggle@gmail.com
+https://github.com/tquiggle/Die-Cast-Remote-Raceway
+
+Copyright (c) Thomas Quiggle. All rights reserved.
+
+Licensed under the MIT license. See LICENSE file in the project root for full license information.
+"""
+
+import collections
+
+MICROS_WRAP = 1 << 32
+NANOSECONDS_PER_MICROSECOND = 1000
+
+MAX_SAMPLES = 32                        # Samples retained for estimating offset and drift
+MIN_DRIFT_SPAN_NS = 10 * 1000000000     # Samples must span this long before estimating drift
+MAX_DRIFT = 500e-6                      # Assumed worst case drift until it can be measured
+SYNC_INTERVAL_NS = 5 * 1000000000       # How often to exchange TIME messages while idle
+HANDSHAKE_SAMPLES = 5                   # TIME exchanges made during the HELO handshake
+
+Sample = collections.namedtuple('Sample', ['local_ns', 'remote_us', 'error_ns'])
+
+
+def micros_delta(later_us, earlier_us):
+    """
+    Signed difference, in microseconds, between two 32 bit micros() readings allowing
+    for the counter wrapping between them.
+    """
+    delta = (later_us - earlier_us) % MICROS_WRAP
+    if delta >= MICROS_WRAP // 2:
+        delta -= MICROS_WRAP
+    return delta
+
+
+class FinishLineClock:
+    """
+    Maps Finish Line micros() stamps onto the Starting Gate's monotonic_ns() clock.
+    """
+
+    def __init__(self):
+        self.samples = collections.deque(maxlen=MAX_SAMPLES)
+        self.drift = 0.0                # Finish Line rate error; local_ns per remote_ns - 1
+        self.drift_error = MAX_DRIFT    # Bound on the error of drift
+        self.__reference = None         # Sample with the smallest error
+        self.__last_raw_us = None       # Most recent micros() reading, as received
+        self.__last_remote_us = None    # Most recent micros() reading, unwrapped
+
+    def synchronized(self):
+        """
+        Returns True once at least one TIME exchange has completed.
+        """
+        return self.__reference is not None
+
+    def reset(self):
+        """
+        Forget the mapping. Call whenever the connection to the Finish Line is replaced,
+        since a different (or rebooted) Finish Line has an unrelated clock.
+        """
+        self.samples.clear()
+        self.drift = 0.0
+        self.drift_error = MAX_DRIFT
+        self.__reference = None
+        self.__last_raw_us = None
+        self.__last_remote_us = None
+
+    def sync_due(self, now_ns):
+        """
+        Returns True if it is time for another TIME exchange.
+        """
+        return not self.samples or now_ns - self.samples[-1].local_ns >= SYNC_INTERVAL_NS
+
+    def add_sample(self, sent_ns, receive_us, transmit_us, received_ns):
+        """
+        Record the result of a TIME request/reply exchange and update the estimate.
+        """
+        processing_ns = micros_delta(transmit_us, receive_us) * NANOSECONDS_PER_MICROSECOND
+        delay_ns = max(received_ns - sent_ns - processing_ns, 0)
+        midpoint_us = receive_us + micros_delta(transmit_us, receive_us) // 2
+
+        self.samples.append(Sample(local_ns=(sent_ns + received_ns) // 2,
+                                   remote_us=self.__unwrap(midpoint_us % MICROS_WRAP),
+                                   error_ns=delay_ns // 2))
+        self.__estimate()
+
+    def to_local_ns(self, remote_us):
+        """
+        Convert a Finish Line micros() stamp to Starting Gate monotonic_ns()
+        """
+        reference = self.__reference_sample()
+        elapsed_ns = (self.__extend(remote_us) - reference.remote_us) * NANOSECONDS_PER_MICROSECOND
+        return reference.local_ns + round(elapsed_ns * (1.0 + self.drift))
+
+    def error_ns(self, remote_us):
+        """
+        Bound on the error of to_local_ns(remote_us)
+        """
+        reference = self.__reference_sample()
+        elapsed_ns = (self.__extend(remote_us) - reference.remote_us) * NANOSECONDS_PER_MICROSECOND
+        return reference.error_ns + round(abs(elapsed_ns) * self.drift_error)
+
+    # PRIVATE:
+
+    def __reference_sample(self):
+        if not self.synchronized():
+            raise ValueError("Finish Line clock is not synchronized")
+        return self.__reference
+
+    def __extend(self, raw_us):
+        """ Unwrap a micros() reading relative to the most recent sample """
+        return self.__last_remote_us + micros_delta(raw_us, self.__last_raw_us)
+
+    def __unwrap(self, raw_us):
+        if self.__last_raw_us is None:
+            self.__last_remote_us = raw_us
+        else:
+            self.__last_remote_us = self.__extend(raw_us)
+        self.__last_raw_us = raw_us
+        return self.__last_remote_us
+
+    def __estimate(self):
+        """
+        Once the samples span enough time, estimate drift from the best sample in each
+        half of the window. Then pick as the reference the sample that gives the smallest
+        error bound for stamps taken now.
+        """
+        samples = list(self.samples)
+        self.drift = 0.0
+        self.drift_error = MAX_DRIFT
+
+        half = len(samples) // 2
+        if half > 0:
+            older = min(samples[:half], key=lambda sample: sample.error_ns)
+            newer = min(samples[half:], key=lambda sample: sample.error_ns)
+
+            span_ns = newer.local_ns - older.local_ns
+            remote_span_ns = (newer.remote_us - older.remote_us) * NANOSECONDS_PER_MICROSECOND
+            if span_ns >= MIN_DRIFT_SPAN_NS and remote_span_ns > 0:
+                drift = float(span_ns) / remote_span_ns - 1.0
+                drift_error = float(older.error_ns + newer.error_ns) / remote_span_ns
+                # Ignore implausible estimates, or ones no better than assuming the worst
+                if abs(drift) <= MAX_DRIFT and drift_error < MAX_DRIFT:
+                    self.drift = drift
+                    self.drift_error = drift_error
+
+        now_ns = samples[-1].local_ns
+        self.__reference = min(samples, key=lambda sample:
+                               sample.error_ns + (now_ns - sample.local_ns) * self.drift_error)
+
+
+def main():
+    """
+    At some point I should write legitimate unit tests.  But for now, I just exercise
+    some basic functionality if the module is invoked as the Python main.
+    """
+    clock = FinishLineClock()
+
+    # Finish Line runs 20 ppm fast, and its micros() is about to wrap
+    for sample in range(12):
+        local_ns = sample * 2000000000
+        remote_us = (MICROS_WRAP - 5000000 + round(local_ns * 1.00002) // 1000) % MICROS_WRAP
+        clock.add_sample(local_ns - 500000, remote_us, remote_us + 100, local_ns + 600000)
+
+    print("drift=%.1f ppm +/- %.1f ppm" % (clock.drift * 1e6, clock.drift_error * 1e6))
+    remote_us = (MICROS_WRAP - 5000000 + round(24000000000 * 1.00002) // 1000) % MICROS_WRAP
+    print(clock.to_local_ns(remote_us), "+/-", clock.error_ns(remote_us))   # ~24000000000
+
+if __name__ == '__main__':
+    main()
+
+# vim: expandtab sw=4
@@ -37,7 +37,9 @@ Licensed under the MIT license. See LICENSE file in the project root for full li
 """
 
 import json
+import os
 import sys
+import threading
 
 # Sentinel value indicating that a car did not complete the race within the timeout period.
 # If the finish time for a lane is NOT_FINISHED, display the failure icon for that lane.
@@ -55,10 +57,17 @@ CIRCUIT = "circuit"                     # Name of the circuit we are racing in,
 COORDINATOR_HOSTNAME = "coord_host"     # Hostname of the race coordinator server
 COORDINATOR_PORT = "coord_port"         # Port the race coordinator server is running on
 FINISH_LINE_NAME = "finish_line_name"   # Bluetooth advertisement of our finish line
+FINISH_LINE_ADDRESSES = "finish_line_addresses" # Bluetooth address last found for each advertisement
+FINISH_LINE_TRANSPORT = "finish_line_transport" # How to reach the Finish Line, see transport.py
+FINISH_LINE_FIRMWARE = "finish_line_firmware"   # Firmware version and capabilities at each address
+FINISH_LINE_DEBOUNCE = "finish_line_debounce"   # Finish Line debounce of each lane, in microseconds
+LANE_DEBOUNCE = "lane_debounce"         # Starting Gate debounce of each lane, in seconds
 NUM_LANES = "num_lanes"                 # Number of lanes in the local track (1..4)
 RACE_TIMEOUT = "race_timeout"           # Timeout, in seconds, to declare a race over
 SERVO_DOWN_VALUE = "servo_down_value"   # Numeric value for Servo for gate in down position
+SERVO_LATENCY = "servo_latency"         # Gate release to car leaving, see servo_calibration.py
 SERVO_UP_VALUE = "servo_up_value"       # Numeric value for Servo for gate in up position
+TRACE_DIR = "trace_dir"                 # Directory sensor traces are dumped to
 TRACK_NAME = "track_name"               # Name of the local track
 WIFI_PSWD = "wifi_pswd"                 # WiFi Password
 WIFI_SSID = "wifi_ssid"                 # WiFi SSID
@@ -76,10 +85,17 @@ PERSISTED_CONFIGS = [CAR_ICONS,
                      COORDINATOR_HOSTNAME,
                      COORDINATOR_PORT,
                      FINISH_LINE_NAME,
+                     FINISH_LINE_ADDRESSES,
+                     FINISH_LINE_TRANSPORT,
+                     FINISH_LINE_FIRMWARE,
+                     FINISH_LINE_DEBOUNCE,
+                     LANE_DEBOUNCE,
                      NUM_LANES,
                      RACE_TIMEOUT,
                      SERVO_DOWN_VALUE,
+                     SERVO_LATENCY,
                      SERVO_UP_VALUE,
+                     TRACE_DIR,
                      TRACK_NAME,
                      WIFI_PSWD,
                      WIFI_SSID]
@@ -116,6 +132,10 @@ class Config:
     # Disallow creating unknown attributes by inadvertant assignment
     __slots__ = PERSISTED_CONFIGS + EPHEMERAL_CONFIGS + __PRIVATE_ATTRIBUTES
 
+    # The menus save from the main thread and the FinishLine thread saves what it learns
+    # about the Finish Line, so saves are serialized
+    __SAVE_LOCK = threading.Lock()
+
     #
     # Default config values, overridden by /home/pi/config/starting_gate.json
     #
@@ -125,6 +145,11 @@ class Config:
     DEFAULT[COORDINATOR_HOSTNAME] = "<COORDINATOR_HOSTNAME>"
     DEFAULT[COORDINATOR_PORT] = 1968
     DEFAULT[FINISH_LINE_NAME] = "FinishLine"
+    DEFAULT[FINISH_LINE_ADDRESSES] = {}
+    DEFAULT[FINISH_LINE_TRANSPORT] = "rfcomm"
+    DEFAULT[FINISH_LINE_FIRMWARE] = {}
+    DEFAULT[FINISH_LINE_DEBOUNCE] = [100000, 100000, 100000, 100000]
+    DEFAULT[LANE_DEBOUNCE] = [0.200, 0.200, 0.200, 0.200]
     DEFAULT[IP_ADDRESS] = "127.0.0.1"
     DEFAULT[ALLOW_MULTI_TRACK] = False
     DEFAULT[MULTI_TRACK] = False
@@ -134,7 +159,9 @@ class Config:
     DEFAULT[REMOTE_NUM_LANES] = 2
     DEFAULT[REMOTE_TRACK_NAME] = "UNKNOWN"
     DEFAULT[SERVO_DOWN_VALUE] = 1.0
+    DEFAULT[SERVO_LATENCY] = {}
     DEFAULT[SERVO_UP_VALUE] = 0.0
+    DEFAULT[TRACE_DIR] = "traces"
     DEFAULT[TRACK_NAME] = "Track-1"
     DEFAULT[WIFI_PSWD] = "<WIFI_PASSWORD>"
     DEFAULT[WIFI_SSID] = "<WIFI_SSID>"
@@ -177,9 +204,17 @@ class Config:
     def save(self):
         """
         Write all non-default, persisted, config values out to the config file.
+        A config created without a file is only kept in memory. Safe to call from any
+        thread.
         """
         print("Config.save(", self.__filename, ")")
+        if self.__filename is None:
+            return
+
+        with Config.__SAVE_LOCK:
+            self.__save()
 
+    def __save(self):
         local_config = {}
 
         for config in PERSISTED_CONFIGS:
@@ -207,9 +242,11 @@ class Config:
             print("saving local_config")
             config_string = json.dumps(local_config, sort_keys=True, indent=4,
                                        separators=(',', ': '))
-            with open(self.__filename, 'w') as filehandle:
+            # Replace the file whole, so it is never seen half written
+            temp_filename = self.__filename + ".tmp"
+            with open(temp_filename, 'w') as filehandle:
                 filehandle.write(config_string)
-                filehandle.close()
+            os.replace(temp_filename, self.__filename)
 
 
 def main():
@@ -0,0 +1,235 @@
+"""
+Diecast Remote Raceway - debounce_fit
+
+Fits each lane's sensor debounce from recorded sensor traces (see sensor_trace).
+
+A hand picked debounce is wrong one way or the other: too short and a short car on a fast
+track, or a sensor flickering as a car is placed, counts twice; too long and the sensor
+is blind for longer than it needs to be. The traces show which it is. The gaps between
+consecutive edges on a lane sensor fall into two clusters: bounces, from well under a
+millisecond to a few tens of milliseconds, and real changes (a car placed, released or
+crossing), hundreds of milliseconds or more apart. The widest gap between the two
+clusters, on a log scale, tells the bounces from the real changes.
+
+Two debounces are fitted for each lane, because the devices debounce differently:
+
+    lane_debounce           The Starting Gate (deviceio) waits for a sensor to be steady
+                            this long. It must outlast the longest gap within a bounce,
+                            so it is SAFETY_FACTOR times that gap.
+
+    finish_line_debounce    The Finish Line ignores edges this long after a finish. It must
+                            outlast a whole burst of edges (a car's passage, bounces and
+                            all), so it is SAFETY_FACTOR times the longest burst.
+
+Neither is held below the real changes, so the fit reports, for every lane, the bounces
+rejected and the real changes lost: real gaps no longer than the debounce, and bursts
+starting within the lockout of the one before. A lane losing any is flagged and left
+unchanged; its sensor is too noisy for the safety factor, or its cars too close together.
+
+The traces are read with numpy and processed as whole arrays, so thousands of races fit in
+seconds. numpy is only needed here, on whatever machine the traces are copied to:
+
+    pip3 install numpy
+    python3 debounce_fit.py traces/ --output debounce.json --config config/starting_gate.json
+
+The Finish Line records no traces, so finish_line_debounce is a heuristic: it is fitted
+from the bursts on the Starting Gate's sensors as cars are placed and released, taking the
+same cars on the same kind of sensor to bounce alike as they cross the finish. Check it
+against doubled or missed finishes. --config writes both into the Starting Gate's config;
+finish_line_config then sends finish_line_debounce to the Finish Line the next time it
+connects.
+
+Author: Tom Quiggle
+tquiggle@gmail.com
+https://github.com/tquiggle/Die-Cast-Remote-Raceway
+
+Copyright (c) Thomas Quiggle. All rights reserved.
+
+Licensed under the MIT license. See LICENSE file in the project root for full license information.
+"""
+
+import argparse
+import collections
+import glob
+import json
+import os
+
+import numpy
+
+from config import Config
+from sensor_trace import HEADER, TRACE_DTYPE, TRACE_MAGIC, TRACE_VERSION, RECORD
+
+GATE_GPIOS = [7, 23, 22, 4]         # deviceio's LANE1..LANE4
+
+TICK_WRAP = 1 << 32
+MAX_BOUNCE_US = 300000      # A gap this long is a real change, however noisy the sensor
+MIN_SEPARATION = 2.0        # Bounces and real gaps must differ at least this much to split
+SAFETY_FACTOR = 4.0         # Debounce this many times the longest bounce or burst
+
+LaneFit = collections.namedtuple('LaneFit', [
+    'gpio', 'edges', 'debounce_us', 'lockout_us', 'longest_bounce_us', 'shortest_real_us',
+    'longest_burst_us', 'shortest_start_us', 'bounces', 'crossings', 'lost'])
+
+
+def trace_files(paths):
+    """
+    The trace files named in paths, with directories searched for *.trace
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(path, "**", "*.trace"), recursive=True)))
+        else:
+            files.append(path)
+    return files
+
+
+def load_edges(files):
+    """
+    Read the edges of every trace in files. Returns (edges, trace) arrays, where edges has
+    TRACE_DTYPE and trace is the index in files of the trace each edge came from.
+    """
+    edges = []
+    for filename in files:
+        with open(filename, "rb") as trace_file:
+            magic, version, record_size, count, _, _, _ = HEADER.unpack(
+                trace_file.read(HEADER.size))
+        if magic != TRACE_MAGIC or version != TRACE_VERSION or record_size != RECORD.size:
+            print("Skipping ", filename, ": not a version ", TRACE_VERSION, " sensor trace")
+            edges.append(numpy.empty(0, dtype=TRACE_DTYPE))
+            continue
+        edges.append(numpy.fromfile(filename, dtype=TRACE_DTYPE, count=count, offset=HEADER.size))
+
+    if not edges:
+        return numpy.empty(0, dtype=TRACE_DTYPE), numpy.empty(0, dtype=numpy.int64)
+    trace = numpy.repeat(numpy.arange(len(edges)), [len(chunk) for chunk in edges])
+    return numpy.concatenate(edges), trace
+
+
+def edge_gaps(edges, trace):
+    """
+    Group the edges by trace and pin, keeping their order within each group. Returns
+    (gpio, gap) arrays in that order, where gap is the microseconds since the previous edge
+    in the group, or infinity for the first.
+    """
+    # pigpio watchdog records (level 2) aren't edges
+    keep = edges["level"] <= 1
+    edges, trace = edges[keep], trace[keep]
+
+    order = numpy.lexsort((numpy.arange(len(edges)), edges["gpio"], trace))
+    ticks = edges["tick"][order].astype(numpy.int64)
+    gpio = edges["gpio"][order]
+    trace = trace[order]
+
+    gap = numpy.full(len(ticks), numpy.inf)
+    if len(ticks) > 1:
+        same = (gpio[1:] == gpio[:-1]) & (trace[1:] == trace[:-1])
+        # Ticks wrap every 2**32 us; the modulus undoes a wrap between consecutive edges
+        gap[1:] = numpy.where(same, (ticks[1:] - ticks[:-1]) % TICK_WRAP, numpy.inf)
+    return gpio, gap
+
+
+def fit_lane(gpio, gap):
+    """
+    Fit the debounce of one lane from gap, its edge gaps as returned by edge_gaps(). Returns
+    a LaneFit, or None if the bounces can't be told from the real gaps.
+    """
+    measured = numpy.sort(gap[numpy.isfinite(gap) & (gap > 0)])
+    if len(measured) < 2 or measured[0] > MAX_BOUNCE_US:
+        return None
+
+    # The widest gap on a log scale, between a bounce and a longer gap
+    logs = numpy.log(measured)
+    candidates = numpy.flatnonzero(measured[:-1] <= MAX_BOUNCE_US)
+    widest = candidates[numpy.argmax(logs[candidates + 1] - logs[candidates])]
+    longest_bounce, shortest_real = measured[widest], measured[widest + 1]
+    if shortest_real < longest_bounce * MIN_SEPARATION:
+        return None
+    debounce = longest_bounce * SAFETY_FACTOR
+
+    # Bursts of edges separated by less than the debounce, and how long each lasted
+    starts = numpy.flatnonzero(gap > debounce)
+    within = numpy.where(gap > debounce, 0, gap)
+    elapsed = numpy.cumsum(within)
+    ends = numpy.append(starts[1:] - 1, len(gap) - 1)
+    bursts = elapsed[ends] - elapsed[starts]
+    longest_burst = max(bursts.max(), longest_bounce)
+
+    # Time from the start of each burst to the start of the next in the same trace
+    following = starts[1:][numpy.isfinite(gap[starts[1:]])]
+    start_gaps = gap[following] + bursts[numpy.searchsorted(starts, following) - 1]
+    shortest_start = start_gaps.min() if len(start_gaps) else numpy.inf
+    lockout = longest_burst * SAFETY_FACTOR
+
+    # Real changes the debounce would merge into a bounce, and crossings the lockout hides
+    lost = int(numpy.count_nonzero(measured[widest + 1:] <= debounce) +
+               numpy.count_nonzero(start_gaps <= lockout))
+    return LaneFit(int(gpio), len(gap), int(debounce), int(lockout), float(longest_bounce),
+                   float(shortest_real), float(longest_burst), float(shortest_start),
+                   int(numpy.count_nonzero(gap <= debounce)), len(starts), lost)
+
+
+def fit(files, gpios):
+    """
+    Fit every lane in gpios from the traces in files. Returns a list with a LaneFit, or
+    None, for each.
+    """
+    gpio, gap = edge_gaps(*load_edges(files))
+    return [fit_lane(pin, gap[gpio == pin]) for pin in gpios]
+
+
+def report(title, fits):
+    """ Print the fit of each lane """
+    print(title)
+    print("  lane gpio  edges  bounce<=  real>=    debounce  burst<=   start>=    lockout"
+          "  rejected  lost")
+    for lane, lane_fit in enumerate(fits):
+        if lane_fit is None:
+            print("  %4d  no clean split between bounces and real changes, unchanged" % (lane + 1))
+            continue
+        print("  %4d %4d %6d %7.1fms %7.1fms %8.1fms %7.1fms %8.1fms %8.1fms %9d %5d%s" % (
+            lane + 1, lane_fit.gpio, lane_fit.edges, lane_fit.longest_bounce_us / 1000,
+            lane_fit.shortest_real_us / 1000, lane_fit.debounce_us / 1000,
+            lane_fit.longest_burst_us / 1000, lane_fit.shortest_start_us / 1000,
+            lane_fit.lockout_us / 1000, lane_fit.bounces, lane_fit.lost,
+            "  loses real changes, unchanged" if lane_fit.lost else ""))
+
+
+def main():
+    """
+    Fit the lane debounces from the traces named on the command line
+    """
+    parser = argparse.ArgumentParser(description="Fit the lane sensor debounce from traces")
+    parser.add_argument("traces", nargs="+", help="Trace files, or directories of them")
+    parser.add_argument("--output", help="Write the fitted model to this JSON file")
+    parser.add_argument("--config", help="Update the debounce in this Starting Gate config")
+    args = parser.parse_args()
+
+    files = trace_files(args.traces)
+    gate = fit(files, GATE_GPIOS)
+    report("Starting Gate, %d traces:" % len(files), gate)
+
+    config = Config(args.config) if args.config else Config(None)
+    usable = [lane_fit if lane_fit and not lane_fit.lost else None for lane_fit in gate]
+    lane_debounce = [lane_fit.debounce_us / 1e6 if lane_fit else current
+                     for lane_fit, current in zip(usable, config.lane_debounce)]
+    finish_line_debounce = [lane_fit.lockout_us if lane_fit else current
+                            for lane_fit, current in zip(usable, config.finish_line_debounce)]
+    print("lane_debounce = ", lane_debounce)
+    print("finish_line_debounce = ", finish_line_debounce)
+
+    if args.output:
+        model = {"lane_debounce": lane_debounce,
+                 "finish_line_debounce": finish_line_debounce,
+                 "lanes": [lane_fit._asdict() if lane_fit else None for lane_fit in gate]}
+        with open(args.output, "w") as model_file:
+            json.dump(model, model_file, indent=4)
+    if args.config:
+        config.lane_debounce = lane_debounce
+        config.finish_line_debounce = finish_line_debounce
+        config.save()
+
+if __name__ == '__main__':
+    main()
+
+# vim: expandtab sw=4
@@ -4,6 +4,56 @@ Diecast Remote Raceway - DeviceIO
 DeviceIO is the interface to the physical input/output devices attached to
 the GPIO, excluding the LCD display which is managed separately.
 
+Lane readiness is edge triggered: the when_activated/when_deactivated callbacks of
+LANE1..LANE4 maintain a bitmask of the lanes with a car at the gate (bit 0 is lane 1).
+Reading the mask costs nothing, and waiting for the lanes to fill or empty blocks on a
+condition variable that is notified by the edge itself, so readiness is seen as soon as
+the last car is placed without polling the sensors.
+
+Where the sensors themselves must be read, read_lane_mask() reads all of them at once:
+with pigpio a single read_bank_1() returns the level of every pin in the same instant, so
+the lanes are one consistent snapshot rather than one reading per gpiozero device.
+lanes_ready_in() and lanes_empty_in() test either kind of mask.
+
+The lane sensors are debounced here rather than by gpiozero: with pigpio, gpiozero's
+bounce_time is a pigpio glitch filter, which hides the bounces from every callback on the
+pin (the start stamps included) and reports each edge bounce_time late. Instead every raw
+edge restarts a timer for the lane's debounce, and the lane's bit in the mask follows the
+sensor once it has been steady that long. The debounce of each lane is fitted from
+recorded traces by debounce_fit.py and set with set_lane_debounce().
+
+Each lane's race starts when its car clears the gate sensor, not when the servo is told
+to release the gate: the servo takes tens of milliseconds to open, and Python may be
+scheduled out in between. pigpio reports every edge with the microsecond tick at which
+the pigpio daemon saw it, so mark_release() pairs the tick with time.monotonic_ns() as
+the gate is released, and the tick of the first rising edge (car gone) on each lane after
+that is converted to the lane's start time. A glitch while the car is still on the sensor,
+from servo vibration say, is a rising edge too, so the edge only becomes the start once the
+lane has stayed clear for its debounce; a falling edge before then discards it.
+
+The gate can also be released at an exact time.monotonic_ns() deadline rather than
+whenever Python gets to it: schedule_release() hands the servo to a dedicated thread that
+sleeps until just before the deadline, at real time priority where it is allowed to, and
+busy waits the rest of the way (see ScheduledRelease). The countdown is drawn from the same
+deadline, so the display and the gate agree however late a frame is.
+
+The GPIO backend is chosen by the DRR_GPIO_BACKEND environment variable, which must be
+set before deviceio is first imported since every device is created at import:
+
+    pigpio              the Raspberry Pi's pins via the pigpio daemon (default)
+    mock                gpiozero's MockFactory; nothing drives the inputs but the caller
+    sim:<timeline>      MockFactory with the inputs driven by a gpio_simulator timeline
+
+With either mock backend the Starting Gate imports and runs on any Linux box, without a
+Pi or pigpiod. Edges are then stamped with a microsecond tick taken from
+time.monotonic_ns() when gpiozero reports them.
+
+Every edge pigpio reports on every input is recorded in an always-on ring buffer (see
+sensor_trace) that dump_trace() writes out for offline analysis. The lane sensors' edges
+are raw; the keys and joystick are glitch filtered by pigpio, so only their filtered
+edges are seen. With pigpio the edges come straight from pigpio callbacks; with the
+simulator, from the edges it drives.
+
 Author: Tom Quiggle
 tquiggle@gmail.com
 https://github.com/tquiggle/Die-Cast-Remote-Raceway
@@ -13,11 +63,42 @@ Copyright (c) Thomas Quiggle. All rights reserved.
 Licensed under the MIT license. See LICENSE file in the project root for full license information.
 """
 
+import os
+import sys
+import threading
+import time
+import warnings
+
 from gpiozero import Device, DigitalInputDevice, Button, Servo
-from gpiozero.pins.pigpio import PiGPIOFactory
 
-# Use PiGPIOFactory for hardware PWM support to prevent servo jitter
-Device.pin_factory = PiGPIOFactory()
+from sensor_trace import SensorTrace
+
+GPIO_BACKEND_ENV = "DRR_GPIO_BACKEND"
+PIGPIO = "pigpio"
+MOCK = "mock"
+SIMULATOR = "sim"
+
+
+def create_pin_factory(backend):
+    """
+    Create the gpiozero pin factory for backend, one of PIGPIO, MOCK or SIMULATOR.
+    Raises ValueError if backend isn't one of them.
+    """
+    # pylint: disable=import-outside-toplevel
+    if backend == PIGPIO:
+        # Use PiGPIOFactory for hardware PWM support to prevent servo jitter
+        from gpiozero.pins.pigpio import PiGPIOFactory
+        return PiGPIOFactory()
+    if backend in (MOCK, SIMULATOR):
+        from gpiozero.exc import PWMSoftwareFallback
+        from gpiozero.pins.mock import MockFactory, MockPWMPin
+        warnings.simplefilter("ignore", PWMSoftwareFallback)   # There's no servo to jitter
+        return MockFactory(pin_class=MockPWMPin)
+    raise ValueError("Unknown %s: %s" % (GPIO_BACKEND_ENV, backend))
+
+
+BACKEND, _, TIMELINE = os.environ.get(GPIO_BACKEND_ENV, PIGPIO).partition(":")
+Device.pin_factory = create_pin_factory(BACKEND)
 
 #
 # Pin assignments were made to simplify the wiring layout of the Prototyping pHAT,
@@ -38,16 +119,139 @@ KEY_1 = Button("GPIO21", True, None, 0.100)  # Pin 40
 KEY_2 = Button("GPIO20", True, None, 0.100)  # Pin 38
 KEY_3 = Button("GPIO16", True, None, 0.100)  # Pin 36
 
-LANE1 = DigitalInputDevice("GPIO7", True, None, 0.200)  # Pin 26
-LANE2 = DigitalInputDevice("GPIO23", True, None, 0.200)  # Pin 16
-LANE3 = DigitalInputDevice("GPIO22", True, None, 0.200)  # Pin 15
-LANE4 = DigitalInputDevice("GPIO4", True, None, 0.200)  # Pin 07
+LANE1 = DigitalInputDevice("GPIO7", True, None, None)  # Pin 26
+LANE2 = DigitalInputDevice("GPIO23", True, None, None)  # Pin 16
+LANE3 = DigitalInputDevice("GPIO22", True, None, None)  # Pin 15
+LANE4 = DigitalInputDevice("GPIO4", True, None, None)  # Pin 07
 
 SERVO = Servo("GPIO12")  # Pin 32
 
 
 # pylint: enable=bad-whitespace
 
+LANES = [LANE1, LANE2, LANE3, LANE4]
+
+# Every input, by name, for the simulator
+INPUTS = {"JOYU": JOYU, "JOYD": JOYD, "JOYL": JOYL, "JOYR": JOYR, "JOYP": JOYP,
+          "KEY_1": KEY_1, "KEY_2": KEY_2, "KEY_3": KEY_3,
+          "LANE1": LANE1, "LANE2": LANE2, "LANE3": LANE3, "LANE4": LANE4}
+
+DEFAULT_LANE_DEBOUNCE = 0.200  # Seconds a lane sensor must be steady, until set_lane_debounce()
+
+RELEASE_CONFIRM_NS = 50000000  # A scheduled release asks confirm() this long before its deadline
+RELEASE_PRIORITY = 50           # SCHED_FIFO priority of the ScheduledRelease thread
+
+TICK_WRAP = 1 << 32         # pigpio ticks are a 32 bit microsecond count, wrapping every ~72 minutes
+
+
+def software_tick():
+    """
+    A tick, in the form pigpio reports them, from time.monotonic_ns(). Stands in for the
+    pigpio daemon's tick with the mock backends.
+    """
+    return (time.monotonic_ns() // 1000) % TICK_WRAP
+
+
+def lane_bits(num_lanes):
+    """
+    Bitmask with a bit set for each of the first num_lanes lanes
+    """
+    return (1 << num_lanes) - 1
+
+
+class ScheduledRelease:
+    """
+    Calls release() at time.monotonic_ns() deadline_ns from a thread of its own, unless
+    confirm(), asked RELEASE_CONFIRM_NS before the deadline, returns False or cancel() is
+    called first. release() returns the monotonic_ns at which it took effect.
+
+    time.sleep() can overshoot by a scheduler tick, and a thread woken from it may wait up
+    to sys.getswitchinterval() for the GIL, so the thread wakes that much (plus a
+    millisecond) early and spins to the deadline holding the GIL.
+    """
+
+    # PUBLIC:
+
+    def __init__(self, deadline_ns, release, confirm=None):
+        self.deadline_ns = deadline_ns
+        self.release_ns = None          # When release() took effect, once it has
+        self.late_ns = None             # How far past the deadline that was
+        self.__release = release
+        self.__confirm = confirm
+        self.__cancelled = False
+        self.__lock = threading.Lock()
+        self.__cancel_event = threading.Event()
+        self.__done = threading.Event()
+        self.__spin_ns = int((sys.getswitchinterval() + 0.001) * 1e9)
+
+        thread = threading.Thread(target=self.__run, name="ScheduledRelease", daemon=True)
+        thread.start()
+
+    def cancel(self):
+        """
+        Cancel the release. Returns False if it is too late, the release having happened.
+        """
+        with self.__lock:
+            if self.release_ns is not None:
+                return False
+            self.__cancelled = True
+        self.__cancel_event.set()
+        return True
+
+    def wait(self, timeout=None):
+        """
+        Block until the deadline has been dealt with. Returns release_ns, None if the
+        release was cancelled or not confirmed.
+        """
+        self.__done.wait(timeout)
+        return self.release_ns
+
+    # PRIVATE:
+
+    def __run(self):
+        try:
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(RELEASE_PRIORITY))
+        except (AttributeError, OSError) as exc:
+            print("ScheduledRelease: running at normal priority: ", exc)
+
+        try:
+            if self.__sleep_until(self.deadline_ns - RELEASE_CONFIRM_NS) and self.__confirm \
+                    and not self.__confirm():
+                print("ScheduledRelease: release at ", self.deadline_ns, " not confirmed")
+                self.cancel()
+            if self.__sleep_until(self.deadline_ns - self.__spin_ns):
+                while time.monotonic_ns() < self.deadline_ns:
+                    pass
+                with self.__lock:
+                    if not self.__cancelled:
+                        self.release_ns = self.__release()
+                        self.late_ns = self.release_ns - self.deadline_ns
+        finally:
+            self.__done.set()
+
+    def __sleep_until(self, when_ns):
+        """ Sleep until when_ns. Returns False if cancelled first. """
+        delay = (when_ns - time.monotonic_ns()) / 1e9
+        if delay > 0:
+            return not self.__cancel_event.wait(delay)
+        return not self.__cancel_event.is_set()
+
+
+def lanes_ready_in(mask, num_lanes):
+    """
+    Returns True if mask has a car on all of the first num_lanes lanes
+    """
+    bits = lane_bits(num_lanes)
+    return mask & bits == bits
+
+
+def lanes_empty_in(mask, num_lanes):
+    """
+    Returns True if mask has no car on any of the first num_lanes lanes
+    """
+    return mask & lane_bits(num_lanes) == 0
+
+
 def car_1_present():
     """
     Returns True if the LANE1 sensor detects a car in the lane 1 starting gate
@@ -134,6 +338,96 @@ class DeviceIO:
         print("DeviceIO.pop_key_handlers, self=", self, " instance=", DeviceIO.instance)
         DeviceIO.instance.pop_key_handlers()
 
+    def lane_mask(self):
+        """
+        Bitmask of the lanes with a car at the gate, bit 0 for lane 1
+        """
+        return DeviceIO.instance.lane_mask
+
+    def read_lane_mask(self):
+        """
+        Read every lane sensor in one GPIO bank read and return the lanes with a car,
+        undebounced, as a bitmask like lane_mask()
+        """
+        return DeviceIO.instance.read_lane_mask()
+
+    def lanes_ready(self, num_lanes):
+        """
+        Returns True if all of the first num_lanes lanes have a car at the gate
+        """
+        return lanes_ready_in(self.lane_mask(), num_lanes)
+
+    def lanes_empty(self, num_lanes):
+        """
+        Returns True if none of the first num_lanes lanes have a car at the gate
+        """
+        return lanes_empty_in(self.lane_mask(), num_lanes)
+
+    def wait_lanes_ready(self, num_lanes, timeout=None):
+        """
+        Block until all of the first num_lanes lanes have a car at the gate, timeout
+        seconds elapse, or wake_lane_waiters() is called. Returns lanes_ready().
+        """
+        return DeviceIO.instance.wait_lanes(lambda mask: lanes_ready_in(mask, num_lanes),
+                                            timeout)
+
+    def wait_lanes_occupied(self, num_lanes, timeout=None):
+        """
+        Block until a car is placed on any of the first num_lanes lanes, timeout seconds
+        elapse, or wake_lane_waiters() is called. Returns not lanes_empty().
+        """
+        return DeviceIO.instance.wait_lanes(lambda mask: not lanes_empty_in(mask, num_lanes),
+                                            timeout)
+
+    def wake_lane_waiters(self):
+        """
+        Wake every thread waiting on the lanes, e.g. because the race was aborted
+        """
+        DeviceIO.instance.wake_lane_waiters()
+
+    def set_lane_debounce(self, debounce):
+        """
+        Set how many seconds each lane's sensor must be steady before a car is taken to
+        have arrived or left, from a list with an entry per lane (Config.lane_debounce)
+        """
+        DeviceIO.instance.set_lane_debounce(debounce)
+
+    def lane_debounce(self):
+        """
+        Returns the list of each lane's debounce, in seconds
+        """
+        return list(DeviceIO.instance.lane_debounce)
+
+    def dump_trace(self, filename):
+        """
+        Write the recent edges of every input to filename (see sensor_trace)
+        """
+        return DeviceIO.instance.trace.dump(filename)
+
+    def mark_release(self):
+        """
+        Record that the starting gate is being released, forgetting the start times of
+        the previous race. Returns the time.monotonic_ns() of the release.
+        """
+        return DeviceIO.instance.mark_release()
+
+    def schedule_release(self, deadline_ns, servo_value, confirm=None):
+        """
+        Set SERVO to servo_value and mark_release() at time.monotonic_ns() deadline_ns,
+        if confirm() allows just before. Returns the ScheduledRelease.
+        """
+        def release():
+            SERVO.value = servo_value
+            return self.mark_release()
+        return ScheduledRelease(deadline_ns, release, confirm)
+
+    def lane_start_ns(self, lane):
+        """
+        Returns a (monotonic_ns, error_ns) tuple for when the car in lane (zero indexed)
+        cleared its gate sensor after the last mark_release(), or None if it hasn't.
+        """
+        return DeviceIO.instance.lane_start_ns(lane)
+
     # PRIVATE:
 
     instance = None
@@ -161,6 +455,76 @@ class DeviceIO:
             self.key_3_stack.pop()
             self.joystick_stack.pop()
 
+        def read_lane_mask(self):
+            """
+            Read the bank holding every lane's pin, and pick out the lanes that are active
+            """
+            active = self.__read_bank() ^ self.__lane_pull_ups
+            mask = 0
+            for lane, pin_bit in enumerate(self.__lane_pin_bits):
+                if active & pin_bit:
+                    mask |= 1 << lane
+            return mask
+
+        def wait_lanes(self, predicate, timeout):
+            """
+            Wait until predicate(lane_mask) holds, timeout seconds elapse or the waiters
+            are woken. Returns predicate(lane_mask).
+            """
+            with self.lane_condition:
+                wakeups = self.__wakeups
+                self.lane_condition.wait_for(
+                    lambda: predicate(self.lane_mask) or self.__wakeups != wakeups, timeout)
+                return predicate(self.lane_mask)
+
+        def wake_lane_waiters(self):
+            """
+            Make every wait_lanes() in progress return
+            """
+            with self.lane_condition:
+                self.__wakeups += 1
+                self.lane_condition.notify_all()
+
+        def set_lane_debounce(self, debounce):
+            """
+            Replace the lane debounce times. Timers already running keep their old time.
+            """
+            if len(debounce) < len(LANES) or min(debounce) < 0:
+                raise ValueError("Need a debounce of at least 0 for each lane: %s" % debounce)
+            self.lane_debounce = [float(seconds) for seconds in debounce[:len(LANES)]]
+            print("DeviceIO: lane debounce ", self.lane_debounce)
+
+        def mark_release(self):
+            """
+            Sample the pigpio tick alongside time.monotonic_ns() and start recording
+            lane start ticks. The tick is read over the pigpio socket, so it is
+            bracketed by two monotonic_ns() readings and taken as their midpoint.
+            """
+            before = time.monotonic_ns()
+            tick = self.__current_tick()
+            after = time.monotonic_ns()
+            with self.__start_lock:
+                self.__release = (tick, (before + after) // 2, (after - before) // 2)
+                self.__start_ticks = [None] * len(LANES)
+                self.__clear_ticks = [None] * len(LANES)
+            if self.simulator is not None:
+                self.simulator.released()
+            return self.__release[1]
+
+        def lane_start_ns(self, lane):
+            """
+            Convert lane's start tick to a (monotonic_ns, error_ns) tuple. The start is
+            only known once the lane has been clear for its debounce.
+            """
+            with self.__start_lock:
+                start_tick = self.__start_ticks[lane]
+                release = self.__release
+            if start_tick is None or release is None:
+                return None
+            release_tick, release_ns, error_ns = release
+            elapsed_us = (start_tick - release_tick) % TICK_WRAP
+            return release_ns + elapsed_us * 1000, error_ns
+
         def __init__(self):
             print("DeviceIOSingleton.__init__: self=", self)
 
@@ -183,6 +547,61 @@ class DeviceIO:
             JOYR.when_pressed = self.__joystick_dispatcher
             JOYP.when_pressed = self.__joystick_dispatcher
 
+            self.__start_lock = threading.Lock()
+            self.__release = None       # (tick, monotonic_ns, error_ns) at the last release
+            self.__start_ticks = [None] * len(LANES)
+            self.__clear_ticks = [None] * len(LANES)   # Start of each lane's clear run
+
+            # Each lane's pin in a GPIO bank read, and which of them are pulled up (so
+            # active, a car present, when low). The mock pins are gathered into a bank.
+            self.__lane_pin_bits = [1 << sensor.pin.number for sensor in LANES]
+            self.__lane_pull_ups = sum(pin_bit for pin_bit, sensor in
+                                       zip(self.__lane_pin_bits, LANES) if sensor.pull_up)
+            if BACKEND == PIGPIO:
+                self.__read_bank = Device.pin_factory.connection.read_bank_1
+            else:
+                self.__read_bank = lambda: sum(int(bool(sensor.pin.state)) << sensor.pin.number
+                                               for sensor in LANES)
+
+            # Track the lane sensors by their edges. The callbacks are registered before
+            # the sensors are read so no edge can be missed in between.
+            self.lane_mask = 0
+            self.lane_condition = threading.Condition()
+            self.__wakeups = 0
+            self.lane_debounce = [DEFAULT_LANE_DEBOUNCE] * len(LANES)
+            self.__settle_timers = [None] * len(LANES)
+            for lane, sensor in enumerate(LANES):
+                sensor.when_activated = self.__lane_dispatcher(lane, True)
+                sensor.when_deactivated = self.__lane_dispatcher(lane, False)
+            with self.lane_condition:
+                self.lane_mask = self.read_lane_mask()
+
+            # The sensors are active low, so a car leaving the gate is a rising edge and one
+            # still on it a falling edge. pigpio callbacks are given the tick of the edge,
+            # unlike gpiozero's. With the mock backends the lane dispatcher stamps the edge.
+            if BACKEND == PIGPIO:
+                import pigpio # pylint: disable=import-outside-toplevel
+                pi = Device.pin_factory.connection
+                self.__current_tick = pi.get_current_tick
+                self.__start_callbacks = [
+                    pi.callback(sensor.pin.number, pigpio.EITHER_EDGE,
+                                self.__start_dispatcher(lane))
+                    for lane, sensor in enumerate(LANES)]
+            else:
+                self.__current_tick = software_tick
+
+            self.trace = SensorTrace(self.__current_tick)
+            if BACKEND == PIGPIO:
+                self.__trace_callbacks = [
+                    pi.callback(device.pin.number, pigpio.EITHER_EDGE, self.trace.record)
+                    for device in INPUTS.values()]
+
+            self.simulator = None
+            if BACKEND == SIMULATOR:
+                from gpio_simulator import GpioSimulator, load_timeline # pylint: disable=import-outside-toplevel
+                self.simulator = GpioSimulator(INPUTS, load_timeline(TIMELINE), self.trace)
+                self.simulator.start()
+
         def __key_1_dispatcher(self):
             print("__KEY_1_dispatcher, calling ", self.key_1_stack[-1])
             self.key_1_stack[-1]()
@@ -198,6 +617,59 @@ class DeviceIO:
         def __joystick_dispatcher(self, btn):
             self.joystick_stack[-1](btn)
 
+        def __start_dispatcher(self, lane):
+            def dispatch(_gpio, level, tick):
+                with self.__start_lock:
+                    # Only the first clear run after the release counts; the car may bounce
+                    # on its way out. Edges ticked before the release are from placing cars.
+                    if self.__release is None or self.__start_ticks[lane] is not None:
+                        return
+                    if (tick - self.__release[0]) % TICK_WRAP >= TICK_WRAP // 2:
+                        return
+                    if level == 0:
+                        self.__clear_ticks[lane] = None
+                    elif self.__clear_ticks[lane] is None:
+                        self.__clear_ticks[lane] = tick
+                    if self.lane_debounce[lane] <= 0:
+                        self.__start_ticks[lane] = self.__clear_ticks[lane]
+            return dispatch
+
+        def __lane_dispatcher(self, lane, present):
+            start_dispatch = self.__start_dispatcher(lane)
+
+            def dispatch():
+                if BACKEND != PIGPIO:
+                    start_dispatch(None, int(not present), software_tick())
+                # Each edge restarts the lane's timer, so the sensor is only read once it
+                # has gone a whole debounce without changing
+                with self.lane_condition:
+                    if self.__settle_timers[lane] is not None:
+                        self.__settle_timers[lane].cancel()
+                        self.__settle_timers[lane] = None
+                    debounce = self.lane_debounce[lane]
+                    if debounce > 0:
+                        timer = threading.Timer(debounce, self.__lane_settled, args=(lane,))
+                        timer.daemon = True
+                        self.__settle_timers[lane] = timer
+                        timer.start()
+                if debounce <= 0:
+                    self.__lane_settled(lane)
+            return dispatch
+
+        def __lane_settled(self, lane):
+            # Read the sensor rather than trusting the last edge, which a timer that was
+            # already running when it was cancelled may have raced
+            with self.lane_condition:
+                if self.read_lane_mask() & 1 << lane:
+                    self.lane_mask |= 1 << lane
+                else:
+                    self.lane_mask &= ~(1 << lane)
+                    # Clear for a whole debounce, so the edge that cleared it was the start
+                    with self.__start_lock:
+                        if self.__start_ticks[lane] is None:
+                            self.__start_ticks[lane] = self.__clear_ticks[lane]
+                self.lane_condition.notify_all()
+
     def __init__(self):
         if not DeviceIO.instance:
             DeviceIO.instance = DeviceIO.__DeviceIOSingleton()
@@ -24,6 +24,7 @@ Licensed under the MIT license. See LICENSE file in the project root for full li
 """
 
 import enum
+import math
 import random
 import threading
 import time
@@ -32,7 +33,7 @@ import pyray as pr
 from pyray import WHITE, RAYWHITE, GRAY, BLACK, ORANGE
 
 from config import CAR1, CAR2, CAR3, CAR4, Config, NOT_FINISHED #pylint: disable=unused-import
-from deviceio import car_1_present, car_2_present
+from deviceio import DeviceIO
 from menu import Menu
 
 @enum.unique
@@ -126,17 +127,18 @@ class Display(threading.Thread):
         """
         self.state = RaceState.WAIT_REMOTE_READY
 
-    def countdown(self):
+    def countdown(self, deadline_ns):
         """
         All conditions to start the race have been met:
            * single track race: all tracks have cars present
            * multi track race:  local track has all cars and the
              controller has signalled that remote tracks are ready
 
-        Display a 3, 2, 1 countdown sequence before returning to the caller.
+        Display a 3, 2, 1 countdown sequence ending at time.monotonic_ns() deadline_ns,
+        when the gate is released, before returning to the caller.
         """
         self.countdown_event.clear()
-        self.countdown_start = time.monotonic()
+        self.countdown_deadline = deadline_ns
         self.state = RaceState.COUNTDOWN
         self.countdown_event.wait()
 
@@ -291,7 +293,7 @@ class Display(threading.Thread):
         self.place_textures = []
         self.fail_texture = None
 
-        self.countdown_start = None
+        self.countdown_deadline = None
         self.font = None
         self.menu = None
         self.results = None
@@ -518,8 +520,9 @@ class Display(threading.Thread):
         self.registration_event.set()
 
     def __wait_local_ready(self):
-        texture1 = self.local_textures[0] if car_1_present() else self.question_texture
-        texture2 = self.local_textures[1] if car_2_present() else self.question_texture
+        lane_mask = DeviceIO().lane_mask()
+        texture1 = self.local_textures[0] if lane_mask & 1 else self.question_texture
+        texture2 = self.local_textures[1] if lane_mask & 2 else self.question_texture
         if self.config.multi_track:
             self.__draw_cars(texture1, texture2, self.question_texture, self.question_texture)
         else:
@@ -535,15 +538,11 @@ class Display(threading.Thread):
     def __countdown(self):
         self.__draw_cars(self.local_textures[CAR1], self.local_textures[CAR2],
                          self.local_textures[CAR1], self.local_textures[CAR2])
-        now = time.monotonic()
-        if now - self.countdown_start > 3.0:
+        remaining = self.countdown_deadline - time.monotonic_ns()
+        if remaining <= 0:
             self.countdown_event.set()
-        elif now - self.countdown_start > 2.0:
-            self.__text_message("Starting in 1")
-        elif now - self.countdown_start > 1.0:
-            self.__text_message("Starting in 2")
         else:
-            self.__text_message("Starting in 3")
+            self.__text_message("Starting in %d" % math.ceil(remaining / 1e9))
 
     def __race_started(self):
         delta = time.monotonic() - self.start
@@ -619,7 +618,7 @@ def run_sample_race():
         time.sleep(2.0)
 
     print("main: calling countdown")
-    display.countdown()
+    display.countdown(time.monotonic_ns() + 3 * 1000000000)
     print("main: calling race started")
     display.race_started()
     time.sleep(2.0)
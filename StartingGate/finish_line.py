@@ -0,0 +1,613 @@
+"""
+Diecast Remote Raceway - finish_line
+
+Manages the connection from the Starting Gate to the Finish Line.
+
+The FinishLine class is a thread, started as soon as the Starting Gate launches, that
+owns the connection. It connects (and reconnects after any error, with capped exponential
+backoff), performs the HELO handshake, keeps the Finish Line clock synchronized and pings
+the Finish Line to monitor the link's health (see link_health) while no race is running,
+and queues finish messages for the race engine. Clients never block on connection
+setup; they can check connected(), wait_connected(), or register a listener to be told
+of every ConnectionState change.
+
+Each race is armed with a BGIN carrying a new race id, which the Finish Line acknowledges
+with ARMED and repeats in every FIN message it sends for that race. FIN messages carrying
+any other id (crossings from an earlier race still in flight) are discarded, so stale
+results can't leak into a race and no timed purge of the connection is needed.
+
+FIN messages also carry a sequence number, and the Finish Line keeps the last few of the
+race's finishes. If the connection drops mid-race the race carries on: once reconnected,
+the race is re-armed and the Finish Line asked (RPLY) to resend every finish after the
+last one received in sequence. Duplicates of finishes already received are discarded.
+Finishes arriving before the clock has been resynchronized with the new connection are
+held back until it has, so their timestamps can be converted.
+
+The HELO handshake exchanges capability flags (see protocol) and the Finish Line's reply
+includes its firmware version. Only features both sides support are used, so older
+firmware keeps working. What each Finish Line supports is saved in the config, keyed by
+its address. The connection is only reported CONNECTED once the capabilities are known:
+on the first connection to a Finish Line that means after its HELLO arrives, but on later
+connections the cached capabilities are used straight away, saving the round trip. If the
+firmware has changed in the meantime, the reply corrects the cache.
+
+Firmware without CAP_FRAMING doesn't terminate its messages, but sends each in a single
+write. Until the capabilities are known, a partial message left waiting UNFRAMED_IDLE_NS
+for its terminator is taken to be such a firmware's HELLO; once they are known to lack
+CAP_FRAMING, whatever each read returns is a message.
+
+The connection is made by a Transport (see transport), Bluetooth RFCOMM unless the
+config says otherwise. Whatever the transport, a lost connection is reported to clients
+as a FinishLineError.
+
+Author: Tom Quiggle
+tquiggle@gmail.com
+https://github.com/tquiggle/Die-Cast-Remote-Raceway
+
+Copyright (c) Thomas Quiggle. All rights reserved.
+
+Licensed under the MIT license. See LICENSE file in the project root for full license information.
+"""
+
+import enum
+import fcntl
+import itertools
+import queue
+import random
+import re
+import select
+import threading
+import time
+
+from clock_sync import FinishLineClock, HANDSHAKE_SAMPLES
+from config import Config
+from link_health import LinkHealth, PING_INTERVAL_NS, PING_TIMEOUT_NS
+from protocol import MessageFramer, encode_message, parse_finished, parse_hello_reply, \
+    parse_time_reply, HELLO, HELLO_REPLY, BEGIN_RACE, END_RACE, ARMED, FINISHED, REPLAY, TIME, \
+    TIME_REPLY, PING, PONG, CAPABILITIES, CAP_FRAMING, CAP_TIME_SYNC, CAP_PING, CAP_ARM_ACK, \
+    CAP_REPLAY
+from transport import create_transport
+
+MIN_RECONNECT_DELAY = 0.5       # Seconds to wait before the first reconnect attempt
+MAX_RECONNECT_DELAY = 30.0      # Cap on the exponential reconnect backoff
+POLL_INTERVAL_MS = 100          # Longest the connection thread waits for data
+TIME_REQUEST_TIMEOUT_NS = 500 * 1000000 # Give up on a TIME reply after this long
+HELLO_TIMEOUT_NS = 5000 * 1000000       # Reconnect if HELO isn't answered in this long
+UNFRAMED_IDLE_NS = 50 * 1000000         # Unterminated data this old is an unframed message
+HEALTH_LOG_INTERVAL = 60        # Log link health every this many pings
+ARM_TIMEOUT = 2.0               # Seconds to wait for the Finish Line to acknowledge BGIN
+LINK_LOCK = "/tmp/drr-finish-line-%s.lock"  # Held by the process that owns each link
+
+READ_ONLY = select.POLLIN | select.POLLPRI | select.POLLHUP | select.POLLERR
+
+
+class FinishLineError(ConnectionError):
+    """
+    Raised to clients when the connection to the Finish Line is lost or can't be trusted
+    with a race. The FinishLine thread is already reconnecting when it is raised.
+    """
+
+
+class ConnectionState(enum.Enum):
+    """
+    States of the connection to the Finish Line published to listeners
+    """
+    DISCONNECTED = 0
+    CONNECTING = 1
+    CONNECTED = 2
+
+
+class FinishLine(threading.Thread):
+    """
+    Background thread that owns the connection to the Finish Line.
+
+    Race engines call arm_race()/wait_armed() (or begin_race() to do both) and end_race()
+    to bracket a race, and receive() to collect the race's FIN messages. Any FinishLineError
+    raised to a client means the connection was lost; the thread is already reconnecting.
+    """
+
+    # PUBLIC:
+
+    def __init__(self, config, transport=None):
+        super().__init__(name="FinishLine", daemon=True)
+        self.config = config
+        self.transport = transport if transport is not None else create_transport(config)
+        self.clock = FinishLineClock()
+        self.health = LinkHealth()
+        self.state = ConnectionState.DISCONNECTED
+        self.firmware_version = None    # Version the Finish Line reported, if known
+        self.capabilities = None        # Features both sides support, None until known
+
+        self.__connection = None
+        self.__poller = select.poll()
+        self.__framer = MessageFramer()
+        self.__messages = queue.Queue()
+        self.__listeners = []
+        self.__handlers = {}
+        self.__condition = threading.Condition()
+        self.__send_lock = threading.Lock()
+        self.__clock_lock = threading.Lock()
+        self.__racing = False
+
+        self.__race_ids = itertools.count(random.randrange(1 << 16))
+        self.race_id = None             # Id of the race most recently armed
+        self.__armed_race = None        # Id of the race the Finish Line acknowledged
+        self.__arm_sent = 0             # monotonic_ns() when BGIN was sent
+        self.arm_latency_ns = None      # BGIN to ARMED round trip of the last race
+        self.__finishes = set()         # (sequence, timestamp_us) of the race's finishes received
+        self.__unsynchronized = []      # Finishes held until the clock is synchronized
+
+        self.__time_sequence = itertools.count()
+        self.__time_request = None      # (sequence, sent_ns) of the outstanding TIME request
+        self.__handshake_samples = 0    # TIME exchanges still to make for the handshake
+        self.__ping_sequence = itertools.count()
+        self.__ping_request = None      # (sequence, sent_ns) of the outstanding PING
+        self.__hello_sent = 0           # monotonic_ns() when HELO was sent
+        self.__last_received = 0        # monotonic_ns() when data last arrived
+        self.__last_ping = 0            # monotonic_ns() of the last PING sent
+        self.__link_lock = None         # Open LINK_LOCK file, held until the process exits
+
+    def start(self):
+        """
+        Claim the link and start the connection thread. Raises FinishLineError if another
+        process, such as a running Starting Gate, already owns the link; the two would
+        take turns knocking each other off the Finish Line's one connection.
+        """
+        if self.transport.exclusive:
+            self.__claim_link()
+        super().start()
+
+    def add_listener(self, listener):
+        """
+        Register listener(state) to be called, from the connection thread, on every
+        change of connection state.
+        """
+        self.__listeners.append(listener)
+
+    def add_handler(self, command, handler):
+        """
+        Register handler(msg, received_ns) to be called, from the connection thread, with
+        every message received for command instead of queueing it for receive().
+        """
+        self.__handlers[command] = handler
+
+    def connected(self):
+        """
+        Returns True if the connection to the Finish Line is up.
+        """
+        return self.state == ConnectionState.CONNECTED
+
+    def wait_connected(self, timeout=None):
+        """
+        Block until the Finish Line is connected or timeout seconds elapse.
+        Returns True if connected.
+        """
+        with self.__condition:
+            return self.__condition.wait_for(self.connected, timeout)
+
+    def send(self, command, *args):
+        """
+        Send a message to the Finish Line. Raises FinishLineError if not connected.
+        """
+        with self.__send_lock:
+            connection = self.__connection
+            if connection is None:
+                raise FinishLineError("Finish Line not connected")
+            try:
+                connection.sendall(encode_message(command, *args))
+                return
+            except OSError as exc:
+                error = exc
+
+        self.__disconnect(connection, error)
+        raise FinishLineError(*error.args) from error
+
+    def receive(self, timeout):
+        """
+        Return the next message received from the Finish Line, or None if no message
+        arrives within timeout seconds. Raises FinishLineError if the connection is
+        lost and no messages remain.
+        """
+        try:
+            return self.__messages.get(timeout=timeout)
+        except queue.Empty:
+            if not self.connected():
+                raise FinishLineError("Finish Line disconnected")
+            return None
+
+    def supports(self, capability):
+        """
+        Returns True if both sides are known to support capability, one of protocol's
+        CAP_* flags.
+        """
+        capabilities = self.capabilities
+        return capabilities is not None and bool(capabilities & capability)
+
+    def link_degraded(self):
+        """
+        Returns True if recent pings show the link is too slow or lossy to trust with a race.
+        """
+        return self.health.degraded()
+
+    def reconnect(self):
+        """
+        Drop the current connection so the thread establishes a fresh one.
+        """
+        connection = self.__connection
+        if connection is not None:
+            self.__disconnect(connection, "reconnect requested")
+
+    def arm_race(self):
+        """
+        Tell the Finish Line to start reporting finishes for a new race and return the
+        race's id. Clock synchronization and pings are suspended until end_race() so they
+        don't compete with finish messages.
+        """
+        self.__racing = True
+        with self.__condition:
+            self.race_id = next(self.__race_ids) % (1 << 16)
+            self.__armed_race = None
+            self.__finishes = set()
+            self.__unsynchronized = []
+            self.arm_latency_ns = None
+            self.__arm_sent = time.monotonic_ns()
+        try:
+            self.send(BEGIN_RACE, self.race_id)
+        except FinishLineError:
+            # Not armed, so don't resume the race on reconnect or keep pings suspended
+            self.__clear_race()
+            raise
+        return self.race_id
+
+    def wait_armed(self, timeout):
+        """
+        Block until the Finish Line acknowledges the race armed by arm_race(), the
+        connection is lost, or timeout seconds elapse. Returns True if acknowledged, or
+        if the Finish Line's firmware predates acknowledgements.
+        """
+        def armed():
+            if self.race_id is None:
+                return False
+            return self.__armed_race == self.race_id or \
+                (self.capabilities is not None and not self.supports(CAP_ARM_ACK))
+
+        with self.__condition:
+            self.__condition.wait_for(lambda: armed() or not self.connected(), timeout)
+            return armed()
+
+    def begin_race(self, timeout=ARM_TIMEOUT):
+        """
+        Arm a new race and wait for the Finish Line to acknowledge it. Raises
+        FinishLineError if it isn't acknowledged within timeout seconds.
+        """
+        self.arm_race()
+        if not self.wait_armed(timeout):
+            self.end_race()
+            raise FinishLineError("Finish Line did not acknowledge BGIN")
+
+    def end_race(self):
+        """
+        Tell the Finish Line to stop reporting finishes and resume idle processing. The
+        race is over locally either way: if ENDR can't be sent, finishes the Finish Line
+        still reports are discarded as not from the current race.
+        """
+        self.__clear_race()
+        try:
+            self.send(END_RACE)
+        except FinishLineError as exc:
+            print("FinishLine: ENDR not sent: ", exc)
+
+    def finish_time_ns(self, timestamp_us):
+        """
+        Convert a Finish Line micros() stamp to a (monotonic_ns, error_ns) tuple, or None
+        if the clocks have not been synchronized.
+        """
+        with self.__clock_lock:
+            if not self.clock.synchronized():
+                return None
+            return self.clock.to_local_ns(timestamp_us), self.clock.error_ns(timestamp_us)
+
+    def run(self):
+        delay = MIN_RECONNECT_DELAY
+
+        while True:
+            if self.__connection is None:
+                connected_at = time.monotonic_ns()
+                if not self.__connect():
+                    time.sleep(delay)
+                    delay = min(delay * 2, MAX_RECONNECT_DELAY)
+                continue
+
+            connection = self.__connection
+            try:
+                self.__service(connection)
+            except OSError as exc:
+                self.__disconnect(connection, exc)
+
+            # connect() succeeding proves nothing over UDP, or to a peer that accepts and
+            # hangs up, so only a connection the Finish Line has answered resets the backoff
+            if self.__last_received >= connected_at:
+                delay = MIN_RECONNECT_DELAY
+            elif self.__connection is None:
+                time.sleep(delay)
+                delay = min(delay * 2, MAX_RECONNECT_DELAY)
+
+    # PRIVATE:
+
+    def __set_state(self, state):
+        with self.__condition:
+            self.state = state
+            self.__condition.notify_all()
+        print("FinishLine: ", state)
+        for listener in self.__listeners:
+            listener(state)
+
+    def __connect(self):
+        self.__set_state(ConnectionState.CONNECTING)
+        try:
+            connection = self.transport.connect()
+        except OSError as exc:
+            print("FinishLine: connection to ", self.transport, " failed: ", exc)
+            connection = None
+
+        if connection is None:
+            self.__set_state(ConnectionState.DISCONNECTED)
+            return False
+
+        with self.__clock_lock:
+            self.clock.reset()
+        self.__framer.reset()
+        self.__time_request = None
+        self.__handshake_samples = HANDSHAKE_SAMPLES
+        self.__ping_request = None
+        self.health.reset()
+        self.__poller.register(connection, READ_ONLY)
+        self.__connection = connection
+
+        firmware = self.config.finish_line_firmware.get(self.transport.address())
+        with self.__condition:
+            if firmware is not None:
+                self.firmware_version = firmware["version"]
+                self.capabilities = firmware["capabilities"] & CAPABILITIES
+            else:
+                self.firmware_version = None
+                self.capabilities = None
+
+        try:
+            self.__hello_sent = time.monotonic_ns()
+            self.send(HELLO, "%x" % CAPABILITIES)
+            if self.race_id is not None:
+                self.__resume_race()
+        except FinishLineError:
+            return False
+
+        if self.capabilities is not None:
+            self.__set_state(ConnectionState.CONNECTED)
+        return True
+
+    def __claim_link(self):
+        name = re.sub(r"[^\w.-]", "_", str(self.transport))
+        lock_file = open(LINK_LOCK % name, "w") # pylint: disable=consider-using-with
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError as exc:
+            lock_file.close()
+            raise FinishLineError("%s is in use by another process" % self.transport) from exc
+        self.__link_lock = lock_file
+
+    def __clear_race(self):
+        self.__racing = False
+        with self.__condition:
+            self.race_id = None
+
+    def __resume_race(self):
+        """
+        Re-arm the race in progress when the connection dropped and ask for every finish
+        after the last one received in sequence.
+        """
+        sequences = {sequence for sequence, _ in self.__finishes}
+        last_sequence = 0
+        while last_sequence + 1 in sequences:
+            last_sequence += 1
+        print("FinishLine: resuming race ", self.race_id, " after finish ", last_sequence)
+        self.send(BEGIN_RACE, self.race_id)
+        if self.capabilities is None or self.supports(CAP_REPLAY):
+            self.send(REPLAY, self.race_id, last_sequence)
+
+    def __disconnect(self, connection, exc):
+        with self.__send_lock:
+            if self.__connection is not connection:
+                return  # Already replaced
+            print("FinishLine: connection lost: ", exc)
+            self.__connection = None
+        try:
+            self.__poller.unregister(connection)
+        except KeyError:
+            pass
+        connection.close()
+        self.__set_state(ConnectionState.DISCONNECTED)
+
+    def __service(self, connection):
+        """
+        Wait up to POLL_INTERVAL_MS for data from the Finish Line and dispatch every
+        complete message received, then send a TIME request or PING if one is due.
+        """
+        if self.__poller.poll(POLL_INTERVAL_MS):
+            data = connection.recv(1024)
+            received = time.monotonic_ns()
+            if not data:
+                raise FinishLineError("Connection closed by Finish Line")
+            self.__last_received = received
+            messages = self.__framer.feed(data)
+            if self.capabilities is not None and not self.supports(CAP_FRAMING):
+                messages += self.__framer.flush()
+            for msg in messages:
+                self.__dispatch(msg, received)
+
+        now = time.monotonic_ns()
+        if self.capabilities is None and self.__framer.pending() and \
+                now - self.__last_received > UNFRAMED_IDLE_NS:
+            for msg in self.__framer.flush():
+                self.__dispatch(msg, self.__last_received)
+        if self.state == ConnectionState.CONNECTING:
+            if now - self.__hello_sent > HELLO_TIMEOUT_NS:
+                raise FinishLineError("Finish Line did not answer HELO")
+            return
+        self.__sync_clock(now)
+        self.__ping(now)
+
+    def __dispatch(self, msg, received):
+        if msg.startswith(TIME_REPLY):
+            self.__time_reply(msg, received)
+        elif msg.startswith(PONG):
+            self.__pong(msg, received)
+        elif msg.startswith(ARMED):
+            self.__armed(msg, received)
+        elif msg.startswith(FINISHED):
+            self.__finished(msg)
+        elif msg.startswith(HELLO_REPLY):
+            self.__hello(msg)
+        elif msg.split(" ", 1)[0] in self.__handlers:
+            self.__handlers[msg.split(" ", 1)[0]](msg, received)
+        else:
+            self.__messages.put(msg)
+
+    def __sync_clock(self, now):
+        if self.__time_request is not None:
+            if now - self.__time_request[1] < TIME_REQUEST_TIMEOUT_NS:
+                return
+            print("FinishLine: TIME request ", self.__time_request[0], " timed out")
+            self.__time_request = None
+
+        if not self.supports(CAP_TIME_SYNC):
+            return
+        # The handshake is short enough to allow during a race resumed after a reconnect
+        if self.__handshake_samples > 0 or (not self.__racing and self.clock.sync_due(now)):
+            sequence = next(self.__time_sequence)
+            self.__time_request = (sequence, time.monotonic_ns())
+            self.send(TIME, sequence)
+
+    def __hello(self, msg):
+        version, capabilities = parse_hello_reply(msg)
+        with self.__condition:
+            self.firmware_version = version
+            self.capabilities = capabilities & CAPABILITIES
+            self.__condition.notify_all()
+        print("FinishLine: handshake complete, firmware ", version,
+              " capabilities %x" % self.capabilities)
+        if self.state == ConnectionState.CONNECTING:
+            self.__set_state(ConnectionState.CONNECTED)
+
+        if not self.supports(CAP_TIME_SYNC):
+            self.__release_finishes()
+
+        address = self.transport.address()
+        firmware = {"version": version, "capabilities": capabilities}
+        if address is not None and self.config.finish_line_firmware.get(address) != firmware:
+            # Replace rather than update the dict, which may still be shared with Config.DEFAULT
+            cache = dict(self.config.finish_line_firmware)
+            cache[address] = firmware
+            self.config.finish_line_firmware = cache
+            self.config.save()  # On the FinishLine thread; Config serializes saves
+
+    def __armed(self, msg, received):
+        race_id = int(msg.split()[1])
+        with self.__condition:
+            if race_id != self.race_id:
+                print("FinishLine: ignoring stale ", msg)
+                return
+            if self.__armed_race == race_id:
+                return  # Re-armed after a reconnect
+            self.__armed_race = race_id
+            self.arm_latency_ns = received - self.__arm_sent
+            self.__condition.notify_all()
+        print("FinishLine: race ", race_id, " armed in %.1fms" % (self.arm_latency_ns / 1000000))
+
+    def __finished(self, msg):
+        finish = parse_finished(msg)
+        if finish.race_id is None:
+            # Firmware without race ids only reports finishes between BGIN and ENDR
+            current = self.race_id is not None and not self.supports(CAP_ARM_ACK)
+        else:
+            current = finish.race_id == self.race_id
+        if not current:
+            print("FinishLine: discarding ", msg, ", not from race ", self.race_id)
+            return
+        if finish.sequence is not None:
+            # Keyed on the timestamp too, as a Finish Line that rebooted counts from 1 again
+            key = (finish.sequence, finish.timestamp_us)
+            if key in self.__finishes:
+                print("FinishLine: discarding duplicate ", msg)
+                return
+            self.__finishes.add(key)
+
+        if not self.clock.synchronized() and \
+                (self.capabilities is None or self.supports(CAP_TIME_SYNC)):
+            self.__unsynchronized.append(msg)
+            return
+        self.__messages.put(msg)
+
+    def __release_finishes(self):
+        for finish in self.__unsynchronized:
+            self.__messages.put(finish)
+        self.__unsynchronized = []
+
+    def __ping(self, now):
+        if self.__ping_request is not None:
+            if now - self.__ping_request[1] < PING_TIMEOUT_NS:
+                return
+            print("FinishLine: PING ", self.__ping_request[0], " not answered")
+            self.__ping_request = None
+            self.health.record_missed()
+            if self.health.lost():
+                raise FinishLineError("Finish Line stopped answering pings")
+
+        if self.__racing or not self.supports(CAP_PING):
+            return
+        if now - self.__last_ping < PING_INTERVAL_NS:
+            return
+        sequence = next(self.__ping_sequence)
+        self.__last_ping = now
+        self.__ping_request = (sequence, time.monotonic_ns())
+        self.send(PING, sequence)
+
+    def __pong(self, msg, received):
+        sequence = int(msg.split()[1])
+        if self.__ping_request is None or sequence != self.__ping_request[0]:
+            print("FinishLine: ignoring stale ", msg)
+            return
+
+        self.health.record_rtt(received - self.__ping_request[1])
+        self.__ping_request = None
+        if sequence % HEALTH_LOG_INTERVAL == 0:
+            print("FinishLine: ", self.health.summary())
+
+    def __time_reply(self, msg, received):
+        sequence, receive_us, transmit_us = parse_time_reply(msg)
+        if self.__time_request is None or sequence != self.__time_request[0]:
+            print("FinishLine: ignoring stale ", msg)
+            return
+
+        with self.__clock_lock:
+            self.clock.add_sample(self.__time_request[1], receive_us, transmit_us, received)
+        self.__time_request = None
+        self.__handshake_samples = max(self.__handshake_samples - 1, 0)
+        self.__release_finishes()
+
+
+def main():
+    """
+    At some point I should write legitimate unit tests.  But for now, I just exercise
+    some basic functionality if the module is invoked as the Python main.
+    """
+    main_config = Config("config/starting_gate.json")
+    finish_line = FinishLine(main_config)
+    finish_line.start()
+    finish_line.wait_connected()
+    time.sleep(10)
+    print("drift=", finish_line.clock.drift, " samples=", len(finish_line.clock.samples))
+
+if __name__ == '__main__':
+    main()
+
+# vim: expandtab sw=4
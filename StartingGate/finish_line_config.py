@@ -0,0 +1,223 @@
+"""
+Diecast Remote Raceway - finish_line_config
+
+Keeps the Finish Line's configuration in step with the Starting Gate's.
+
+The Finish Line needs the WiFi credentials and coordinator address to check for firmware
+updates, and advertises itself over Bluetooth under its own name. All of these are already
+in the Starting Gate's Config, so the Starting Gate is the source of truth:
+
+    Finish Line setting         Starting Gate config
+    wifiSSID                    wifi_ssid
+    wifiPassword                wifi_pswd
+    bluetoothAdvertisement      finish_line_name
+    controllerHostname          coord_host
+    controllerPort              coord_port
+    laneDebounce                finish_line_debounce (see debounce_fit.py)
+
+Rather than one SETC key=value per setting, each of which rewrites the Finish Line's
+flash, FinishLineConfig sends the settings that differ as JSON objects, as few SETCs as
+will carry them. The Finish Line discards any message longer than MAX_MESSAGE_LENGTH, so
+settings are only batched together while the SETC fits. The Finish Line applies each
+batch, writes its flash at most once (not at all if nothing changed), and replies with
+the resulting value of each setting in the batch (CONF). So provisioning a Finish Line
+takes one round trip, or two with long WiFi credentials.
+
+The Finish Line's config is remembered from its last CONF reply, and only settings that
+differ from it are sent. Until a reply has been received every setting is sent, leaving
+the Finish Line to skip any that are unchanged. Settings still holding a placeholder
+default (e.g. "<WIFI_SSID>") are never sent.
+
+A sync is started automatically every time the Finish Line connects. Call sync() after
+changing any of the above in Config. Firmware without CAP_BATCH_CONFIG is left alone.
+
+Author: Tom Quiggle
+tquiggle@gmail.com
+https://github.com/tquiggle/Die-Cast-Remote-Raceway
+
+Copyright (c) Thomas Quiggle. All rights reserved.
+
+Licensed under the MIT license. See LICENSE file in the project root for full license information.
+"""
+
+import json
+import threading
+
+from config import Config, WIFI_SSID, WIFI_PSWD, FINISH_LINE_NAME, COORDINATOR_HOSTNAME, \
+    COORDINATOR_PORT, FINISH_LINE_DEBOUNCE
+from finish_line import ConnectionState, FinishLine, FinishLineError
+from protocol import SET_CONFIG, CONFIG_REPLY, CAP_BATCH_CONFIG, MAX_MESSAGE_LENGTH
+
+# Finish Line setting names, and the Starting Gate config each is provisioned from
+FINISH_LINE_SETTINGS = {
+    "wifiSSID": WIFI_SSID,
+    "wifiPassword": WIFI_PSWD,
+    "bluetoothAdvertisement": FINISH_LINE_NAME,
+    "controllerHostname": COORDINATOR_HOSTNAME,
+    "controllerPort": COORDINATOR_PORT,
+    "laneDebounce": FINISH_LINE_DEBOUNCE
+}
+
+
+def is_placeholder(value):
+    """
+    Returns True if value is an unconfigured default such as "<WIFI_SSID>"
+    """
+    return isinstance(value, str) and value.startswith("<") and value.endswith(">")
+
+
+def encode_settings(settings):
+    """
+    Encode settings as the compact JSON object SETC carries
+    """
+    return json.dumps(settings, separators=(',', ':'))
+
+
+def setting_batches(settings):
+    """
+    Split settings into batches that each fit in one SETC message. A setting too long to
+    send even on its own is left out.
+    """
+    limit = MAX_MESSAGE_LENGTH - len(SET_CONFIG) - 1
+    batches = []
+    batch = {}
+    for setting, value in settings.items():
+        if len(encode_settings({setting: value})) > limit:
+            print("FinishLineConfig: ", setting, " is too long to send")
+            continue
+        if len(encode_settings(dict(batch, **{setting: value}))) > limit:
+            batches.append(batch)
+            batch = {}
+        batch[setting] = value
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+class FinishLineConfig:
+    """
+    Provisions the Finish Line with settings from the Starting Gate's Config.
+    """
+
+    def __init__(self, config, finish_line):
+        self.config = config
+        self.finish_line = finish_line
+        self.remote = None              # Finish Line config from its last CONF, if any
+        self.__pending = set()          # Settings sent and not yet acknowledged
+        self.__condition = threading.Condition()
+
+        finish_line.add_listener(self.__state_changed)
+        finish_line.add_handler(CONFIG_REPLY, self.__config_reply)
+
+    def desired(self):
+        """
+        The Finish Line settings the Starting Gate's Config calls for.
+        """
+        settings = {}
+        for setting, config_name in FINISH_LINE_SETTINGS.items():
+            value = getattr(self.config, config_name)
+            if isinstance(value, list):
+                # The Finish Line keeps per lane settings as one comma separated string
+                value = ",".join(str(item) for item in value)
+            if not is_placeholder(value):
+                settings[setting] = value
+        return settings
+
+    def changes(self):
+        """
+        The settings that need to be sent to bring the Finish Line up to date.
+        """
+        desired = self.desired()
+        if self.remote is None:
+            return desired
+        return {setting: value for setting, value in desired.items()
+                if self.remote.get(setting) != value}
+
+    def sync(self):
+        """
+        Send any changed settings to the Finish Line in as few batches as fit. Returns
+        without waiting for the replies; see wait_synchronized().
+        """
+        if not self.finish_line.supports(CAP_BATCH_CONFIG):
+            print("FinishLineConfig: Finish Line firmware ", self.finish_line.firmware_version,
+                  " can't be provisioned")
+            return
+
+        changes = self.changes()
+        if not changes:
+            with self.__condition:
+                self.__pending = set()
+            return
+
+        batches = setting_batches(changes)
+        print("FinishLineConfig: sending ", sorted(changes), " in ", len(batches), " SETC")
+        with self.__condition:
+            self.__pending = set().union(*batches)
+        try:
+            for batch in batches:
+                self.finish_line.send(SET_CONFIG, encode_settings(batch))
+        except FinishLineError as exc:
+            print("FinishLineConfig: sync failed: ", exc)
+
+    def synchronized(self):
+        """
+        Returns True if the Finish Line has acknowledged the desired settings.
+        """
+        return not self.__pending and not self.changes()
+
+    def wait_synchronized(self, timeout=None):
+        """
+        Block until the Finish Line has acknowledged the desired settings or timeout
+        seconds elapse. Returns True if it is synchronized.
+        """
+        with self.__condition:
+            return self.__condition.wait_for(self.synchronized, timeout)
+
+    # PRIVATE:
+
+    def __state_changed(self, state):
+        if state == ConnectionState.CONNECTED:
+            self.sync()
+
+    def __config_reply(self, msg, _received):
+        try:
+            remote = json.loads(msg[len(CONFIG_REPLY):])
+        except ValueError:
+            print("FinishLineConfig: unparseable ", msg)
+            return
+
+        with self.__condition:
+            self.remote = dict(self.remote or {}, **remote)
+            self.__pending -= set(remote)
+            self.__condition.notify_all()
+
+        rejected = sorted(set(self.changes()) & set(remote))
+        if rejected:
+            print("FinishLineConfig: Finish Line did not accept ", rejected)
+
+
+def main():
+    """
+    At some point I should write legitimate unit tests.  But for now, I just exercise
+    some basic functionality if the module is invoked as the Python main.
+    """
+    # pylint: disable=import-outside-toplevel
+    from finish_line_emulator import FinishLineEmulator
+    from transport import LoopbackTransport
+
+    emulator = FinishLineEmulator()
+    config = Config(None)
+    config.wifi_ssid = "raceway".ljust(32, "-")     # The longest SSID and password WiFi
+    config.wifi_pswd = "hotwheels".ljust(63, "-")   # allows take two SETC to send
+    config.coord_host = "raceway.local"
+
+    finish_line = FinishLine(config, LoopbackTransport(emulator.serve))
+    finish_line_config = FinishLineConfig(config, finish_line)
+    finish_line.start()
+    print(finish_line_config.wait_synchronized(5.0))    # True
+    print(emulator.config, emulator.flash_writes)       # raceway/hotwheels, 1 write (laneDebounce unchanged)
+
+if __name__ == '__main__':
+    main()
+
+# vim: expandtab sw=4
@@ -0,0 +1,707 @@
+"""
+Diecast Remote Raceway - finish_line_emulator
+
+A software Finish Line that speaks the same protocol as FinishLine/finishline/finishline.ino,
+so the race path (FinishLine, run_race() and track.RaceRunning) can be exercised and
+benchmarked without an ESP32 on the bench.
+
+Every command in the firmware's commandTable is implemented:
+
+    HELO            replies HELLO <firmware version> <capabilities>
+    BGIN <id>       arms race <id>, replies ARMED <id> and starts the crossing schedule
+                    (re-arming the race already running only replies ARMED)
+    ENDR            stops reporting finishes
+    FWVS            replies with the firmware version
+    GETC [keys]     replies CONF with the config (or just the comma separated keys) as
+                    compact JSON, one CONF per setting if it won't fit in one message
+    SETC key=value  updates the config, writes "flash" if it changed, and replies CONF key
+    SETC {json}     the same for a batch of settings, with at most one flash write
+    DELC            erases the config from "flash"; defaults return on the next restart
+    RSRT            drops the connection and restarts with a fresh micros() epoch
+    UPFW            installs firmware_update, if set, and restarts once no race is running
+    TIME <seq>      replies TIME <seq> <micros received> <micros sent>
+    PING <seq>      replies PONG <seq>
+    RPLY <id> <seq> resends race <id>'s last EVENT_LOG_SIZE FINs after sequence <seq>
+    OTAB/OTAD/OTAF  receives a firmware image as the Update API would (see firmware_update),
+                    then adopts the version given in OTAB and restarts
+    OTAA            discards a partially received image
+
+The emulator serves one connection at a time, given as a connected socket (serve(), which
+LoopbackTransport accepts directly as its serve callback), a TCP listener (serve_tcp()), a
+UDP port (serve_udp()) or a pseudo terminal (serve_pty(), for the serial transport). UDP
+has no connections, so datagrams from a new address replace the current session, as a
+new connection would; a Starting Gate that reconnects sends from a new port.
+
+Lane crossings are either triggered by calling cross() or scripted by a schedule of
+(lane, seconds after BGIN) pairs, or a callable returning one given the race id. To model
+a poor link, every message sent can be delayed by latency plus up to jitter seconds (in
+order, as RFCOMM delivers them), dropped with probability drop_rate, or duplicated with
+probability duplicate_rate. Received OTAD chunks are corrupted with probability
+corrupt_rate. The micros() clock can be given an offset and a drift.
+disconnect() drops the connection without otherwise disturbing the emulated Finish Line,
+as a link lost to interference would.
+
+Like the firmware, the emulator discards any message longer than MAX_MESSAGE_LENGTH.
+
+Older firmware is emulated by clearing bits from capabilities: the HELLO, TIME, PING and
+RPLY commands, ARMED acks and the fields of FIN messages then behave as they did before
+the corresponding capability was added. Without CAP_FRAMING, messages are sent without a
+terminator, each in a single write.
+
+Run as a program to serve a TCP port, UDP port or pty, or to benchmark the race path over
+an in-process loopback connection or the emulator's own TCP or UDP port:
+
+    python3 finish_line_emulator.py --tcp 8888 --schedule 1:3.5,2:3.6
+    python3 finish_line_emulator.py --udp 8888 --schedule 1:3.5,2:3.6
+    python3 finish_line_emulator.py --benchmark 20 --latency 0.005 --jitter 0.01
+    python3 finish_line_emulator.py --benchmark 20 --over udp
+
+Author: Tom Quiggle
+tquiggle@gmail.com
+https://github.com/tquiggle/Die-Cast-Remote-Raceway
+
+Copyright (c) Thomas Quiggle. All rights reserved.
+
+Licensed under the MIT license. See LICENSE file in the project root for full license information.
+"""
+
+import argparse
+import base64
+import binascii
+import hashlib
+import json
+import os
+import pty
+import random
+import socket
+import threading
+import time
+import tty
+import zlib
+
+from protocol import MessageFramer, MESSAGE_TERMINATOR, MAX_MESSAGE_LENGTH, CAPABILITIES, \
+    CAP_FRAMING, CAP_TIMESTAMPS, CAP_TIME_SYNC, CAP_PING, CAP_ARM_ACK, CAP_REPLAY, CAP_OTA
+
+FW_VERSION = "21012000"
+MICROS_WRAP = 1 << 32
+EVENT_LOG_SIZE = 16         # Finishes the firmware keeps for RPLY
+OTA_RESTART_DELAY = 0.5     # Seconds between OTAC and the restart into the new image
+MAX_DATAGRAM = 65535        # Largest UDP datagram serve_udp() receives
+
+DEFAULT_CONFIG = {
+    "wifiSSID": "<WIFI_SSID>",
+    "wifiPassword": "<WIFI_PASSWORD>",
+    "bluetoothAdvertisement": "FinishLine",
+    "controllerHostname": "<COORDINATOR_HOSTNAME>",
+    "controllerPort": 1968,
+    "laneDebounce": "100000,100000,100000,100000"
+}
+
+
+class FinishLineEmulator:
+    """
+    Emulated Finish Line. All public attributes may be changed while it is running.
+    """
+
+    # PUBLIC:
+
+    def __init__(self, schedule=None, latency=0.0, jitter=0.0, drop_rate=0.0,
+                 duplicate_rate=0.0, corrupt_rate=0.0, clock_offset_us=None, drift=0.0,
+                 seed=None):
+        self.schedule = schedule
+        self.latency = latency
+        self.jitter = jitter
+        self.drop_rate = drop_rate
+        self.duplicate_rate = duplicate_rate
+        self.corrupt_rate = corrupt_rate
+        self.drift = drift              # micros() runs (1 + drift) times real time
+        self.firmware_update = None     # Version UPFW installs, or None if up to date
+        self.update_ready = False       # UPFW installed an update, restart after the race
+        self.version = FW_VERSION
+        self.capabilities = CAPABILITIES    # protocol.CAP_* flags the firmware supports
+        self.ota = None                 # Update in progress: size, md5, version and image so far
+        self.installed_image = None     # Last image installed by OTAF
+
+        self.random = random.Random(seed)
+        self.clock_offset_us = clock_offset_us if clock_offset_us is not None \
+                               else self.random.randrange(MICROS_WRAP)
+        self.epoch = time.monotonic_ns()
+
+        self.flash = dict(DEFAULT_CONFIG)   # Config as saved to SPIFFS, None once deleted
+        self.flash_writes = 0
+        self.config = dict(self.flash)      # Config in effect
+
+        self.race_id = None             # Race being reported, None between races
+        self.crossings = []             # (lane, micros) of every crossing this race, in sequence
+        self.received = []              # Every message received, in order
+        self.sent = 0
+        self.dropped = 0
+        self.duplicated = 0
+        self.corrupted = 0
+
+        self.__lock = threading.Lock()
+        self.__session = None
+        self.__timers = []
+
+    def micros(self):
+        """
+        The emulated ESP32 micros(): a 32 bit microsecond counter since restart.
+        """
+        elapsed_ns = time.monotonic_ns() - self.epoch
+        return (self.clock_offset_us + int(elapsed_ns * (1.0 + self.drift)) // 1000) % MICROS_WRAP
+
+    def serve(self, peer):
+        """
+        Serve the Starting Gate connected to socket peer, replacing any current connection.
+        Returns immediately; the connection is serviced by its own thread.
+        """
+        peer.setblocking(True)
+        self.__start_session(peer.fileno(), peer)
+
+    def serve_tcp(self, host="127.0.0.1", port=0):
+        """
+        Listen for the Starting Gate on a TCP port, serving each connection as it arrives.
+        Returns the port, which is chosen by the kernel if port is 0.
+        """
+        listener = socket.create_server((host, port))
+
+        def accept():
+            while True:
+                peer, address = listener.accept()
+                print("FinishLineEmulator: connection from ", address)
+                peer.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                self.serve(peer)
+
+        threading.Thread(target=accept, name="EmulatorListener", daemon=True).start()
+        return listener.getsockname()[1]
+
+    def serve_udp(self, host="127.0.0.1", port=0):
+        """
+        Listen for the Starting Gate on a UDP port, replying to the address each datagram
+        came from. Returns the port, which is chosen by the kernel if port is 0.
+        """
+        udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        udp_socket.bind((host, port))
+
+        def receive():
+            session = None
+            while True:
+                data, address = udp_socket.recvfrom(MAX_DATAGRAM)
+                received_us = self.micros()
+                if session is None or session.closed or session.address != address:
+                    print("FinishLineEmulator: datagrams from ", address)
+                    session = self.__start_session(udp_socket.fileno(), udp_socket, address)
+                session.receive(data, received_us)
+
+        threading.Thread(target=receive, name="EmulatorListener", daemon=True).start()
+        return udp_socket.getsockname()[1]
+
+    def serve_pty(self):
+        """
+        Serve the master side of a new pseudo terminal and return the path of the slave,
+        which the serial transport can open as if it were the ESP32's USB serial port.
+        """
+        master, slave = pty.openpty()
+        tty.setraw(slave)
+        self.__start_session(master)
+        return os.ttyname(slave)
+
+    def cross(self, lane, detected_us=None):
+        """
+        Report a car crossing lane (zero indexed) at micros() detected_us, default now.
+        Crossings outside a race are ignored, as the firmware ignores them.
+        """
+        if detected_us is None:
+            detected_us = self.micros()
+        with self.__lock:
+            race_id = self.race_id
+            if race_id is None:
+                return
+            self.crossings.append((lane, detected_us))
+            sequence = len(self.crossings)
+        self.__send_finish(race_id, sequence, lane, detected_us)
+
+    def disconnect(self):
+        """
+        Drop the connection to the Starting Gate, leaving the race and clock untouched.
+        """
+        with self.__lock:
+            session = self.__session
+            self.__session = None
+        if session is not None:
+            session.close()
+
+    def restart(self):
+        """
+        Emulate ESP.restart(): drop the connection, forget any race, restart micros()
+        and reload the config from flash.
+        """
+        self.__cancel_schedule()
+        with self.__lock:
+            session = self.__session
+            self.__session = None
+            self.race_id = None
+            self.ota = None
+            self.epoch = time.monotonic_ns()
+            self.clock_offset_us = 0
+            if self.flash is None:
+                self.flash = dict(DEFAULT_CONFIG)   # readConfig() recreates a deleted config
+            self.config = dict(self.flash)
+        if session is not None:
+            session.close()
+
+    # PRIVATE:
+
+    def __start_session(self, fd, peer=None, address=None):
+        session = _Session(self, fd, peer, address)
+        with self.__lock:
+            previous = self.__session
+            self.__session = session
+        if previous is not None:
+            previous.close()
+        session.start()
+        return session
+
+    def __supports(self, capability):
+        return bool(self.capabilities & capability)
+
+    def __send_finish(self, race_id, sequence, lane, detected_us):
+        fields = ["FIN%d" % (lane + 1)]
+        if self.__supports(CAP_TIMESTAMPS):
+            fields.append(str(detected_us))
+            if self.__supports(CAP_ARM_ACK):
+                fields.append(race_id)
+                if self.__supports(CAP_REPLAY):
+                    fields.append(str(sequence))
+        self.__send(" ".join(fields))
+
+    def __send(self, message):
+        with self.__lock:
+            session = self.__session
+        if session is None:
+            return
+        if self.random.random() < self.drop_rate:
+            self.dropped += 1
+            return
+        copies = 1
+        if self.random.random() < self.duplicate_rate:
+            self.duplicated += 1
+            copies = 2
+        for _ in range(copies):
+            delay = self.latency + self.random.uniform(0.0, self.jitter)
+            session.send(message, time.monotonic() + delay)
+            self.sent += 1
+
+    def _process(self, session, message, received_us):
+        """ Handle one message from the Starting Gate, as processMessage() does """
+        if session is not self.__session:
+            return
+        self.received.append(message)
+        command = message[:4]
+        argument = message[5:]
+
+        if command == "HELO":
+            if self.capabilities:
+                self.__send("HELLO %s %x" % (self.version, self.capabilities))
+            else:
+                self.__send("HELLO")
+        elif command == "RSRT":
+            self.restart()
+        elif command == "UPFW":
+            if self.firmware_update is not None:
+                print("FinishLineEmulator: updating firmware to ", self.firmware_update)
+                self.version = self.firmware_update
+                self.firmware_update = None
+                self.update_ready = True
+            self.__restart_if_updated()
+        elif command == "FWVS":
+            self.__send(self.version)
+        elif command == "BGIN":
+            self.__begin_race(argument[:5])
+        elif command == "ENDR":
+            self.__cancel_schedule()
+            with self.__lock:
+                self.race_id = None
+            self.__restart_if_updated()
+        elif command == "GETC":
+            self.__get_config(argument)
+        elif command == "SETC":
+            self.__set_config(argument)
+        elif command == "DELC":
+            self.flash = None
+        elif command == "TIME" and self.__supports(CAP_TIME_SYNC):
+            self.__send("TIME %s %d %d" % (argument, received_us, self.micros()))
+        elif command == "PING" and self.__supports(CAP_PING):
+            self.__send("PONG " + argument)
+        elif command == "RPLY" and self.__supports(CAP_REPLAY):
+            self.__replay(*argument.split())
+        elif command == "OTAB" and self.__supports(CAP_OTA):
+            self.__ota_begin(*argument.split())
+        elif command == "OTAD" and self.__supports(CAP_OTA):
+            self.__ota_data(*argument.split())
+        elif command == "OTAF" and self.__supports(CAP_OTA):
+            self.__ota_finish()
+        elif command == "OTAA" and self.__supports(CAP_OTA):
+            self.ota = None
+        else:
+            print("FinishLineEmulator: received unknown command ", message)
+
+    def __restart_if_updated(self):
+        """ The firmware only boots a downloaded update between races """
+        if self.update_ready and self.race_id is None:
+            self.update_ready = False
+            self.restart()
+
+    def __begin_race(self, race_id):
+        with self.__lock:
+            resumed = race_id == self.race_id
+        if resumed:
+            self.__ack_armed(race_id)
+            return
+
+        self.__cancel_schedule()
+        with self.__lock:
+            self.race_id = race_id
+            self.crossings = []
+        self.__ack_armed(race_id)
+
+        schedule = self.schedule(race_id) if callable(self.schedule) else self.schedule
+        for lane, delay in schedule or []:
+            timer = threading.Timer(delay, self.cross, args=(lane,))
+            timer.daemon = True
+            self.__timers.append(timer)
+            timer.start()
+
+    def __ack_armed(self, race_id):
+        if self.__supports(CAP_ARM_ACK):
+            self.__send("ARMED " + race_id)
+
+    def __replay(self, race_id, after):
+        with self.__lock:
+            if race_id != self.race_id:
+                return
+            first = max(int(after), len(self.crossings) - EVENT_LOG_SIZE)
+            events = list(enumerate(self.crossings[first:], first + 1))
+        for sequence, (lane, detected_us) in events:
+            self.__send_finish(race_id, sequence, lane, detected_us)
+
+    def __ota_begin(self, size, md5, version=None):
+        if self.race_id is not None:
+            self.__send("OTAE busy")
+            return
+        ota = self.ota
+        if ota is None or ota["size"] != int(size) or ota["md5"] != md5:
+            ota = self.ota = {"size": int(size), "md5": md5, "version": version,
+                              "image": bytearray(), "nak_sent": False}
+        self.__send("OTAK %d" % len(ota["image"]))
+
+    def __ota_data(self, offset, crc, data):
+        ota = self.ota
+        if ota is None:
+            self.__send("OTAE not started")
+            return
+        image = ota["image"]
+        offset = int(offset)
+        if offset < len(image):             # Resent after a rewind; already written
+            self.__send("OTAK %d" % len(image))
+            return
+        if offset > len(image):             # In flight behind a rejected chunk
+            if not ota["nak_sent"]:
+                ota["nak_sent"] = True
+                self.__send("OTAN %d" % len(image))
+            return
+
+        ota["nak_sent"] = False
+        try:
+            chunk = base64.b64decode(data, validate=True)
+        except binascii.Error:
+            chunk = b""
+        if chunk and self.random.random() < self.corrupt_rate:
+            self.corrupted += 1
+            chunk = bytes([chunk[0] ^ 0xff]) + chunk[1:]
+        if not chunk or zlib.crc32(chunk) != int(crc, 16) or \
+           offset + len(chunk) > ota["size"]:
+            ota["nak_sent"] = True
+            self.__send("OTAN %d" % len(image))
+            return
+        image += chunk
+        self.__send("OTAK %d" % len(image))
+
+    def __ota_finish(self):
+        ota = self.ota
+        if ota is None:
+            self.__send("OTAE not started")
+        elif len(ota["image"]) != ota["size"]:
+            self.__send("OTAE incomplete")
+        elif hashlib.md5(ota["image"]).hexdigest() != ota["md5"]:
+            self.ota = None
+            self.__send("OTAE MD5 Check Failed")
+        else:
+            print("FinishLineEmulator: installed firmware ", ota["version"])
+            self.installed_image = bytes(ota["image"])
+            if ota["version"] is not None:
+                self.version = ota["version"]
+            self.__send("OTAC")
+            timer = threading.Timer(self.latency + self.jitter + OTA_RESTART_DELAY, self.restart)
+            timer.daemon = True
+            timer.start()
+
+    def __cancel_schedule(self):
+        for timer in self.__timers:
+            timer.cancel()
+        self.__timers = []
+
+    def __get_config(self, keys):
+        names = keys.split(",") if keys else self.config
+        config = {key: self.config[key] for key in names if key in self.config}
+        message = "CONF " + json.dumps(config, separators=(',', ':'))
+        if len(message.encode('utf-8')) <= MAX_MESSAGE_LENGTH:
+            self.__send(message)
+            return
+        # Too long for the Starting Gate to receive, so send each setting on its own
+        for key, value in config.items():
+            self.__send("CONF " + json.dumps({key: value}, separators=(',', ':')))
+
+    def __set_config(self, argument):
+        if argument.startswith("{"):
+            try:
+                settings = json.loads(argument)
+            except ValueError:
+                print("FinishLineEmulator: invalid JSON ", argument)
+                return
+        else:
+            key, _, value = argument.partition("=")
+            settings = {key: value}
+
+        changed = False
+        for key, value in settings.items():
+            if key not in DEFAULT_CONFIG:
+                print("FinishLineEmulator: invalid config name ", key)
+                continue
+            value = int(value) if isinstance(DEFAULT_CONFIG[key], int) else str(value)
+            if self.config[key] != value:
+                self.config[key] = value
+                changed = True
+
+        if changed:
+            self.flash = dict(self.config)
+            self.flash_writes += 1
+        self.__get_config(",".join(settings))
+
+
+class _Session:
+    """
+    One connection to the Starting Gate, over a socket (peer) or pty file descriptor. A reader
+    thread parses and processes commands; a writer thread delivers replies no earlier
+    than the time the emulator scheduled them for, and never out of order. Over UDP, peer
+    is the listening socket, shared by every session, and address the Starting Gate's;
+    serve_udp() receives the datagrams, so there is no reader thread.
+    """
+
+    def __init__(self, emulator, fd, peer=None, address=None):
+        self.emulator = emulator
+        self.fd = fd
+        self.peer = peer
+        self.address = address
+        self.closed = False
+        self.framer = MessageFramer()
+        self.outgoing = []              # (deliver_at, message), in delivery order
+        self.last_delivery = 0.0
+        self.condition = threading.Condition()
+
+    def start(self):
+        if self.address is None:
+            threading.Thread(target=self.read, name="EmulatorReader", daemon=True).start()
+        threading.Thread(target=self.write, name="EmulatorWriter", daemon=True).start()
+
+    def send(self, message, deliver_at):
+        with self.condition:
+            self.last_delivery = max(self.last_delivery, deliver_at)
+            self.outgoing.append((self.last_delivery, message))
+            self.condition.notify()
+
+    def close(self):
+        with self.condition:
+            if self.closed:
+                return
+            self.closed = True
+            self.condition.notify()
+        if self.address is not None:
+            return      # The UDP socket outlives the session
+        try:
+            if self.peer is not None:
+                # Shut down first so the Starting Gate sees the close, and read() wakes up
+                self.peer.shutdown(socket.SHUT_RDWR)
+                self.peer.close()
+            else:
+                os.close(self.fd)
+        except OSError:
+            pass
+
+    def read(self):
+        while not self.closed:
+            try:
+                data = os.read(self.fd, 1024)
+            except OSError:
+                data = b""
+            received_us = self.emulator.micros()
+            if not data:
+                break
+            self.receive(data, received_us)
+        self.close()
+
+    def receive(self, data, received_us):
+        for message in self.framer.feed(data):
+            self.emulator._process(self, message, received_us) #pylint: disable=protected-access
+
+    def write(self):
+        while True:
+            with self.condition:
+                while not self.closed and not self.outgoing:
+                    self.condition.wait()
+                if self.closed:
+                    return
+                deliver_at, message = self.outgoing[0]
+                delay = deliver_at - time.monotonic()
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+                self.outgoing.pop(0)
+            try:
+                terminator = MESSAGE_TERMINATOR if self.emulator.capabilities & CAP_FRAMING else b""
+                data = message.encode('utf-8') + terminator
+                if self.address is not None:
+                    self.peer.sendto(data, self.address)
+                else:
+                    os.write(self.fd, data)
+            except OSError:
+                self.close()
+                return
+
+
+def parse_schedule(spec):
+    """
+    Parse a schedule given as "lane:seconds,..." with one based lane numbers, e.g.
+    "1:3.5,2:3.62", into a list of (lane_index, seconds) pairs.
+    """
+    schedule = []
+    for crossing in spec.split(","):
+        lane, delay = crossing.split(":")
+        schedule.append((int(lane) - 1, float(delay)))
+    return schedule
+
+
+def percentile(values, fraction):
+    """ Value below which fraction of values fall """
+    ordered = sorted(values)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+def benchmark(emulator, races, lanes=4, over="loopback"):
+    """
+    Run races through a FinishLine connected to emulator over loopback, or the emulator's
+    own tcp or udp port, and print the BGIN/ARMED round trip and the delay from each
+    crossing to its FIN being received.
+    """
+    # Imported here so the emulator itself doesn't depend on the Starting Gate
+    from config import Config #pylint: disable=import-outside-toplevel
+    from finish_line import FinishLine #pylint: disable=import-outside-toplevel
+    from protocol import parse_finished #pylint: disable=import-outside-toplevel
+    # pylint: disable=import-outside-toplevel
+    from transport import LoopbackTransport, TcpTransport, UdpTransport, TCP, UDP
+
+    if over == TCP:
+        transport = TcpTransport("127.0.0.1", emulator.serve_tcp())
+    elif over == UDP:
+        transport = UdpTransport("127.0.0.1", emulator.serve_udp())
+    else:
+        transport = LoopbackTransport(emulator.serve)
+    finish_line = FinishLine(Config(None), transport)
+    finish_line.start()
+    finish_line.wait_connected()
+    time.sleep(1.0)     # Let the clock synchronization handshake complete
+
+    arm_ns = []
+    delivery_ns = []
+    lost = 0
+    start = time.monotonic()
+
+    for _ in range(races):
+        finish_line.begin_race()
+        arm_ns.append(finish_line.arm_latency_ns)
+        for lane in range(lanes):
+            emulator.cross(lane)
+
+        finished = 0
+        while finished < lanes:
+            msg = finish_line.receive(1.0)
+            if msg is None:
+                lost += lanes - finished
+                break
+            received = time.monotonic_ns()
+            finish = finish_line.finish_time_ns(parse_finished(msg).timestamp_us)
+            if finish is not None:
+                delivery_ns.append(received - finish[0])
+            finished += 1
+        finish_line.end_race()
+
+    elapsed = time.monotonic() - start
+    print("%d races in %.2fs, %.1f races/s, %d finishes lost" % (
+        races, elapsed, races / elapsed, lost))
+    for name, values in (("arm", arm_ns), ("finish delivery", delivery_ns)):
+        if values:
+            print("%s p50=%.2fms p95=%.2fms max=%.2fms" % (
+                name, percentile(values, 0.5) / 1e6, percentile(values, 0.95) / 1e6,
+                max(values) / 1e6))
+
+
+def main():
+    """
+    Serve an emulated Finish Line over TCP, UDP or a pty, or benchmark the race path.
+    """
+    parser = argparse.ArgumentParser(description="Emulated Diecast Remote Raceway Finish Line")
+    parser.add_argument("--tcp", type=int, metavar="PORT", help="listen on a TCP port")
+    parser.add_argument("--udp", type=int, metavar="PORT", help="listen on a UDP port")
+    parser.add_argument("--pty", action="store_true", help="serve a pseudo terminal")
+    parser.add_argument("--benchmark", type=int, metavar="RACES",
+                        help="run races through an in-process FinishLine and report latency")
+    parser.add_argument("--over", choices=["loopback", "tcp", "udp"], default="loopback",
+                        help="how the benchmark's FinishLine reaches the emulator")
+    parser.add_argument("--schedule", type=parse_schedule, metavar="LANE:SECONDS,...",
+                        help="crossings to report after each BGIN")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every reply")
+    parser.add_argument("--jitter", type=float, default=0.0, help="up to this many more seconds")
+    parser.add_argument("--drop", type=float, default=0.0, help="probability a reply is dropped")
+    parser.add_argument("--duplicate", type=float, default=0.0,
+                        help="probability a reply is sent twice")
+    parser.add_argument("--corrupt", type=float, default=0.0,
+                        help="probability a received firmware chunk is corrupted")
+    parser.add_argument("--drift", type=float, default=0.0, help="micros() rate error, e.g. 20e-6")
+    parser.add_argument("--seed", type=int, help="seed for repeatable faults")
+    args = parser.parse_args()
+
+    emulator = FinishLineEmulator(schedule=args.schedule, latency=args.latency,
+                                  jitter=args.jitter, drop_rate=args.drop,
+                                  duplicate_rate=args.duplicate,
+                                  corrupt_rate=args.corrupt, drift=args.drift, seed=args.seed)
+
+    if args.benchmark:
+        benchmark(emulator, args.benchmark, over=args.over)
+        return
+
+    if args.tcp is not None:
+        print("Finish Line emulator listening on TCP port ", emulator.serve_tcp("", args.tcp))
+    elif args.udp is not None:
+        print("Finish Line emulator listening on UDP port ", emulator.serve_udp("", args.udp))
+    elif args.pty:
+        print("Finish Line emulator serving ", emulator.serve_pty())
+    else:
+        parser.error("one of --tcp, --udp, --pty or --benchmark is required")
+
+    while True:
+        time.sleep(3600)
+
+if __name__ == '__main__':
+    main()
+
+# vim: expandtab sw=4
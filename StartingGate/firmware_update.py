@@ -0,0 +1,257 @@
+"""
+Diecast Remote Raceway - firmware_update
+
+Streams a new firmware image to the Finish Line over the existing link.
+
+The Finish Line used to update itself only over WiFi, from the coordinator, so a Finish
+Line at a venue without WiFi could not be updated at all. FirmwareUpdate instead sends the
+image over whatever link the FinishLine thread has up (Bluetooth RFCOMM, normally), and
+the firmware writes it to its spare OTA partition with the ESP32 Update API:
+
+    OTAB <size> <md5> [version]     start the update, answered with OTAK 0
+    OTAD <offset> <crc32> <base64>  one chunk of OTA_CHUNK_SIZE bytes, answered with
+                                    OTAK <offset after chunk>, or OTAN <offset> if rejected
+    OTAF                            verify the MD5 and install, answered with OTAC before
+                                    the Finish Line restarts into the new image
+
+Each chunk carries the CRC32 of its bytes, so a chunk damaged in transit is rejected
+(OTAN) rather than written. The Finish Line acks cumulatively, so flow control is a
+window: up to OTA_WINDOW chunks are sent ahead of the last ack, which keeps the link busy
+while the Finish Line erases and writes flash, without overrunning its receive buffer. A
+rejected chunk, or OTA_ACK_TIMEOUT without progress, rewinds the stream to the last
+acknowledged offset (go back N).
+
+If the connection is lost part way through, the update resumes once the FinishLine
+thread has reconnected: sending OTAB again for the same image is answered with the
+offset the Finish Line had reached.
+
+Updates are refused while a race is running, by both sides.
+
+At most OTA_WINDOW chunks, 672 bytes of image, are in flight per round trip, and the
+window can't grow much: the firmware's SerialBT receive queue has to absorb it while
+Update.write() is busy with flash. Over Bluetooth SPP, with round trips of 20 to 40ms,
+that is 15 to 35 KB/s, so a typical 1MB image (Bluetooth and WiFi both linked in) takes
+30 seconds to a minute. main() reports the rate achieved.
+
+The FinishLine thread owns the only connection the Finish Line serves, so run this on the
+Starting Gate with the Starting Gate program stopped; it refuses to start otherwise:
+
+    python3 firmware_update.py finish-line-21101700.bin --version 21101700
+
+Author: Tom Quiggle
+tquiggle@gmail.com
+https://github.com/tquiggle/Die-Cast-Remote-Raceway
+
+Copyright (c) Thomas Quiggle. All rights reserved.
+
+Licensed under the MIT license. See LICENSE file in the project root for full license information.
+"""
+
+import argparse
+import base64
+import hashlib
+import sys
+import threading
+import time
+import zlib
+
+from config import Config
+from finish_line import FinishLine, FinishLineError
+from protocol import OTA_BEGIN, OTA_DATA, OTA_FINISH, OTA_ABORT, OTA_ACK, OTA_NAK, OTA_ERROR, \
+    OTA_COMPLETE, CAP_OTA
+
+OTA_CHUNK_SIZE = 168            # Image bytes per OTAD; base64 encoded it fits in a message
+OTA_WINDOW = 4                  # Chunks sent ahead of the last acknowledgement
+OTA_ACK_TIMEOUT = 2.0           # Seconds without progress before resending the window
+OTA_FINISH_TIMEOUT = 10.0       # Seconds to wait for the Finish Line to verify the image
+OTA_MAX_RETRIES = 5             # Consecutive timeouts before giving up
+OTA_MAX_RECONNECTS = 3          # Lost connections survived before giving up
+OTA_RECONNECT_TIMEOUT = 30.0    # Seconds to wait for the FinishLine thread to reconnect
+
+
+class FirmwareUpdateError(RuntimeError):
+    """
+    The firmware update failed. The Finish Line carries on running its current firmware.
+    """
+
+
+class FirmwareUpdate:
+    """
+    Sends image, a firmware .bin as built by the Arduino IDE, to the Finish Line.
+    """
+
+    # PUBLIC:
+
+    def __init__(self, finish_line, image, version=None, chunk_size=OTA_CHUNK_SIZE,
+                 window=OTA_WINDOW):
+        self.finish_line = finish_line
+        self.image = bytes(image)
+        self.version = version
+        self.chunk_size = chunk_size
+        self.window = window
+        self.md5 = hashlib.md5(self.image).hexdigest()
+        self.acked = 0                  # Bytes the Finish Line has written
+        self.retransmits = 0            # Chunks rejected or timed out, and sent again
+
+        self.__nak = None               # Offset of the last OTAN not yet acted on
+        self.__error = None             # Reason given by OTAE
+        self.__complete = False
+        self.__condition = threading.Condition()
+
+        for command in (OTA_ACK, OTA_NAK, OTA_ERROR, OTA_COMPLETE):
+            finish_line.add_handler(command, self.__reply)
+
+    def run(self):
+        """
+        Send the image and wait for the Finish Line to install it, resuming after lost
+        connections. Raises FirmwareUpdateError if the update fails.
+        """
+        if not self.finish_line.supports(CAP_OTA):
+            raise FirmwareUpdateError("Finish Line firmware %s can't be updated over the link"
+                                      % self.finish_line.firmware_version)
+        if self.finish_line.race_id is not None:
+            raise FirmwareUpdateError("A race is running")
+
+        reconnects = 0
+        while True:
+            try:
+                self.__begin()
+                self.__stream()
+                self.__finish()
+                return
+            except FinishLineError as exc:
+                reconnects += 1
+                if reconnects > OTA_MAX_RECONNECTS:
+                    raise FirmwareUpdateError("Connection lost: %s" % exc) from exc
+                print("FirmwareUpdate: connection lost at ", self.acked, ", resuming")
+                if not self.finish_line.wait_connected(OTA_RECONNECT_TIMEOUT):
+                    raise FirmwareUpdateError("Finish Line did not reconnect") from exc
+
+    def abort(self):
+        """
+        Tell the Finish Line to discard the partially received image.
+        """
+        self.finish_line.send(OTA_ABORT)
+
+    def progress(self):
+        """
+        Fraction of the image the Finish Line has written.
+        """
+        return max(self.acked, 0) / len(self.image) if self.image else 1.0
+
+    # PRIVATE:
+
+    def __begin(self):
+        with self.__condition:
+            self.acked = -1
+            self.__nak = None
+            self.__error = None
+            self.__complete = False
+        args = [len(self.image), self.md5] + ([self.version] if self.version else [])
+        self.finish_line.send(OTA_BEGIN, *args)
+        if not self.__wait(lambda: self.acked >= 0, OTA_ACK_TIMEOUT):
+            raise FirmwareUpdateError("Finish Line did not answer OTAB")
+        if self.acked > 0:
+            print("FirmwareUpdate: resuming at ", self.acked)
+
+    def __stream(self):
+        size = len(self.image)
+        window_bytes = self.window * self.chunk_size
+        sent = self.acked
+        retries = 0
+
+        while self.acked < size:
+            sent = max(sent, self.acked)
+            while sent < size and sent - self.acked < window_bytes:
+                self.__send_chunk(sent)
+                sent = min(sent + self.chunk_size, size)
+
+            acked = self.acked
+            progressed = self.__wait(lambda: self.acked != acked or self.__nak is not None,
+                                     OTA_ACK_TIMEOUT)
+            with self.__condition:
+                nak, self.__nak = self.__nak, None
+
+            if nak is not None:
+                self.retransmits += (sent - nak + self.chunk_size - 1) // self.chunk_size
+                sent = nak
+            elif not progressed:
+                retries += 1
+                if retries > OTA_MAX_RETRIES:
+                    raise FirmwareUpdateError("Finish Line stopped acknowledging at %d" % acked)
+                self.retransmits += (sent - self.acked + self.chunk_size - 1) // self.chunk_size
+                sent = self.acked
+            else:
+                retries = 0
+
+    def __finish(self):
+        self.finish_line.send(OTA_FINISH)
+        if not self.__wait(lambda: self.__complete, OTA_FINISH_TIMEOUT):
+            raise FirmwareUpdateError("Finish Line did not confirm the update")
+
+    def __send_chunk(self, offset):
+        chunk = self.image[offset:offset + self.chunk_size]
+        self.finish_line.send(OTA_DATA, offset, "%08x" % zlib.crc32(chunk),
+                              base64.b64encode(chunk).decode('ascii'))
+
+    def __wait(self, predicate, timeout):
+        """
+        Wait for predicate, an OTAE, or the connection to drop. Returns predicate().
+        """
+        with self.__condition:
+            done = self.__condition.wait_for(
+                lambda: predicate() or self.__error is not None or
+                not self.finish_line.connected(), timeout)
+            error = self.__error
+        if error is not None:
+            raise FirmwareUpdateError("Finish Line failed the update: %s" % error)
+        if not self.finish_line.connected():
+            raise FinishLineError("Finish Line disconnected")
+        return done and predicate()
+
+    def __reply(self, msg, _received):
+        command, _, argument = msg.partition(" ")
+        with self.__condition:
+            if command == OTA_ACK:
+                self.acked = int(argument)
+            elif command == OTA_NAK:
+                self.__nak = int(argument)
+            elif command == OTA_ERROR:
+                self.__error = argument
+            else:
+                self.__complete = True
+            self.__condition.notify_all()
+
+
+def main():
+    """
+    Send a firmware image to the Finish Line named in the config
+    """
+    parser = argparse.ArgumentParser(description="Update the Finish Line's firmware")
+    parser.add_argument("image", help="Firmware .bin to install")
+    parser.add_argument("--version", help="Version of the image, for the Finish Line's log")
+    parser.add_argument("--config", default="config/starting_gate.json")
+    args = parser.parse_args()
+
+    with open(args.image, "rb") as image_file:
+        image = image_file.read()
+
+    finish_line = FinishLine(Config(args.config))
+    try:
+        finish_line.start()
+    except FinishLineError as exc:
+        sys.exit("%s: stop the Starting Gate first" % exc)
+    finish_line.wait_connected()
+    print("Finish Line is running ", finish_line.firmware_version)
+
+    update = FirmwareUpdate(finish_line, image, args.version)
+    start = time.monotonic()
+    update.run()
+    elapsed = time.monotonic() - start
+    print("Sent %d bytes in %.1fs (%.1f KB/s), %d chunks resent" % (
+        len(image), elapsed, len(image) / elapsed / 1024, update.retransmits))
+
+if __name__ == '__main__':
+    main()
+
+# vim: expandtab sw=4
@@ -0,0 +1,217 @@
+"""
+Diecast Remote Raceway - gpio_simulator
+
+Drives the Starting Gate's inputs from a scripted timeline, so the Starting Gate can be run
+and benchmarked on a plain Linux box. Selected by DRR_GPIO_BACKEND=sim:<timeline file> (see
+deviceio), which puts every pin on gpiozero's MockFactory and starts a GpioSimulator.
+
+A timeline is a JSON object:
+
+    {
+        "repeat": 12.0,
+        "events": [
+            {"at": 1.0, "input": "LANE1", "action": "activate"},
+            {"at": 1.2, "input": "LANE2", "action": "activate"},
+            {"at": 9.0, "input": "KEY_1", "action": "press"}
+        ],
+        "on_release": [
+            {"after": 0.035, "input": "LANE1", "action": "deactivate"},
+            {"after": 0.041, "input": "LANE2", "action": "deactivate"}
+        ]
+    }
+
+events are performed the given number of seconds after the simulator starts, and again
+every repeat seconds if repeat is given. on_release events are performed the given number
+of seconds after each release of the starting gate (DeviceIO.mark_release()), which is how
+cars leave the gate once the servo has had time to open it. Inputs are named as in
+deviceio (LANE1..LANE4, KEY_1..KEY_3, JOYU, JOYD, JOYL, JOYR, JOYP). The actions are:
+
+    activate        a car arrives at a lane sensor, or a key is held down
+    deactivate      the car leaves, or the key is let go
+    press           activate, then deactivate PRESS_SECONDS later
+
+Run as a program to benchmark lane readiness and start stamping on the mock backend:
+
+    python3 gpio_simulator.py --races 20 --lanes 4
+
+Author: Tom Quiggle
+tquiggle@gmail.com
+https://github.com/tquiggle/Die-Cast-Remote-Raceway
+
+Copyright (c) Thomas Quiggle. All rights reserved.
+
+Licensed under the MIT license. See LICENSE file in the project root for full license information.
+"""
+
+import argparse
+import json
+import os
+import threading
+import time
+
+ACTIVATE = "activate"
+DEACTIVATE = "deactivate"
+PRESS = "press"
+ACTIONS = (ACTIVATE, DEACTIVATE, PRESS)
+
+PRESS_SECONDS = 0.150       # How long a pressed key is held down; longer than any debounce
+
+
+def load_timeline(filename):
+    """
+    Read a timeline from the JSON file filename
+    """
+    with open(filename, "r") as timeline_file:
+        return json.load(timeline_file)
+
+
+class GpioSimulator:
+    """
+    Performs a timeline's events on the mock pins of inputs, a dict of gpiozero input
+    devices by name, recording each edge driven in trace if given.
+    """
+
+    # PUBLIC:
+
+    def __init__(self, inputs, timeline, trace=None):
+        self.inputs = inputs
+        self.trace = trace
+        self.events = timeline.get("events", [])
+        self.on_release = timeline.get("on_release", [])
+        self.repeat = timeline.get("repeat")
+        self.performed = 0              # Events performed so far
+
+        for event in self.events + self.on_release:
+            if event["input"] not in inputs:
+                raise ValueError("Unknown input in timeline: %s" % event["input"])
+            if event["action"] not in ACTIONS:
+                raise ValueError("Unknown action in timeline: %s" % event["action"])
+
+        self.__lock = threading.Lock()
+        self.__timers = []
+
+    def start(self):
+        """
+        Schedule the timeline's events, relative to now
+        """
+        for event in self.events:
+            self.__schedule(event["at"], event)
+        if self.repeat:
+            self.__schedule_call(self.repeat, self.start)
+
+    def released(self):
+        """
+        Schedule the timeline's on_release events, relative to now
+        """
+        for event in self.on_release:
+            self.__schedule(event["after"], event)
+
+    def stop(self):
+        """
+        Cancel every event not yet performed
+        """
+        with self.__lock:
+            timers = self.__timers
+            self.__timers = []
+        for timer in timers:
+            timer.cancel()
+
+    def perform(self, name, action):
+        """
+        Perform action on the input called name right away
+        """
+        device = self.inputs[name]
+        # Inputs with pull ups are active low
+        level = int((action != DEACTIVATE) != device.pull_up)
+        if level:
+            device.pin.drive_high()
+        else:
+            device.pin.drive_low()
+        if self.trace is not None:
+            self.trace.record(device.pin.number, level, self.trace.current_tick())
+        if action == PRESS:
+            self.__schedule_call(PRESS_SECONDS, self.perform, name, DEACTIVATE)
+        self.performed += 1
+
+    # PRIVATE:
+
+    def __schedule(self, delay, event):
+        self.__schedule_call(delay, self.perform, event["input"], event["action"])
+
+    def __schedule_call(self, delay, function, *args):
+        timer = threading.Timer(delay, function, args=args)
+        timer.daemon = True
+        with self.__lock:
+            self.__timers = [pending for pending in self.__timers if pending.is_alive()]
+            self.__timers.append(timer)
+        timer.start()
+
+
+def percentile(values, fraction):
+    """ Value below which fraction of values fall """
+    ordered = sorted(values)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+def benchmark(races, lanes, debounce):
+    """
+    Place cars on lanes, measure how long DeviceIO takes to see they are all ready with the
+    given lane debounce, release the gate and measure the error in each lane's start stamp.
+    """
+    # pylint: disable=import-outside-toplevel
+    import deviceio
+    from deviceio import DeviceIO
+
+    device = DeviceIO()
+    device.set_lane_debounce([debounce] * len(deviceio.LANES))
+    settle = debounce + 0.050              # Long enough for the lanes to settle
+    simulator = GpioSimulator(deviceio.INPUTS, {}, device.trace)
+    names = ["LANE%d" % (lane + 1) for lane in range(lanes)]
+    ready_latencies = []
+    start_errors = []
+
+    for _ in range(races):
+        for name in names:
+            simulator.perform(name, ACTIVATE)
+        placed = time.monotonic_ns()
+        if not device.wait_lanes_ready(lanes, 1.0):
+            print("Lanes never became ready")
+            continue
+        ready_latencies.append(time.monotonic_ns() - placed)
+        time.sleep(settle)
+
+        device.mark_release()
+        for name in names:
+            simulator.perform(name, DEACTIVATE)
+        left = time.monotonic_ns()
+        time.sleep(settle)      # The start stamps are confirmed once the lanes settle
+        for lane in range(lanes):
+            start = device.lane_start_ns(lane)
+            if start is not None:
+                start_errors.append(abs(start[0] - left))
+
+    for label, values in (("ready latency", ready_latencies), ("start stamp error", start_errors)):
+        if values:
+            print("%-18s p50=%.3fms p95=%.3fms max=%.3fms" % (
+                label, percentile(values, 0.50) / 1e6, percentile(values, 0.95) / 1e6,
+                max(values) / 1e6))
+
+
+def main():
+    """
+    Benchmark deviceio on the mock backend
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the Starting Gate's GPIO handling")
+    parser.add_argument("--races", type=int, default=20)
+    parser.add_argument("--lanes", type=int, default=4, choices=range(1, 5))
+    parser.add_argument("--debounce", type=float, default=0.0,
+                        help="Lane debounce in seconds, which ready latency includes")
+    args = parser.parse_args()
+
+    os.environ.setdefault("DRR_GPIO_BACKEND", "mock")
+    benchmark(args.races, args.lanes, args.debounce)
+
+if __name__ == '__main__':
+    main()
+
+# vim: expandtab sw=4
@@ -0,0 +1,137 @@
+"""
+Diecast Remote Raceway - link_health
+
+Tracks the health of the Bluetooth link to the Finish Line.
+
+Between races the FinishLine thread sends a PING every PING_INTERVAL_NS and the Finish
+Line echoes it back as a PONG. LinkHealth keeps the round trip times of the most recent
+pings, reports their p50/p95/p99 along with a coarse histogram, and counts consecutive
+pings that went unanswered. The link is considered degraded when the p95 round trip
+exceeds DEGRADED_P95_NS, or any ping has recently gone unanswered. The Starting Gate checks
+for degradation before each countdown and reconnects rather than risk losing a heat, and
+the FinishLine thread reconnects on its own after MAX_MISSED_PINGS unanswered pings.
+
+Author: Tom Quiggle
+tquiggle@gmail.com
+https://github.com/tquiggle/Die-Cast-Remote-Raceway
+
+Copyright (c) Thomas Quiggle. All rights reserved.
+
+Licensed under the MIT license. See LICENSE file in the project root for full license information.
+"""
+
+import bisect
+import collections
+
+NANOSECONDS_PER_MILLISECOND = 1000000
+
+PING_INTERVAL_NS = 1000 * NANOSECONDS_PER_MILLISECOND   # How often to ping while idle
+PING_TIMEOUT_NS = 1000 * NANOSECONDS_PER_MILLISECOND    # A ping is lost if not answered by then
+MAX_MISSED_PINGS = 3                    # Consecutive lost pings before forcing a reconnect
+RTT_WINDOW = 120                        # Round trips retained, about 2 minutes of idle time
+MIN_RTT_SAMPLES = 10                    # Round trips needed before judging percentiles
+DEGRADED_P95_NS = 100 * NANOSECONDS_PER_MILLISECOND
+
+# Upper bounds, in milliseconds, of the histogram buckets. The last bucket is unbounded.
+HISTOGRAM_BUCKETS_MS = [5, 10, 20, 50, 100, 200, 500]
+
+
+class LinkHealth:
+    """
+    Rolling round trip time statistics for the link to the Finish Line.
+    """
+
+    def __init__(self):
+        self.rtts = collections.deque(maxlen=RTT_WINDOW)
+        self.missed_pings = 0           # Consecutive unanswered pings
+        self.total_missed_pings = 0
+
+    def reset(self):
+        """
+        Forget all statistics. Call when the connection is replaced.
+        """
+        self.rtts.clear()
+        self.missed_pings = 0
+        self.total_missed_pings = 0
+
+    def record_rtt(self, rtt_ns):
+        """
+        Record the round trip time of an answered ping.
+        """
+        self.rtts.append(rtt_ns)
+        self.missed_pings = 0
+
+    def record_missed(self):
+        """
+        Record a ping that was not answered within PING_TIMEOUT_NS.
+        """
+        self.missed_pings += 1
+        self.total_missed_pings += 1
+
+    def percentile(self, fraction):
+        """
+        Round trip time, in nanoseconds, below which fraction of recent pings completed,
+        or None if no pings have been answered.
+        """
+        if not self.rtts:
+            return None
+        ordered = sorted(self.rtts)
+        index = min(int(fraction * len(ordered)), len(ordered) - 1)
+        return ordered[index]
+
+    def histogram(self):
+        """
+        Counts of recent round trips falling in each of HISTOGRAM_BUCKETS_MS, plus a
+        final count of those slower than the last bucket.
+        """
+        counts = [0] * (len(HISTOGRAM_BUCKETS_MS) + 1)
+        for rtt in self.rtts:
+            counts[bisect.bisect_left(HISTOGRAM_BUCKETS_MS, rtt / NANOSECONDS_PER_MILLISECOND)] += 1
+        return counts
+
+    def degraded(self):
+        """
+        Returns True if the link is too slow or lossy to trust with a race.
+        """
+        if self.missed_pings > 0:
+            return True
+        if len(self.rtts) < MIN_RTT_SAMPLES:
+            return False
+        return self.percentile(0.95) > DEGRADED_P95_NS
+
+    def lost(self):
+        """
+        Returns True if enough consecutive pings went unanswered to presume the link dead.
+        """
+        return self.missed_pings >= MAX_MISSED_PINGS
+
+    def summary(self):
+        """
+        One line description of the link's health for logging
+        """
+        if not self.rtts:
+            return "no round trips, %d missed" % self.total_missed_pings
+
+        p50, p95, p99 = [self.percentile(fraction) / NANOSECONDS_PER_MILLISECOND
+                         for fraction in (0.50, 0.95, 0.99)]
+        return "rtt p50=%.1fms p95=%.1fms p99=%.1fms histogram=%s missed=%d" % (
+            p50, p95, p99, self.histogram(), self.total_missed_pings)
+
+
+def main():
+    """
+    At some point I should write legitimate unit tests.  But for now, I just exercise
+    some basic functionality if the module is invoked as the Python main.
+    """
+    health = LinkHealth()
+    for rtt_ms in [8, 9, 12, 7, 30, 11, 10, 9, 25, 8, 9, 10]:
+        health.record_rtt(rtt_ms * NANOSECONDS_PER_MILLISECOND)
+    print(health.summary())
+    print("degraded=", health.degraded())   # False
+    health.record_missed()
+    print("degraded=", health.degraded())   # True
+
+if __name__ == '__main__':
+    main()
+
+# vim: expandtab sw=4
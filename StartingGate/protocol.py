@@ -0,0 +1,207 @@
+"""
+Diecast Remote Raceway - protocol
+
+Message framing for the Bluetooth link between the Starting Gate and the Finish Line.
+
+Every message in either direction is a short line of ASCII text terminated by a single
+MESSAGE_TERMINATOR ('\\n'). A message consists of a four character command, optionally
+followed by a space and space separated arguments. E.g.:
+
+    HELO\\n
+    FIN1 81234567 4711\\n
+
+The same format is implemented by FinishLine/finishline/finishline.ino. Keep the two
+in sync when adding new messages.
+
+RFCOMM is a byte stream, so a single recv() may return part of a message, exactly one
+message, or several messages at once (two lanes finishing a few milliseconds apart). The
+MessageFramer accumulates received bytes and returns every complete message contained
+in the stream, leaving any partial message buffered until the rest of it arrives.
+
+Author: Tom Quiggle
+tquiggle@gmail.com
+https://github.com/tquiggle/Die-Cast-Remote-Raceway
+
+Copyright (c) Thomas Quiggle. All rights reserved.
+
+Licensed under the MIT license. See LICENSE file in the project root for full license information.
+"""
+
+import collections
+
+MESSAGE_TERMINATOR = b"\n"
+MAX_MESSAGE_LENGTH = 256    # Longest message, excluding terminator, either side will send
+
+# Messages from the Starting Gate to the Finish Line
+HELLO = "HELO"          # HELO <capabilities>: answered with HELLO
+BEGIN_RACE = "BGIN"     # BGIN <race id>: arm the Finish Line, acknowledged with ARMED
+END_RACE = "ENDR"
+TIME = "TIME"           # TIME <seq>: request the Finish Line's current micros()
+PING = "PING"           # PING <seq>: keepalive, echoed back as PONG <seq>
+REPLAY = "RPLY"         # RPLY <race id> <sequence>: resend the race's FINs after sequence
+GET_CONFIG = "GETC"     # GETC [key,...]: answered with CONF
+SET_CONFIG = "SETC"     # SETC key=value or SETC <JSON object>: answered with CONF
+OTA_BEGIN = "OTAB"      # OTAB <size> <md5> [version]: start (or resume) a firmware update
+OTA_DATA = "OTAD"       # OTAD <offset> <crc32> <base64 chunk>: answered with OTAK or OTAN
+OTA_FINISH = "OTAF"     # OTAF: verify and install the image, answered with OTAC or OTAE
+OTA_ABORT = "OTAA"      # OTAA: discard the partially received image
+
+# Messages from the Finish Line to the Starting Gate
+HELLO_REPLY = "HELLO"   # HELLO <firmware version> <capabilities>
+ARMED = "ARMED"         # ARMED <race id>
+FINISHED = "FIN"        # FINn <micros> <race id> <sequence>: lane n finished at micros()
+TIME_REPLY = "TIME"     # TIME <seq> <micros when received> <micros when replied>
+PONG = "PONG"           # PONG <seq>
+CONFIG_REPLY = "CONF"   # CONF <JSON object>
+OTA_ACK = "OTAK"        # OTAK <offset>: every byte before offset has been written
+OTA_NAK = "OTAN"        # OTAN <offset>: chunk rejected, resend from offset
+OTA_ERROR = "OTAE"      # OTAE <reason>: the update has failed
+OTA_COMPLETE = "OTAC"   # OTAC: image verified, the Finish Line is restarting into it
+
+# Capability flags, exchanged in hex in HELO and HELLO. Firmware that predates them sends
+# a bare HELLO, and so has none of them.
+CAP_FRAMING = 0x01      # Every message is newline terminated
+CAP_TIMESTAMPS = 0x02   # FIN carries the micros() of the crossing
+CAP_TIME_SYNC = 0x04    # Answers TIME
+CAP_PING = 0x08         # Answers PING
+CAP_ARM_ACK = 0x10      # Answers BGIN with ARMED, and FIN carries the race id
+CAP_REPLAY = 0x20       # FIN carries a sequence number, and answers RPLY
+CAP_BATCH_CONFIG = 0x40 # SETC accepts a JSON object, and SETC/GETC are answered with CONF
+CAP_OTA = 0x80          # Accepts a firmware image over the link (OTAB/OTAD/OTAF/OTAA)
+CAPABILITIES = CAP_FRAMING | CAP_TIMESTAMPS | CAP_TIME_SYNC | CAP_PING | CAP_ARM_ACK | \
+    CAP_REPLAY | CAP_BATCH_CONFIG | CAP_OTA   # Everything the Starting Gate supports
+
+
+def encode_message(command, *args):
+    """
+    Encode a command and its arguments as a terminated message ready to send.
+    """
+    fields = [command] + [str(arg) for arg in args]
+    return " ".join(fields).encode('utf-8') + MESSAGE_TERMINATOR
+
+
+Finish = collections.namedtuple('Finish', ['lane', 'timestamp_us', 'race_id', 'sequence'])
+
+
+def parse_finished(message):
+    """
+    Parse a FINn message into a Finish tuple.
+
+    Lanes are named Lane1 through Lane4, but arrays are zero indexed.  So the "FIN1"
+    message indicates that the lane with an index position of 0 is finished.
+    timestamp_us is the Finish Line micros() when the crossing was detected, race_id
+    the id the race was armed with, and sequence the position of the finish among the
+    race's finishes, counting from 1. Fields the Finish Line firmware is too old to send
+    are None.
+    """
+    fields = message.split()
+    values = [int(field) for field in fields[1:4]]
+    values += [None] * (3 - len(values))
+    return Finish(int(fields[0][len(FINISHED)]) - 1, *values)
+
+
+def parse_hello_reply(message):
+    """
+    Parse a HELLO reply into a (firmware_version, capabilities) tuple. The version is
+    None if the firmware predates version negotiation.
+    """
+    fields = message.split()
+    version = fields[1] if len(fields) > 1 else None
+    capabilities = int(fields[2], 16) if len(fields) > 2 else 0
+    return version, capabilities
+
+
+def parse_time_reply(message):
+    """
+    Parse a TIME reply into a (sequence, receive_us, transmit_us) tuple.
+    """
+    fields = message.split()
+    return int(fields[1]), int(fields[2]), int(fields[3])
+
+
+class MessageFramer:
+    """
+    Incremental parser that splits a byte stream into terminated messages.
+
+    Received data is appended to a single, reused bytearray. Complete messages are removed
+    from the front of the buffer as they are extracted. A message longer than max_length
+    is garbage (e.g. line noise or a peer speaking a different protocol) and is discarded
+    up to its terminator, as the firmware does, so the buffer can never grow without bound.
+    """
+
+    def __init__(self, max_length=MAX_MESSAGE_LENGTH):
+        self.max_length = max_length
+        self.__buffer = bytearray()
+        self.__discarding = False       # The start of the buffered message was discarded
+
+    def feed(self, data):
+        """
+        Append data received from the stream and return a list of every complete
+        message now available, in the order received, as strings without terminators.
+        """
+        self.__buffer += data
+        messages = []
+        start = 0
+
+        while True:
+            end = self.__buffer.find(MESSAGE_TERMINATOR, start)
+            if end < 0:
+                break
+            if self.__discarding or end - start > self.max_length:
+                print("MessageFramer.feed(): discarded a message longer than", self.max_length,
+                      "bytes")
+                self.__discarding = False
+            else:
+                message = self.__buffer[start:end].decode('utf-8', 'replace').strip()
+                if message:
+                    messages.append(message)
+            start = end + len(MESSAGE_TERMINATOR)
+
+        del self.__buffer[:start]
+
+        if len(self.__buffer) > self.max_length:
+            self.__buffer.clear()
+            self.__discarding = True
+
+        return messages
+
+    def flush(self):
+        """
+        Empty the buffer and return the partial message it held, as a list of at most one
+        message. For a peer that predates framing and doesn't terminate its messages.
+        """
+        message = self.__buffer.decode('utf-8', 'replace').strip()
+        discarding = self.__discarding
+        self.reset()
+        return [message] if message and not discarding else []
+
+    def pending(self):
+        """
+        Returns the number of bytes of an incomplete message currently buffered.
+        """
+        return len(self.__buffer)
+
+    def reset(self):
+        """
+        Discard any partially received message. Call when the underlying connection
+        is replaced.
+        """
+        self.__buffer.clear()
+        self.__discarding = False
+
+
+def main():
+    """
+    At some point I should write legitimate unit tests.  But for now, I just exercise
+    some basic functionality if the module is invoked as the Python main.
+    """
+    framer = MessageFramer()
+    print(framer.feed(b"FIN1\nFI"))       # ['FIN1']
+    print(framer.feed(b"N2\nFIN3\n"))     # ['FIN2', 'FIN3']
+    print(framer.pending())               # 0
+    print(encode_message(BEGIN_RACE))     # b'BGIN\n'
+
+if __name__ == '__main__':
+    main()
+
+# vim: expandtab sw=4
@@ -0,0 +1,150 @@
+"""
+Diecast Remote Raceway - sensor_trace
+
+An always-on record of every edge seen on the Starting Gate's input pins.
+
+The flicker that debouncing hides (a lane sensor briefly losing sight of a car, a key
+bouncing) never reaches gpiozero's callbacks. SensorTrace records every edge pigpio
+reports as its pin, new level and pigpio tick in a fixed size ring buffer. The lane
+sensors' edges are raw: deviceio debounces the lanes after the edge is reported. The keys
+and joystick are still debounced by pigpio's glitch filter (their gpiozero bounce_time),
+so only the edges that get through it are recorded, each up to the filter time late.
+debounce_fit.py fits the lane debounce from the dumps. The buffer is preallocated, so
+recording an edge only stores three values and advances a counter: there is no logging,
+I/O or container growth in the edge callback. The oldest edges are overwritten once
+TRACE_SIZE have been recorded.
+
+dump() writes what the buffer holds to a compact binary file, on demand or when a race
+goes wrong (see starting_gate.run_race()). The file is a header followed by the edges,
+oldest first:
+
+    header  <4sHHIQIQ   magic b"DRRT", format version, record size, edges in the file,
+                        edges recorded since start, a tick and the time.time_ns() it
+                        was taken at (to place the ticks in wall clock time)
+    edge    <IBB        tick, BCM pin number, level (0 or 1; 2 for a pigpio watchdog)
+
+The edge records are laid out so numpy can read them directly with TRACE_DTYPE, e.g.:
+
+    numpy.fromfile(filename, dtype=TRACE_DTYPE, offset=HEADER.size)
+
+Author: Tom Quiggle
+tquiggle@gmail.com
+https://github.com/tquiggle/Die-Cast-Remote-Raceway
+
+Copyright (c) Thomas Quiggle. All rights reserved.
+
+Licensed under the MIT license. See LICENSE file in the project root for full license information.
+"""
+
+import array
+import collections
+import os
+import struct
+import time
+
+TRACE_SIZE = 8192               # Edges retained, 48 KB once dumped
+TRACE_MAGIC = b"DRRT"
+TRACE_VERSION = 1
+HEADER = struct.Struct("<4sHHIQIQ")
+RECORD = struct.Struct("<IBB")
+TRACE_DTYPE = [("tick", "<u4"), ("gpio", "u1"), ("level", "u1")]
+
+TraceHeader = collections.namedtuple(
+    'TraceHeader', ['edges', 'recorded', 'reference_tick', 'reference_time_ns'])
+Edge = collections.namedtuple('Edge', ['tick', 'gpio', 'level'])
+
+
+class SensorTrace:
+    """
+    Ring buffer of the most recent size edges. record() may be called from one thread
+    at a time (pigpio delivers every callback from its one notification thread) while
+    any thread calls dump().
+    """
+
+    # PUBLIC:
+
+    def __init__(self, current_tick, size=TRACE_SIZE):
+        self.current_tick = current_tick    # Returns the tick now, to date the dump
+        self.size = size
+        self.recorded = 0                   # Edges recorded since start, free running
+        self.__ticks = array.array('I', bytes(4 * size))
+        self.__pins = bytearray(size)
+        self.__levels = bytearray(size)
+
+    def record(self, gpio, level, tick):
+        """
+        Record an edge. The arguments are in the order pigpio passes them to callbacks,
+        so record can be registered directly.
+        """
+        index = self.recorded % self.size
+        self.__ticks[index] = tick
+        self.__pins[index] = gpio
+        self.__levels[index] = level
+        self.recorded += 1
+
+    def edges(self):
+        """
+        Returns a list of the Edges in the buffer, oldest first.
+        """
+        last = self.recorded
+        ticks, pins, levels = self.__ticks[:], self.__pins[:], self.__levels[:]
+        # Edges recorded while copying overwrote the oldest slots, which then can't be
+        # trusted, so drop as many of the oldest edges as were recorded meanwhile
+        first = max(self.recorded - self.size, 0)
+        return [Edge(ticks[n % self.size], pins[n % self.size], levels[n % self.size])
+                for n in range(first, last)]
+
+    def dump(self, filename):
+        """
+        Write the buffer to filename, creating its directory if need be. Returns the
+        number of edges written.
+        """
+        edges = self.edges()
+        reference_tick = self.current_tick()
+        reference_time_ns = time.time_ns()
+
+        directory = os.path.dirname(filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(filename, "wb") as trace_file:
+            trace_file.write(HEADER.pack(TRACE_MAGIC, TRACE_VERSION, RECORD.size, len(edges),
+                                         self.recorded, reference_tick, reference_time_ns))
+            trace_file.write(b"".join(RECORD.pack(*edge) for edge in edges))
+        print("SensorTrace: wrote ", len(edges), " edges to ", filename)
+        return len(edges)
+
+
+def load_trace(filename):
+    """
+    Read a trace written by SensorTrace.dump(). Returns a (TraceHeader, list of Edges)
+    tuple. Raises ValueError if filename isn't a trace.
+    """
+    with open(filename, "rb") as trace_file:
+        data = trace_file.read()
+
+    magic, version, record_size, edges, recorded, reference_tick, reference_time_ns = \
+        HEADER.unpack_from(data)
+    if magic != TRACE_MAGIC or version != TRACE_VERSION or record_size != RECORD.size:
+        raise ValueError("Not a version %d sensor trace: %s" % (TRACE_VERSION, filename))
+
+    header = TraceHeader(edges, recorded, reference_tick, reference_time_ns)
+    return header, [Edge(*fields) for fields in
+                    RECORD.iter_unpack(data[HEADER.size:HEADER.size + edges * RECORD.size])]
+
+
+def main():
+    """
+    At some point I should write legitimate unit tests.  But for now, I just exercise
+    some basic functionality if the module is invoked as the Python main.
+    """
+    trace = SensorTrace(lambda: 5000, size=4)
+    for tick in range(1000, 7000, 1000):
+        trace.record(7, tick // 1000 % 2, tick)
+    print(trace.edges())            # The last 4 edges, ticks 3000 to 6000
+    trace.dump("/tmp/sensor-trace.bin")
+    print(load_trace("/tmp/sensor-trace.bin"))
+
+if __name__ == '__main__':
+    main()
+
+# vim: expandtab sw=4
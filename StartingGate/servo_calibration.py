@@ -0,0 +1,130 @@
+"""
+Diecast Remote Raceway - servo_calibration
+
+Measures how long each lane's car takes to leave the gate once the servo is told to
+release it.
+
+A race starts for each lane when its car clears the gate sensor (see
+DeviceIO.lane_start_ns()). When the sensor misses the car, the race engine falls back
+to the moment the servo was told to release the gate, but the gate physically opens
+tens of milliseconds later, and how much later differs from one unit to the next and
+with servo_down_value. calibrate() fires the servo repeatedly, waiting for cars to be put
+back behind the gate each time, and times the release to each lane's sensor clearing.
+The median for each lane is stored in Config.servo_latency, together with the
+servo_down_value it was measured at, and starting_gate.estimated_start_ns() adds it to the
+release when there is no sensor start stamp:
+
+    {
+        "servo_down_value": 1.0,
+        "rounds": 10,
+        "latency": [0.0352, 0.0417, null, null],
+        "error": [0.0011, 0.0009, null, null]
+    }
+
+latency and error are in seconds, per lane; error is the furthest any measurement fell
+from the median. Lanes that were never seen to clear are null. Changing servo_down_value
+makes the profile stale, and it is ignored until the servo is calibrated again.
+
+Run on the Starting Gate, with the Starting Gate program stopped:
+
+    python3 servo_calibration.py --rounds 10 --config config/starting_gate.json
+
+Author: Tom Quiggle
+tquiggle@gmail.com
+https://github.com/tquiggle/Die-Cast-Remote-Raceway
+
+Copyright (c) Thomas Quiggle. All rights reserved.
+
+Licensed under the MIT license. See LICENSE file in the project root for full license information.
+"""
+
+import argparse
+import time
+
+from config import Config
+from deviceio import DeviceIO, LANES
+from starting_gate import release_starting_gate, reset_starting_gate, NANOSECONDS_TO_SECONDS
+
+CALIBRATION_ROUNDS = 10     # Releases to time
+SETTLE_SECONDS = 0.5        # Pause after the cars are placed, so they are at rest
+CLEAR_TIMEOUT = 1.0         # Seconds after the release for cars to clear their sensors
+POLL_SECONDS = 0.005
+
+
+def latency_profile(servo_down_value, samples):
+    """
+    Build a Config.servo_latency from samples, a list for each lane of the nanoseconds
+    from release to the lane's sensor clearing
+    """
+    latency = []
+    error = []
+    for lane_samples in samples:
+        if not lane_samples:
+            latency.append(None)
+            error.append(None)
+            continue
+        ordered = sorted(lane_samples)
+        median = ordered[len(ordered) // 2]
+        latency.append(median / NANOSECONDS_TO_SECONDS)
+        error.append(max(median - ordered[0], ordered[-1] - median) / NANOSECONDS_TO_SECONDS)
+    return {"servo_down_value": servo_down_value,
+            "rounds": max(len(lane_samples) for lane_samples in samples),
+            "latency": latency,
+            "error": error}
+
+
+def calibrate(config, rounds=CALIBRATION_ROUNDS):
+    """
+    Release the gate rounds times with cars on each of config.num_lanes lanes, and return
+    the resulting latency profile. Doesn't change config.
+    """
+    device = DeviceIO()
+    num_lanes = config.num_lanes
+    samples = [[] for _ in LANES]
+
+    for calibration_round in range(rounds):
+        reset_starting_gate(config)
+        print("Round %d of %d: place a car on each of the %d lanes" % (
+            calibration_round + 1, rounds, num_lanes))
+        device.wait_lanes_ready(num_lanes)
+        time.sleep(SETTLE_SECONDS)
+
+        release = release_starting_gate(config)
+        deadline = release + int(CLEAR_TIMEOUT * NANOSECONDS_TO_SECONDS)
+        starts = [None] * num_lanes
+        while None in starts and time.monotonic_ns() < deadline:
+            time.sleep(POLL_SECONDS)
+            starts = [device.lane_start_ns(lane) for lane in range(num_lanes)]
+
+        for lane, start in enumerate(starts):
+            if start is None:
+                print("  lane %d: not seen leaving the gate" % (lane + 1))
+                continue
+            samples[lane].append(start[0] - release)
+            print("  lane %d: %.1fms" % (lane + 1, (start[0] - release) / 1e6))
+
+    reset_starting_gate(config)
+    return latency_profile(config.servo_down_value, samples)
+
+
+def main():
+    """
+    Calibrate the servo and save the profile in the config
+    """
+    parser = argparse.ArgumentParser(description="Measure the starting gate's release latency")
+    parser.add_argument("--rounds", type=int, default=CALIBRATION_ROUNDS)
+    parser.add_argument("--config", default="config/starting_gate.json")
+    args = parser.parse_args()
+
+    config = Config(args.config)
+    DeviceIO().set_lane_debounce(config.lane_debounce)
+    profile = calibrate(config, args.rounds)
+    print("servo_latency = ", profile)
+
+    config.servo_latency = profile
+    config.save()
+
+if __name__ == '__main__':
+    main()
+
+# vim: expandtab sw=4
@@ -9,8 +9,7 @@ Starting Gate:
 
  TODO:
        Clean up startup process
-         * After exchanging HELLO messages, request version from FL
-         * Do version check on SG
+         * Do version check on SG against the version the FL reports in HELLO
          * Only if update needed, send UPFW command w/ bluetooth SSID and password
        Send encoded WiFI parameters to Finish Line if firmware update needed
 
@@ -25,26 +24,28 @@ Licensed under the MIT license. See LICENSE file in the project root for full li
 
 import json
 import operator
-import select
+import os
+import signal
 import time
 import traceback
 import threading
 
-import bluetooth
 import deviceio
-from deviceio import DeviceIO, SERVO, LANE1, LANE2, LANE3, LANE4
+from deviceio import DeviceIO, SERVO
 
 from config import Config, NOT_FINISHED
 from coordinator import Coordinator
 from display import Display
+from finish_line import FinishLine, FinishLineError, ARM_TIMEOUT
+from finish_line_config import FinishLineConfig
+from protocol import parse_finished, FINISHED
 
 # Globals (yea, I know)
 #pylint: disable=invalid-name
 race_aborted = False # Set by key_pressed callback to reset race state
-finish_line_connected = False
 
 NANOSECONDS_TO_SECONDS = 1000000000
-READ_ONLY = select.POLLIN | select.POLLPRI | select.POLLHUP | select.POLLERR
+COUNTDOWN_SECONDS = 3   # From all lanes ready to the gate opening
 
 def key_pressed():
     """
@@ -55,54 +56,28 @@ def key_pressed():
     print("key_pressed(): Setting race_aborted to True")
     global race_aborted #pylint: disable=global-statement
     race_aborted = True
+    DeviceIO().wake_lane_waiters()
 
-#TODO: Make this async and kick it off as early as possible.
-def connect_to_finish_line(target_name, display, old_socket, poller):
-    """ Perform a bluetooth scan for the Finish Line advertising itself as 'target_name'
-        If found, establish a connection and return the connected socket
+def wait_for_finish_line(finish_line, display):
+    """ Wait for the FinishLine thread to establish its connection.
+
+        The connection is made in the background from the moment the Starting Gate
+        launches, so this usually returns immediately.
 
         Args:
-            target_name:    The Bluetooth advertised name of the Finish Line to connect
+            finish_line:    FinishLine connection manager
             display:        Display object to manage display of race state
-            old_socket:     The socket previously connected to the Finish Line or None
-            poller:         The Select.Poll object to add new BT socket to
-
-        Returns:
-            socket          The open socket to the Finish Line
-
     """
+    if finish_line.connected():
+        return
 
-    port = 1
-    socket = None
-    target_address = None
-    global finish_line_connected #pylint: disable=global-statement
-
-    print("Attempting Bluetooth connection to ", target_name)
-
+    print("Waiting for connection to ", finish_line.transport)
     display.wait_finish_line()
 
-    if old_socket is not None:
-        poller.unregister(old_socket)
-
-    while target_address is None:
-        nearby_devices = bluetooth.discover_devices()
-
-        for bdaddr in nearby_devices:
-            if target_name == bluetooth.lookup_name(bdaddr):
-                target_address = bdaddr
-                break
-
-        if target_address is None:
-            print("could not find ", target_name, " nearby")
-        else:
-            print("Found ", target_name, ", connecting...")
-            socket = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
-            socket.connect((target_address, port))
-            poller.register(socket, READ_ONLY)
-            finish_line_connected = True
-            print("Connected to finish line")
-            socket.send("HELO")
-    return socket
+    while not finish_line.wait_connected(0.5):
+        if race_aborted:
+            return
+    print("Connected to finish line")
 
 def reset_starting_gate(config):
     """ Set servo to midpoint position to close the starting gate """
@@ -111,67 +86,69 @@ def reset_starting_gate(config):
     SERVO.value = None  # Stop PWM signal to servo to prevent humm/jitter and reduce wear
 
 def release_starting_gate(config):
-    """ Set servo to max position to release the starting gate """
-    SERVO.value = config.servo_down_value
+    """ Set servo to max position to release the starting gate.
 
-def all_lanes_empty(config):
-    """ Scan the lane sensors to see if any lanes have cars present. """
-    num_lanes = config.num_lanes
+        Returns the time.monotonic_ns() of the release, from which estimated_start_ns()
+        dates any lane whose car isn't seen leaving its gate sensor (see
+        DeviceIO.lane_start_ns()).
+    """
+    SERVO.value = config.servo_down_value
+    return DeviceIO().mark_release()
 
-    if num_lanes == 1:
-        return LANE1.value == 0
-    if num_lanes == 2:
-        return LANE1.value + LANE2.value == 0
-    if num_lanes == 3:
-        return LANE1.value + LANE2.value + LANE3.value == 0
-    if num_lanes == 4:
-        return LANE1.value + LANE2.value + LANE3.value + LANE4.value == 0
-    return 0 # Dead code, but makes pylint happy
+def schedule_gate_release(config, deadline_ns, confirm=None):
+    """ Release the starting gate at time.monotonic_ns() deadline_ns, from a thread of its
+        own so the release doesn't wait on the display, provided confirm() (if given)
+        returns True just before.
 
-def all_lanes_ready(config):
-    """ Scan the lane sensors to see if all lanes have cars present. """
+        Returns the ScheduledRelease, whose wait() returns the time.monotonic_ns() of the
+        release, or None if it was cancelled.
+    """
+    return DeviceIO().schedule_release(deadline_ns, config.servo_down_value, confirm)
 
-    num_lanes = config.num_lanes
+def estimated_start_ns(config, lane, release_ns):
+    """ Estimate when the car in lane left the gate released at release_ns, for when its
+        sensor didn't see it go. Returns a (monotonic_ns, error_ns) tuple.
 
-    if num_lanes == 1:
-        return LANE1.value == 1
-    if num_lanes == 2:
-        return LANE1.value + LANE2.value == 2
-    if num_lanes == 3:
-        return LANE1.value + LANE2.value + LANE3.value == 3
-    if num_lanes == 4:
-        return LANE1.value + LANE2.value + LANE4.value == 4
-    return 0 # Dead code, but makes pylint happy
-
-def purge_bluetooth_messages(socket):
-    """ Read any residual data from the Finish Line bluetooth connection.
-
-    Before adding the BGIN/ENDR message exchange to prevent the finish line
-    from sending results when something passed over a lane when no race was
-    active, this purge was critical. Otherwise pending messages (for example
-    from someone picking up a car from the finish line) would register before
-    a car actually reached the finish line.
-
-    Now reading data should be rare and probably indicates a problem in the
-    finish line's debounce logic for the IR sensors. Nevertheless, a millisecond
-    delay to read any outstanding data on the socket seems like a reasonable
-    defensive act.
+        The servo takes tens of milliseconds to open the gate, which servo_calibration.py
+        measures for each lane. Without a calibration for the current servo_down_value
+        the release itself is the best estimate.
     """
+    profile = config.servo_latency
+    if profile.get("servo_down_value") != config.servo_down_value or \
+            profile["latency"][lane] is None:
+        return release_ns, 0
+    return (release_ns + int(profile["latency"][lane] * NANOSECONDS_TO_SECONDS),
+            int(profile["error"][lane] * NANOSECONDS_TO_SECONDS))
+
+def all_lanes_empty(config):
+    """ Check the lane sensors to see if any lanes have cars present. """
+    return DeviceIO().lanes_empty(config.num_lanes)
+
+def all_lanes_ready(config):
+    """ Check the lane sensors to see if all lanes have cars present. """
+    return DeviceIO().lanes_ready(config.num_lanes)
 
-    prior_timeout = socket.gettimeout()
-    socket.settimeout(0.01)    # wait 1ms for any residual messages
+def dump_sensor_trace(config, reason):
+    """ Write the recent edges of every input to a new file in config.trace_dir """
+    filename = os.path.join(config.trace_dir,
+                            time.strftime("%Y%m%d-%H%M%S-") + reason + ".trace")
     try:
-        socket.recv(1024)   # Purge any messages from the Finish Line
-    except bluetooth.btcommon.BluetoothError as exc:
-        if exc.args[0] == 'timed out':
-            print("purge_bluetooth_messages(): BluetoothError = timed out, ignoring.")
-        else:
-            # Re raise any other bluetooth exception so the main loop will reconnect
-            print("purge_bluetooth_messages(): BluetoothError, other reason =", exc.args)
-            raise exc
-    socket.settimeout(prior_timeout)
+        DeviceIO().dump_trace(filename)
+    except OSError as exc:
+        print("Could not write sensor trace ", filename, ": ", exc)
+
+def check_race_anomalies(config, finish_times):
+    """ Dump the sensor trace if any lane didn't finish, or its car wasn't seen leaving
+        the gate, so the sensor behavior around the race can be examined afterwards.
+    """
+    device = DeviceIO()
+    anomalous = [lane + 1 for lane in range(config.num_lanes)
+                 if finish_times[lane] == NOT_FINISHED or device.lane_start_ns(lane) is None]
+    if anomalous:
+        print("Anomalous race in lanes ", anomalous)
+        dump_sensor_trace(config, "race")
 
-def run_race(config, coordinator, display, socket, poller):
+def run_race(config, coordinator, display, finish_line):
     """
     Run a race
 
@@ -179,34 +156,41 @@ def run_race(config, coordinator, display, socket, poller):
         config      Config object with current race configuration
         coordinator Coordinator object for communicating
         display     Display object to manage display of race state
-        socket      Bluetooth connection to Finish Line
-        poller      Polling object bound to socket to test for READ ready
+        finish_line FinishLine connection manager
     """
 
     global race_aborted #pylint: disable=global-statement
     num_lanes = config.num_lanes
     finish_times = [NOT_FINISHED, NOT_FINISHED, NOT_FINISHED, NOT_FINISHED]
+    finish_errors = [None, None, None, None]
 
-    def lane_index(msg):
-        """
-        Convert finished message received from the Finish Line to a lane index.
-
-        Lanes are named Lane1 through Lane4, but arrays are zero indexed.  So the "FIN1"
-        message indicates that the lane with an index position of 0 is finished.
-        """
-        lane_number = int(msg[3])
-        return lane_number - 1
-
-    def lane_finished(lane, times):
+    def lane_finished(lane, timestamp_us, times):
         """
         Record the finish time for the specified lane in the times array
+
+        The finish time is taken from the Finish Line's timestamp of the crossing so that
+        Bluetooth latency is not included in the result. Fall back to the time the message
+        arrived if the Finish Line didn't send a timestamp or we couldn't sync clocks.
+        Likewise the start time is when the lane's car cleared its gate sensor, falling
+        back to the gate's release plus the servo's calibrated latency.
         """
         if times[lane] != NOT_FINISHED:
             print("lane ", lane+1, " reported redundant finish")
             return
 
-        end = time.monotonic_ns()
-        delta = float(end - start) / NANOSECONDS_TO_SECONDS
+        lane_start, start_error = device.lane_start_ns(lane) or \
+            estimated_start_ns(config, lane, start)
+
+        finish = None
+        if timestamp_us is not None:
+            finish = finish_line.finish_time_ns(timestamp_us)
+
+        if finish is not None:
+            end, error = finish
+            finish_errors[lane] = float(error + start_error) / NANOSECONDS_TO_SECONDS
+        else:
+            end = time.monotonic_ns()
+        delta = float(end - lane_start) / NANOSECONDS_TO_SECONDS
         print("Lane %d finished. Elapsed time: %6.3f" % (lane+1, delta))
         times[lane] = delta
 
@@ -222,71 +206,81 @@ def run_race(config, coordinator, display, socket, poller):
     # Wait for cars on the local starting lanes
     display.wait_local_ready()
     print("Waiting for cars at the gate")
-    while not all_lanes_ready(config) and not race_aborted:
-        time.sleep(0.1)
+    device = DeviceIO()
+    while not race_aborted and not device.wait_lanes_ready(num_lanes):
+        pass
 
     if race_aborted:
         return
 
     print("All Lanes Ready.")
 
+    # Rather than lose a heat to a failing link, reconnect before the countdown
+    if finish_line.link_degraded():
+        print("Finish Line link degraded: ", finish_line.health.summary())
+        finish_line.reconnect()
+        raise FinishLineError("Finish Line link degraded")
+
     if config.multi_track:
         print("Waiting for remote ready")
         display.wait_remote_ready()
         coordinator.start_race()
         print("Remote track ready")
 
-    # Send start of race message to finish line.
-    # The message is sent before the countdown because it can take more than 1 second
-    # for the bluetooth communication and the message to be picked up and processed by
-    # the finish line. Odd, given that the lane finished messages from the finish line
-    # are received nearly instantly.
-    socket.send("BGIN")
-    display.countdown()
+    # Arm the finish line before the countdown so the BGIN/ARMED round trip overlaps it.
+    # Finishes reported before the Finish Line saw this race's id are discarded by the
+    # FinishLine thread, so there is nothing to purge afterwards.
+    finish_line.arm_race()
 
-    purge_bluetooth_messages(socket)
+    # From here on, however the race ends, tell the Finish Line to stop reporting finishes
+    try:
+        # The gate opens at the end of the countdown, on the dot, unless the Finish Line
+        # hasn't acknowledged BGIN by then
+        deadline = time.monotonic_ns() + COUNTDOWN_SECONDS * NANOSECONDS_TO_SECONDS
+        release = schedule_gate_release(config, deadline, lambda: finish_line.wait_armed(0))
+        display.countdown(deadline)
 
-    print("Start the race!")
-    release_starting_gate(config)
+        start = release.wait()
+        if start is None:
+            if not finish_line.wait_armed(ARM_TIMEOUT):
+                raise FinishLineError("Finish Line did not acknowledge BGIN")
+            start = release_starting_gate(config)
+        print("Start the race! Released %.3fms after the countdown" % (
+            (start - deadline) / 1e6))
 
-    display.race_started()
+        display.race_started()
 
-    start = time.monotonic_ns()
-    timeout = start + config.race_timeout * NANOSECONDS_TO_SECONDS
+        timeout = start + config.race_timeout * NANOSECONDS_TO_SECONDS
 
-    while not all_lanes_finished() and not race_aborted and time.monotonic_ns() < timeout:
-        try:
-            events = poller.poll(100)
-            if events:
-                data = socket.recv(5)
+        while not all_lanes_finished() and not race_aborted and time.monotonic_ns() < timeout:
+            try:
+                msg = finish_line.receive(0.1)
+            except FinishLineError:
+                # Keep racing; finishes missed while reconnecting are replayed once it's back
+                finish_line.wait_connected(0.1)
+                continue
 
-                msg = data.decode('utf-8')
+            if msg is not None:
                 print("received ", msg)
 
-                if msg.startswith("FIN"):
-                    lane_finished(lane_index(msg), finish_times)
-
-        except bluetooth.btcommon.BluetoothError as exc:
-            if exc.args[0] == 'timed out':
-                print("Timeout waiting for race results. Finishing race")
-            else:
-                print("purge_bluetooth_messages(): BluetoothError, other reason =", exc.args)
-                raise exc
-
-
-    # Send end of race message to Finish Line to disable further completion messages
-    socket.send("ENDR")
+                if msg.startswith(FINISHED):
+                    finish = parse_finished(msg)
+                    lane_finished(finish.lane, finish.timestamp_us, finish_times)
+    finally:
+        finish_line.end_race()
 
     if race_aborted:
         return
 
     print("Race finished")
+    check_race_anomalies(config, finish_times)
     results = []
     for lane in range(num_lanes):
         result = {}
         result["trackName"] = config.track_name
         result["laneNumber"] = lane + 1
         result["laneTime"] = finish_times[lane]
+        result["laneTimeError"] = finish_errors[lane]
         results.append(result)
 
     results.sort(key=operator.itemgetter('laneTime'))
@@ -301,23 +295,29 @@ def run_race(config, coordinator, display, socket, poller):
 
     # Placing a car on a lane terminates the results display and exits the race
 
-    while all_lanes_empty(config):
-        if race_aborted:
-            return
-        time.sleep(0.1)
+    while not race_aborted and not device.wait_lanes_occupied(num_lanes):
+        pass
 
 def main():
     """
     Configure starting_gate and run races
     """
     config = Config("/home/aweiland/StartingGate/config/starting_gate.json")
+
+    # Start connecting to the Finish Line right away so the link is usually up
+    # before the first race is selected
+    finish_line = FinishLine(config)
+    FinishLineConfig(config, finish_line)  # Provisions the Finish Line each time it connects
+    finish_line.start()
+
     display = Display(config)
     
     device = DeviceIO()
+    device.set_lane_debounce(config.lane_debounce)
     coordinator = Coordinator(config)
-    socket = None
-    poller = select.poll()
-    global finish_line_connected #pylint: disable=global-statement
+
+    # kill -USR1 dumps the sensor trace on demand
+    signal.signal(signal.SIGUSR1, lambda signum, frame: dump_sensor_trace(config, "request"))
 
     reset_starting_gate(config)
 
@@ -339,9 +339,8 @@ def main():
         device.push_key_handlers(key_pressed, key_pressed, key_pressed,
                                  deviceio.default_joystick_handler)
 
-        # Establish Bluetooth connection to Finish Line
-        if not finish_line_connected:
-            socket = connect_to_finish_line(config.finish_line_name, display, socket, poller)
+        # Make sure the connection to Finish Line is up
+        wait_for_finish_line(finish_line, display)
 
         # Register with the race coordinator if multi-track race selected in menu
         if config.multi_track:
@@ -351,11 +350,10 @@ def main():
 
         while not race_aborted:
             try:
-                run_race(config, coordinator, display, socket, poller)
-            except bluetooth.btcommon.BluetoothError:
-                print("Bluetooth exception caught.  Reconnecting...")
-                finish_line_connected = False
-                socket = connect_to_finish_line(config.finish_line_name, display, socket, poller)
+                run_race(config, coordinator, display, finish_line)
+            except FinishLineError:
+                print("Finish Line connection lost.  Waiting for reconnect...")
+                wait_for_finish_line(finish_line, display)
             except Exception as exc: #pylint: disable=broad-except
                 print("Unexpected exception caught", exc)
                 traceback.print_exc()
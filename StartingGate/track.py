@@ -5,24 +5,24 @@ import threading
 from dataclasses import dataclass
 
 from menuv2 import Menu
-from deviceio import DeviceIO, SERVO, LANE1, LANE2, LANE3, LANE4
+from deviceio import DeviceIO, SERVO
 from functools import wraps
 
 import time
 import random
-import select
-import bluetooth
 from abc import ABC, abstractmethod
 
 from views import MainMenuView, ConfigMenuView, WaitForFinishView, CountdownView, RaceRunningView, WaitForCarsView, \
     ResultsView
 from config import Config, NOT_FINISHED
 import deviceio
-from deviceio import DeviceIO, SERVO, LANE1, LANE2, LANE3, LANE4, JOYL, JOYR, JOYD, JOYP, JOYU
-from starting_gate import purge_bluetooth_messages, reset_starting_gate, all_lanes_ready, all_lanes_empty, \
-    release_starting_gate, NANOSECONDS_TO_SECONDS
-
-READ_ONLY = select.POLLIN | select.POLLPRI | select.POLLHUP | select.POLLERR
+from deviceio import DeviceIO, SERVO, JOYL, JOYR, JOYD, JOYP, JOYU, \
+    lanes_ready_in
+from finish_line import FinishLine, FinishLineError, ARM_TIMEOUT
+from protocol import parse_finished, FINISHED
+from starting_gate import reset_starting_gate, all_lanes_ready, all_lanes_empty, \
+    release_starting_gate, schedule_gate_release, check_race_anomalies, estimated_start_ns, \
+    COUNTDOWN_SECONDS, NANOSECONDS_TO_SECONDS
 
 
 class TrackState(ABC):
@@ -52,15 +52,17 @@ class TrackState(ABC):
 
 class Track:
 
-    def __init__(self, config: Config, device: DeviceIO):
+    def __init__(self, config: Config, device: DeviceIO, finish_line: FinishLine = None):
         # self.display = display
         self.config = config
         self.device = device
 
-        self.socket: bluetooth.BluetoothSocket = None
-        self.poller = select.poll()
+        # Connection manager started at launch. None when running a demo without a Finish Line
+        self.finish_line = finish_line
         self.car_positions = [0] * 4
         self.finish_times = [NOT_FINISHED] * 4
+        self.finish_errors = [None] * 4
+        self.start_time = None          # monotonic_ns at which the gate opened for the race
 
         self._main_menu = MainMenu()
         self._main_menu.context = self
@@ -114,12 +116,17 @@ class Track:
     def configure_menu(self):
         self.set_state(self._configure_menu)
 
-    def run_race(self):
+    def run_race(self, start_time):
+        self.start_time = start_time
         self.set_state(self._race_running)
 
     def race_finished(self):
         self.set_state(self._race_finished)
 
+    def finish_line_connected(self):
+        """True if the Finish Line is connected, or we are running a demo without one"""
+        return self.finish_line is None or self.finish_line.connected()
+
 
 class MainMenu(TrackState):
 
@@ -130,8 +137,10 @@ class MainMenu(TrackState):
 
     def __start_race(self):
         print('race')
-        # self.context.wait_for_finish()
-        self.context.wait_for_cars()
+        if self.context.finish_line_connected():
+            self.context.wait_for_cars()
+        else:
+            self.context.wait_for_finish()
 
     def __configure(self):
         print('configure')
@@ -149,7 +158,7 @@ class MainMenu(TrackState):
 
 
 class WaitForFinish(TrackState):
-    '''TODO Make this async to start'''
+    """Wait for the FinishLine thread to (re)connect, without blocking the render loop"""
     def __init__(self):
         super().__init__()
         self.view = WaitForFinishView()
@@ -159,40 +168,16 @@ class WaitForFinish(TrackState):
         self.context.device.push_key_handlers(self.context.main_menu, deviceio.default_key_2_handler,
                                               deviceio.default_key_3_handler, deviceio.default_joystick_handler)
 
-        # clear old socket if exists
-        if self.context.socket is not None:
-            self.context.poller.unregister(self.context.socket)
-            self.context.socket.close()
-
     def exit(self):
         self.context.device.pop_key_handlers()
 
     def loop(self):
-        self.view.draw(self.context.config)
-
-        target_address = None
-        port = 1
-
-        print("Looking for BT devices")
-        nearby_devices = bluetooth.discover_devices()
-
-        for bdaddr in nearby_devices:
-            if self.context.config.finish_line_name == bluetooth.lookup_name(bdaddr):
-                target_address = bdaddr
-                break
-
-        if target_address is None:
-            print("could not find ", self.context.config.finish_line_name, " nearby")
-        else:
-            print("Found ", self.context.config.finish_line_name, ", connecting...")
-            socket = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
-            socket.connect((target_address, port))
-            self.context.poller.register(socket, READ_ONLY)
-            self.context.socket = socket
+        if self.context.finish_line_connected():
             print("Connected to finish line")
-            socket.send("HELO")
-
             self.context.wait_for_cars()
+            return
+
+        self.view.draw(self.context.config)
 
 
 class WaitForCars(TrackState):
@@ -200,16 +185,8 @@ class WaitForCars(TrackState):
 
     def __init__(self):
         super().__init__()
-        self.lanes = [LANE1, LANE2, LANE3, LANE4]
         self.view = WaitForCarsView()
 
-    def _all_lanes_ready(self):
-        ready = True
-        for x in range(self.context.config.num_lanes):
-            ready = ready and self.lanes[x].value == 1
-
-        return ready
-
     def enter(self):
         print("Waiting for cars")
         self.view.load_car_images(self.context.config)
@@ -222,41 +199,83 @@ class WaitForCars(TrackState):
 
     def loop(self):
         """ Scan the lane sensors to see if all lanes have cars present. """
-        if self._all_lanes_ready():
+        if not self.context.finish_line_connected():
+            self.context.wait_for_finish()
+            return
+
+        # The lane mask is kept up to date by the sensor edges, so this reads no hardware,
+        # and one snapshot of it serves both the readiness test and the drawing
+        lane_mask = self.context.device.lane_mask()
+        if lanes_ready_in(lane_mask, self.context.config.num_lanes):
+            # Rather than lose a heat to a failing link, reconnect before the countdown
+            if self.context.finish_line and self.context.finish_line.link_degraded():
+                print("Finish Line link degraded: ", self.context.finish_line.health.summary())
+                self.context.finish_line.reconnect()
+                self.context.wait_for_finish()
+                return
             self.context.countdown()
 
-        car_status = [lane.value == 1 for lane in self.lanes]
+        car_status = [bool(lane_mask & (1 << lane)) for lane in range(4)]
         self.view.draw(self.context.config, car_status=car_status)
 
 
 class Countdown(TrackState):
     def __init__(self):
         super().__init__()
-        self.start_time = 0
+        self.deadline = 0
+        self.release = None
         self.view = CountdownView()
 
     def enter(self):
         print("Starting countdown")
-        self.start_time = time.monotonic()
+        # The gate opens at the deadline however long frames take, unless the Finish Line
+        # hasn't acknowledged BGIN by then; loop() then releases it once it has
+        self.deadline = time.monotonic_ns() + COUNTDOWN_SECONDS * NANOSECONDS_TO_SECONDS
+        finish_line = self.context.finish_line
+        confirm = (lambda: finish_line.wait_armed(0)) if finish_line else None
+        self.release = schedule_gate_release(self.context.config, self.deadline, confirm)
+
         self.view.load_car_images(self.context.config)
         print("Done loading car images")
 
-    def loop(self):
-        timer = 3 - math.floor(time.monotonic() - self.start_time)
-        if timer <= 0:
-            self.context.run_race()
-        self.view.draw(self.context.config, timer=timer)
-
+        # Arm the Finish Line now so the BGIN/ARMED round trip overlaps the countdown
+        if self.context.finish_line:
+            try:
+                self.context.finish_line.arm_race()
+            except FinishLineError as exc:
+                print("Lost connection to Finish Line arming race:", exc.args)
 
-def lane_index(msg):
-    """
-    Convert finished message received from the Finish Line to a lane index.
+    def __release_gate(self):
+        """
+        Wait for the scheduled release, or release the gate now if it was held back and the
+        Finish Line has since armed. Returns when the gate opened, or None if it is still shut.
+        """
+        if self.release:
+            release, self.release = self.release, None
+            start_time = release.wait()
+            if start_time is not None:
+                return start_time
+        # Prevent errors when running a demo
+        if self.context.finish_line and not self.context.finish_line.wait_armed(0):
+            return None
+        return release_starting_gate(self.context.config)
 
-    Lanes are named Lane1 through Lane4, but arrays are zero indexed.  So the "FIN1"
-    message indicates that the lane with an index position of 0 is finished.
-    """
-    lane_number = int(msg[3])
-    return lane_number - 1
+    def loop(self):
+        now = time.monotonic_ns()
+        timer = math.ceil((self.deadline - now) / NANOSECONDS_TO_SECONDS)
+        if timer <= 0:
+            # Only start the race once the gate is open, so RaceRunning always has a start.
+            # If the Finish Line hadn't armed by the deadline, keep drawing while it does.
+            start_time = self.__release_gate()
+            if start_time is not None:
+                self.context.run_race(start_time)
+            elif now - self.deadline >= ARM_TIMEOUT * NANOSECONDS_TO_SECONDS:
+                print("Finish Line did not acknowledge BGIN")
+                self.context.finish_line.end_race()
+                self.context.finish_line.reconnect()
+                self.context.wait_for_finish()
+                return
+        self.view.draw(self.context.config, timer=max(timer, 0))
 
 
 class RaceRunning(TrackState):
@@ -271,33 +290,44 @@ class RaceRunning(TrackState):
         self.progress_threshold = 0.4
 
     def enter(self):
-        self.start_time = time.monotonic()
         self.race_aborted = False
         self.car_positions = [0] * 4
         self.context.finish_times = [NOT_FINISHED] * 4
+        self.context.finish_errors = [None] * 4
 
-        self.timeout = (self.start_time + self.context.config.race_timeout) * NANOSECONDS_TO_SECONDS
-
-        # Prevent errors when running a demo
-        if self.context.socket:
-            self.context.socket.send("BGIN")
-            purge_bluetooth_messages(self.context.socket)
-
+        self.start_time = self.context.start_time
         self.view.load_car_images(self.context.config)
 
         print("Start the race!")
-        release_starting_gate(self.context.config)
+        self.timeout = self.start_time + self.context.config.race_timeout * NANOSECONDS_TO_SECONDS
 
-    def lane_finished(self, lane):
+    def lane_finished(self, lane, timestamp_us):
         """
         Record the finish time for the specified lane in the times array
+
+        The finish time is taken from the Finish Line's timestamp of the crossing so that
+        Bluetooth latency is not included in the result. Fall back to the time the message
+        arrived if the Finish Line didn't send a timestamp or we couldn't sync clocks.
+        Likewise the start time is when the lane's car cleared its gate sensor, falling
+        back to the gate's release plus the servo's calibrated latency.
         """
         if self.context.finish_times[lane] != NOT_FINISHED:
             print("lane ", lane + 1, " reported redundant finish")
             return
 
-        end = time.monotonic_ns()
-        delta = float(end - self.start_time) / NANOSECONDS_TO_SECONDS
+        lane_start, start_error = self.context.device.lane_start_ns(lane) or \
+            estimated_start_ns(self.context.config, lane, self.start_time)
+
+        finish = None
+        if timestamp_us is not None:
+            finish = self.context.finish_line.finish_time_ns(timestamp_us)
+
+        if finish is not None:
+            end, error = finish
+            self.context.finish_errors[lane] = float(error + start_error) / NANOSECONDS_TO_SECONDS
+        else:
+            end = time.monotonic_ns()
+        delta = float(end - lane_start) / NANOSECONDS_TO_SECONDS
         print("Lane %d finished. Elapsed time: %6.3f" % (lane + 1, delta))
         self.context.finish_times[lane] = delta
 
@@ -311,36 +341,35 @@ class RaceRunning(TrackState):
         return True
 
     def loop(self):
-        delta = time.monotonic() - self.start_time
+        delta = float(time.monotonic_ns() - self.start_time) / NANOSECONDS_TO_SECONDS
 
         for car in range(self.context.config.num_lanes):
             if random.random() < self.progress_threshold and self.car_positions[car] < self.view.MAX_Y:
                 # print("Incrementing car")
                 self.car_positions[car] += 5
 
-        if not self.all_lanes_finished() and not self.race_aborted and time.monotonic() < self.timeout:
+        if not self.all_lanes_finished() and not self.race_aborted and time.monotonic_ns() < self.timeout:
             try:
-                events = self.context.poller.poll(100)
-                if events:
-                    data = self.context.socket.recv(5)
-
-                    msg = data.decode('utf-8')
+                # Handle every message that arrived since the last frame without blocking
+                msg = self.context.finish_line.receive(0) if self.context.finish_line else None
+                while msg is not None:
                     print("received ", msg)
 
-                    if msg.startswith("FIN"):
-                        self.lane_finished(lane_index(msg), self.context.finish_times)
+                    if msg.startswith(FINISHED):
+                        finish = parse_finished(msg)
+                        self.lane_finished(finish.lane, finish.timestamp_us)
+                    msg = self.context.finish_line.receive(0)
 
-            except bluetooth.btcommon.BluetoothError as exc:
-                if exc.args[0] == 'timed out':
-                    print("Timeout waiting for race results. Finishing race")
-                    self.context.race_finished()
-                else:
-                    print("purge_bluetooth_messages(): BluetoothError, other reason =", exc.args)
-                    raise exc
+            except FinishLineError:
+                # Keep racing; finishes missed while reconnecting are replayed once it's back
+                pass
         else:
             print(
                 f"finished {self.all_lanes_finished()}, aborted {self.race_aborted}, timeout at {time.monotonic_ns()} < {self.timeout}")
-            self.context.socket.send("ENDR")
+            if self.context.finish_line:
+                self.context.finish_line.end_race()
+            if not self.race_aborted:
+                check_race_anomalies(self.context.config, self.context.finish_times)
             self.context.car_positions = self.car_positions
             self.context.race_finished()
 
@@ -359,6 +388,7 @@ class RaceFinished(TrackState):
         track_name: str
         lane_number: int
         lane_time: float
+        lane_time_error: float = None   # Bound on the error of lane_time, None if unknown
 
     def __init__(self):
         super().__init__()
@@ -382,7 +412,8 @@ class RaceFinished(TrackState):
             results.append(RaceFinished.FinishData(
                 track_name=self.context.config.track_name,
                 lane_number=lane + 1,
-                lane_time=self.context.finish_times[lane]
+                lane_time=self.context.finish_times[lane],
+                lane_time_error=self.context.finish_errors[lane]
             ))
 
         # results.sort(key=operator.itemgetter('laneTime'))
@@ -479,7 +510,7 @@ def run_sample_race():
     time.sleep(1)
     track.loop()
 
-    track.run_race()
+    track.run_race(time.monotonic_ns())
     for x in range(5):
         track.loop()
         time.sleep(0.01)
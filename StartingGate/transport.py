@@ -0,0 +1,339 @@
+"""
+Diecast Remote Raceway - transport
+
+Links over which the Starting Gate can talk to the Finish Line.
+
+Every transport carries the same newline framed messages (see protocol), so the
+FinishLine thread is indifferent to which one it is given. A Transport's connect()
+returns a connection object, or None if the Finish Line could not be found. The
+connection only needs the subset of the socket API the FinishLine thread uses:
+
+    fileno()        so it can be registered with select.poll()
+    recv(size)      returning b"" once the peer has gone away
+    sendall(data)
+    close()
+
+Any failure is reported by raising OSError (BluetoothError is a subclass of OSError).
+
+The transport is chosen by the finish_line_transport config, which is one of:
+
+    rfcomm                              Bluetooth RFCOMM to config.finish_line_name (default)
+    tcp://host:port                     TCP to finish_line_emulator.py --tcp
+    udp://host:port                     UDP to finish_line_emulator.py --udp
+    serial:///dev/ttyUSB0?baud=115200   A serial device, e.g. finish_line_emulator.py --pty
+
+Only rfcomm reaches a real Finish Line. The firmware reads commands from SerialBT alone:
+it has no TCP or UDP listener, and its USB serial port carries unframed debug output, not
+the protocol. tcp, udp and serial are for the emulator, and its benchmark can run over
+tcp or udp (finish_line_emulator.py --benchmark 20 --over udp).
+
+LoopbackTransport, which connects to a peer running in the same process, is created
+directly rather than from config; it exists to run the race path with no radios at all.
+
+The optional bluetooth and serial modules are only imported by the transports that
+need them, so a Starting Gate using TCP runs on any Linux box.
+
+Author: Tom Quiggle
+tquiggle@gmail.com
+https://github.com/tquiggle/Die-Cast-Remote-Raceway
+
+Copyright (c) Thomas Quiggle. All rights reserved.
+
+Licensed under the MIT license. See LICENSE file in the project root for full license information.
+"""
+
+import concurrent.futures
+import socket
+import threading
+import urllib.parse
+from abc import ABC, abstractmethod
+
+RFCOMM = "rfcomm"
+TCP = "tcp"
+UDP = "udp"
+SERIAL = "serial"
+
+FINISH_LINE_PORT = 1            # RFCOMM channel the Finish Line's SerialBT listens on
+DEFAULT_BAUD_RATE = 115200      # Baud rate of the serial transport
+
+
+class Transport(ABC):
+    """
+    A way of reaching the Finish Line
+    """
+
+    # Only one process at a time may use the link; the Finish Line serves one connection
+    exclusive = True
+
+    @abstractmethod
+    def connect(self):
+        """
+        Connect to the Finish Line and return the connection, or None if it could not
+        be found. Raises OSError if it was found but the connection failed.
+        """
+
+    def address(self):
+        """
+        Identifies the Finish Line most recently connected to, for keying what is
+        remembered about it.
+        """
+        return str(self)
+
+    def __str__(self):
+        return type(self).__name__
+
+
+def lookup_finish_line_address(target_name):
+    """
+    Perform a Bluetooth inquiry and return the address of the device advertising itself as
+    target_name, or None if no such device is nearby. Names of the discovered devices are
+    looked up in parallel and the search ends with the first match.
+    """
+    import bluetooth #pylint: disable=import-outside-toplevel
+
+    nearby_devices = bluetooth.discover_devices()
+    if not nearby_devices:
+        return None
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(nearby_devices))
+    lookups = {executor.submit(bluetooth.lookup_name, bdaddr): bdaddr for bdaddr in nearby_devices}
+    target_address = None
+
+    for lookup in concurrent.futures.as_completed(lookups):
+        if lookup.exception() is None and lookup.result() == target_name:
+            target_address = lookups[lookup]
+            break
+
+    executor.shutdown(wait=False, cancel_futures=True)
+    return target_address
+
+
+def open_finish_line_socket(address):
+    """
+    Open an RFCOMM connection to the Finish Line at address. Raises BluetoothError if
+    the connection can't be established.
+    """
+    import bluetooth #pylint: disable=import-outside-toplevel
+
+    bt_socket = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
+    try:
+        bt_socket.connect((address, FINISH_LINE_PORT))
+    except bluetooth.btcommon.BluetoothError:
+        bt_socket.close()
+        raise
+    return bt_socket
+
+
+class RfcommTransport(Transport):
+    """
+    Bluetooth RFCOMM connection to the Finish Line advertising config.finish_line_name.
+
+    A full Bluetooth inquiry followed by a name lookup of every device found takes upwards
+    of 10 seconds. The address of the Finish Line found by the last inquiry is saved in the
+    config (keyed by the advertised name) and a direct RFCOMM connection to that address is
+    attempted first, which completes in well under a second when the Finish Line is up.
+    Only if that fails is a full inquiry performed, with the name lookups run in parallel.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.__address = None
+
+    def connect(self):
+        import bluetooth #pylint: disable=import-outside-toplevel
+
+        config = self.config
+        target_name = config.finish_line_name
+        cached_address = config.finish_line_addresses.get(target_name)
+
+        if cached_address is not None:
+            try:
+                bt_socket = open_finish_line_socket(cached_address)
+                print("Connected to ", target_name, " at cached address ", cached_address)
+                self.__address = cached_address
+                return bt_socket
+            except bluetooth.btcommon.BluetoothError as exc:
+                print("Cached address ", cached_address, " for ", target_name, " failed: ", exc)
+
+        target_address = lookup_finish_line_address(target_name)
+        if target_address is None:
+            print("could not find ", target_name, " nearby")
+            return None
+
+        print("Found ", target_name, " at ", target_address, ", connecting...")
+        bt_socket = open_finish_line_socket(target_address)
+        self.__address = target_address
+
+        if target_address != cached_address:
+            # Replace rather than update the dict, which may still be shared with Config.DEFAULT
+            addresses = dict(config.finish_line_addresses)
+            addresses[target_name] = target_address
+            config.finish_line_addresses = addresses
+            config.save()   # On the FinishLine thread; Config serializes saves
+
+        return bt_socket
+
+    def address(self):
+        return self.__address
+
+    def __str__(self):
+        return "rfcomm:" + self.config.finish_line_name
+
+
+class TcpTransport(Transport):
+    """
+    TCP connection to an emulated Finish Line listening at host:port. Nagle's
+    algorithm is disabled since every message is small and latency sensitive.
+    """
+
+    def __init__(self, host, port, timeout=5.0):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+
+    def connect(self):
+        tcp_socket = socket.create_connection((self.host, self.port), self.timeout)
+        tcp_socket.settimeout(None)
+        tcp_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return tcp_socket
+
+    def __str__(self):
+        return "tcp://%s:%d" % (self.host, self.port)
+
+
+class UdpTransport(Transport):
+    """
+    Connected UDP socket to an emulated Finish Line at host:port. Messages are sent one
+    per datagram and a datagram may carry several. UDP makes no delivery guarantees, and
+    connect() succeeds whatever the address: a Finish Line that isn't there shows up as
+    an unanswered HELO or pings (see link_health), or as ConnectionRefusedError once the
+    host reports the port unreachable. Either way the FinishLine thread backs off.
+    """
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+
+    def connect(self):
+        udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            udp_socket.connect((self.host, self.port))
+        except OSError:
+            udp_socket.close()
+            raise
+        return udp_socket
+
+    def __str__(self):
+        return "udp://%s:%d" % (self.host, self.port)
+
+
+class SerialConnection:
+    """
+    Adapts a pyserial port to the socket subset the FinishLine thread uses.
+    """
+
+    def __init__(self, port):
+        self.port = port
+
+    def fileno(self):
+        return self.port.fileno()
+
+    def recv(self, size):
+        # poll() reports a port with nothing waiting as readable once the device is gone
+        return self.port.read(min(self.port.in_waiting, size))
+
+    def sendall(self, data):
+        self.port.write(data)
+
+    def close(self):
+        self.port.close()
+
+
+class SerialTransport(Transport):
+    """
+    Serial connection at device, such as the pty of an emulated Finish Line. The
+    firmware's own USB serial port only prints debug output.
+    """
+
+    def __init__(self, device, baud_rate=DEFAULT_BAUD_RATE):
+        self.device = device
+        self.baud_rate = baud_rate
+
+    def connect(self):
+        import serial #pylint: disable=import-outside-toplevel
+
+        try:
+            port = serial.Serial(self.device, self.baud_rate, timeout=0)
+        except serial.SerialException as exc:
+            raise OSError(*exc.args) from exc
+        return SerialConnection(port)
+
+    def __str__(self):
+        return "serial://%s?baud=%d" % (self.device, self.baud_rate)
+
+
+class LoopbackTransport(Transport):
+    """
+    In-process connection to a peer, e.g. a Finish Line emulator. Each connect() creates
+    a new socketpair and hands the far end to serve(peer_socket), which must return
+    promptly (typically by starting a thread to service peer_socket).
+    """
+
+    exclusive = False   # Nothing outside this process can reach the peer
+
+    def __init__(self, serve):
+        self.serve = serve
+
+    def connect(self):
+        near, far = socket.socketpair()
+        self.serve(far)
+        return near
+
+    def __str__(self):
+        return "loopback"
+
+
+def create_transport(config):
+    """
+    Create the Transport described by config.finish_line_transport. Raises ValueError
+    if it isn't understood.
+    """
+    spec = config.finish_line_transport
+    if spec == RFCOMM:
+        return RfcommTransport(config)
+
+    url = urllib.parse.urlsplit(spec)
+    if url.scheme in (TCP, UDP):
+        if url.hostname is None or url.port is None:
+            raise ValueError("finish_line_transport needs a host and port: " + spec)
+        if url.scheme == TCP:
+            return TcpTransport(url.hostname, url.port)
+        return UdpTransport(url.hostname, url.port)
+
+    if url.scheme == SERIAL:
+        query = urllib.parse.parse_qs(url.query)
+        baud_rate = int(query.get("baud", [DEFAULT_BAUD_RATE])[0])
+        return SerialTransport(url.path, baud_rate)
+
+    raise ValueError("Unknown finish_line_transport: " + spec)
+
+
+def main():
+    """
+    At some point I should write legitimate unit tests.  But for now, I just exercise
+    some basic functionality if the module is invoked as the Python main.
+    """
+    def echo(peer):
+        peer.sendall(peer.recv(1024))
+        peer.close()
+
+    connection = LoopbackTransport(
+        lambda peer: threading.Thread(target=echo, args=(peer,), daemon=True).start()).connect()
+    connection.sendall(b"HELO\n")
+    print(connection.recv(1024))        # b'HELO\n'
+    connection.close()
+
+if __name__ == '__main__':
+    main()
+
+# vim: expandtab sw=4
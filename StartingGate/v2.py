@@ -8,6 +8,8 @@ from deviceio import DeviceIO, SERVO, LANE1, LANE2, LANE3, LANE4, JOYL, JOYR, JO
 
 from config import Config, NOT_FINISHED
 from coordinator import Coordinator
+from finish_line import FinishLine
+from finish_line_config import FinishLineConfig
 # from displayv2 import Display, MainMenuView, init_display
 
 from track import Track, MainMenu
@@ -28,11 +30,19 @@ def init_display():
 
 def main():
     config = Config("/home/aweiland/StartingGate/config/starting_gate.json")
+
+    # Start connecting to the Finish Line right away so the link is usually up
+    # before the first race is selected
+    finish_line = FinishLine(config)
+    FinishLineConfig(config, finish_line)  # Provisions the Finish Line each time it connects
+    finish_line.start()
+
     # display = Display(config)
     init_display()
     device = DeviceIO()
+    device.set_lane_debounce(config.lane_debounce)
 
-    track = Track(config, device)
+    track = Track(config, device, finish_line)
     track.main_menu()
 
     while not pr.window_should_close():
@@ -1,10 +1,13 @@
 from dataclasses import dataclass
 from abc import ABC, abstractmethod
+from collections import OrderedDict
 from typing import Type
 import pyray as pr
 from pyray import WHITE, RAYWHITE, GRAY, BLACK, ORANGE, LIGHTGRAY
 from config import Config, NOT_FINISHED
 
+TEXTURE_BUDGET = 4 * 1024 * 1024    # Bytes of GPU memory cached textures may use
+
 
 def load_texture(filename):
     img = pr.load_image(filename)
@@ -13,6 +16,81 @@ def load_texture(filename):
     return texture
 
 
+def asset_filename(asset, size=None):
+    """
+    File holding asset, e.g. "cars/question" at size 24 is "cars/question-24.png". Assets
+    that come in one size are named by their file.
+    """
+    return asset if size is None else "{}-{}.png".format(asset, size)
+
+
+class TextureCache:
+    """
+    Textures shared by every view, keyed by asset and size, so each is read from the SD
+    card and uploaded to the GPU once however many views draw it.
+
+    Views acquire() the textures they draw and release() them when they stop. A texture
+    stays loaded while any view holds a reference to it. Once none do it stays cached, in
+    case it is wanted again (a car icon switched back, say), until the cached textures
+    exceed the budget of GPU memory; then the least recently used unreferenced ones are
+    unloaded.
+
+    raylib textures belong to the thread with the GL context, so the cache is only used
+    from the main loop and isn't locked.
+    """
+
+    class Entry:
+        def __init__(self, key, texture):
+            self.key = key
+            self.texture = texture
+            self.refs = 0
+            self.size = pr.get_pixel_data_size(texture.width, texture.height, texture.format)
+
+    def __init__(self, budget=TEXTURE_BUDGET):
+        self.budget = budget
+        self.size = 0                   # Bytes of GPU memory held by cached textures
+        self.loads = 0                  # Textures loaded from file since start
+        self._entries = OrderedDict()   # (asset, size) to Entry, least recently used first
+
+    def acquire(self, asset, size=None):
+        """
+        Return the texture for asset at size, loading it if it isn't cached, and take a
+        reference to it.
+        """
+        key = (asset, size)
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = TextureCache.Entry(key, load_texture(asset_filename(asset, size)))
+            self._entries[key] = entry
+            self.size += entry.size
+            self.loads += 1
+        self._entries.move_to_end(key)
+        entry.refs += 1
+        self._evict()
+        return entry.texture
+
+    def release(self, asset, size=None):
+        """
+        Drop a reference taken by acquire(). The texture stays cached until evicted.
+        """
+        entry = self._entries[(asset, size)]
+        assert entry.refs > 0, "texture {} released too often".format(entry.key)
+        entry.refs -= 1
+        self._evict()
+
+    def _evict(self):
+        for key in [key for key, entry in self._entries.items() if entry.refs == 0]:
+            if self.size <= self.budget:
+                break
+            entry = self._entries.pop(key)
+            pr.unload_texture(entry.texture)
+            self.size -= entry.size
+
+
+# The process wide texture cache
+TEXTURES = TextureCache()
+
+
 class View(ABC):
     def __init__(self):
         self.font = pr.load_font_ex("fonts/Roboto-Black.ttf", 32, None, 0)
@@ -76,28 +154,30 @@ class TrackView(View, ABC):
 
     def __init__(self):
         super().__init__()
-        self.background_texture = load_texture("images/raceoff-2.png")
-        self.checkerboard_small_texture = load_texture("images/checkerboard-34.png")
-        self.checkerboard_large_texture = load_texture("images/checkerboard-64.png")
-        self.question_small_texture = load_texture("cars/question-24.png")
-        self.question_large_texture = load_texture("cars/question-48.png")
+        self.background_texture = TEXTURES.acquire("images/raceoff-2.png")
+        self.checkerboard_small_texture = TEXTURES.acquire("images/checkerboard", 34)
+        self.checkerboard_large_texture = TEXTURES.acquire("images/checkerboard", 64)
+        self.question_small_texture = TEXTURES.acquire("cars/question", 24)
+        self.question_large_texture = TEXTURES.acquire("cars/question", 48)
 
         # self.car_textures = [None] * 4
         self.large_car_textures = [None] * 4
         self.small_car_textures = [None] * 4
+        self.car_icons = [None] * 4     # Icon each lane's textures were acquired for
 
     def load_car_images(self, config: Config):
-        # cleanup existing textures (if they exist)
-        for texture in self.small_car_textures + self.large_car_textures:
-            if texture:
-                pr.unload_texture(texture)
-
+        # Only lanes whose icon changed swap textures, so entering a state normally costs
+        # nothing, and a changed icon is read from the SD card only if it isn't cached
         for car in range(4):
-            car_icon_size = 24
             icon = config.car_icons[car]
-            self.small_car_textures[car] = load_texture("cars/{}-{}.png".format(icon, car_icon_size))
-            car_icon_size = 48
-            self.large_car_textures[car] = load_texture("cars/{}-{}.png".format(icon, car_icon_size))
+            if icon == self.car_icons[car]:
+                continue
+            if self.car_icons[car] is not None:
+                TEXTURES.release("cars/" + self.car_icons[car], 24)
+                TEXTURES.release("cars/" + self.car_icons[car], 48)
+            self.small_car_textures[car] = TEXTURES.acquire("cars/" + icon, 24)
+            self.large_car_textures[car] = TEXTURES.acquire("cars/" + icon, 48)
+            self.car_icons[car] = icon
 
     def _draw_background(self, config):
         pr.draw_texture(self.background_texture, 0, 0, WHITE)
@@ -210,21 +290,10 @@ class MainMenuView(View):
         super().__init__()
         print("Loading main menu textures")
 
-        background_image = pr.load_image("images/background.png")
-        self.background_texture = pr.load_texture_from_image(background_image)
-        pr.unload_image(background_image)
-
-        single_track_image = pr.load_image("images/Single-Track.png")
-        self.single_track_texture = pr.load_texture_from_image(single_track_image)
-        pr.unload_image(single_track_image)
-
-        multi_track_image = pr.load_image("images/Multi-Track.png")
-        self.multi_track_texture = pr.load_texture_from_image(multi_track_image)
-        pr.unload_image(multi_track_image)
-
-        configure_image = pr.load_image("images/Configure.png")
-        self.configure_texture = pr.load_texture_from_image(configure_image)
-        pr.unload_image(configure_image)
+        self.background_texture = TEXTURES.acquire("images/background.png")
+        self.single_track_texture = TEXTURES.acquire("images/Single-Track.png")
+        self.multi_track_texture = TEXTURES.acquire("images/Multi-Track.png")
+        self.configure_texture = TEXTURES.acquire("images/Configure.png")
 
     def _draw(self, config: Config, **kwargs):
         pr.draw_texture(self.background_texture, 0, 0, WHITE)
@@ -285,21 +354,12 @@ class ResultsView(TrackView):
 
     def __init__(self):
         super().__init__()
-        self.place_small_textures = [
-            load_texture("images/1st-24.png"),
-            load_texture("images/2nd-24.png"),
-            load_texture("images/3rd-24.png"),
-            load_texture("images/fail-24.png")
-        ]
-        self.place_large_textures = [
-            load_texture("images/1st-48.png"),
-            load_texture("images/2nd-48.png"),
-            load_texture("images/3rd-48.png"),
-            load_texture("images/fail-48.png")
-        ]
+        places = ["images/1st", "images/2nd", "images/3rd", "images/fail"]
+        self.place_small_textures = [TEXTURES.acquire(place, 24) for place in places]
+        self.place_large_textures = [TEXTURES.acquire(place, 48) for place in places]
 
-        self.fail_small_texture = load_texture("images/fail-48.png")
-        self.fail_large_texture = load_texture("images/fail-96.png")
+        self.fail_small_texture = TEXTURES.acquire("images/fail", 48)
+        self.fail_large_texture = TEXTURES.acquire("images/fail", 96)
 
     def _draw_result(self, track_count, track_number, lane_number, lane_time, place):
         print(f"Drawing result for lane {lane_number}/{track_count}")